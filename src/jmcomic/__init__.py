@@ -9,7 +9,10 @@ from .api import *
 from .jm_plugin import *
 from .jm_feature import *
 from .jm_async_client import AsyncJmApiClient
-from .jm_async_downloader import JmAsyncDownloader
+from .jm_async_downloader import JmAsyncDownloader, JmAsyncDownloadEngine
+from .jm_job_queue import JmJob, JmJobQueue, JmQueueWorker
+from .jm_multiprocess import JmSharedState, download_batch_multiprocess
+from .jm_lease import JmLeaseDir, JmLeaseWorker, download_batch_leased
 
 # 下面进行注册组件（客户端、插件）
 gb = dict(filter(lambda pair: isinstance(pair[1], type), globals().items()))
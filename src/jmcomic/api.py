@@ -1,4 +1,7 @@
 import asyncio
+import queue
+import threading
+from typing import AsyncGenerator
 from time import perf_counter
 
 from .jm_downloader import *
@@ -22,6 +25,123 @@ def _finish_download_result(detail, dler, task_started_at):
     return DownloadResult(detail, dler)
 
 
+def _decide_max_in_flight(option, max_in_flight):
+    """批量下载同时在途的本子数，默认为 download.threading.album，为 None 时不限制"""
+    if max_in_flight is None:
+        max_in_flight = BaseDownloader._threading_config(option, 'album', None)
+    if max_in_flight is None:
+        return None
+
+    max_in_flight = int(max_in_flight)
+    ExceptionTool.require_true(max_in_flight > 0, f'max_in_flight 必须大于0: {max_in_flight}')
+    return max_in_flight
+
+
+def _iter_jm_id(jm_id_iter):
+    """逐个取出 jm_id 并去重，不会一次性读完 jm_id_iter"""
+    seen = set()
+    for jmid in jm_id_iter:
+        jmid = JmcomicText.parse_to_jm_id(jmid)
+        if jmid not in seen:
+            seen.add(jmid)
+            yield jmid
+
+
+async def _aiter_jm_id(jm_id_iter):
+    """
+    _iter_jm_id 的异步版本，支持异步迭代器。
+    普通的生成器（例如由 search_gen / favorite_folder_gen 得到的 id）可能在取下一个 id 时发请求，在线程中拉取，避免阻塞事件循环。
+    """
+    if hasattr(jm_id_iter, '__aiter__'):
+        seen = set()
+        async for jmid in jm_id_iter:
+            jmid = JmcomicText.parse_to_jm_id(jmid)
+            if jmid not in seen:
+                seen.add(jmid)
+                yield jmid
+        return
+
+    it = _iter_jm_id(jm_id_iter)
+    if isinstance(jm_id_iter, (list, tuple, set, frozenset, dict)):
+        for jmid in it:
+            yield jmid
+        return
+
+    loop = asyncio.get_running_loop()
+    end = object()
+    while True:
+        jmid = await loop.run_in_executor(None, next, it, end)
+        if jmid is end:
+            return
+        yield jmid
+
+
+def download_batch_iter(download_api,
+                        jm_id_iter: Union[Iterable, Generator],
+                        option=None,
+                        downloader=None,
+                        max_in_flight=None,
+                        **kwargs,
+                        ) -> Generator[BatchItem, None, None]:
+    """
+    流式批量下载 album / photo，每下载完一个就产出一个 BatchItem（按完成顺序）。
+
+    jm_id_iter 按需逐个读取，同时在途的本子最多 max_in_flight 个（默认为 download.threading.album，未配置时不限制），
+    达到上限时等有本子下载完成再读取下一个 id，适合 search_gen 等很长的 id 来源。
+
+    一个album/photo，对应一个线程，所有的jmid共用一个option。
+    提前结束迭代时，已经开始的下载仍会在后台线程中完成，不会再开始新的下载。
+
+    :param download_api: 下载api
+    :param jm_id_iter: jmid (album_id, photo_id) 的迭代器
+    :param option: 下载选项
+    :param downloader: 下载器类
+    :param max_in_flight: 同时在途的本子数
+    """
+    if option is None:
+        option = JmModuleConfig.option_class().default()
+
+    max_in_flight = _decide_max_in_flight(option, max_in_flight)
+    download_type = _download_type(download_api)
+    done_queue = queue.Queue()
+
+    def _safe_download(aid):
+        """batch 内部的单任务包装：确保异常被收集而非静默丢失"""
+        item = None
+        try:
+            with jm_task_context(download_type=download_type, jm_id=str(aid)):
+                try:
+                    item = BatchItem(str(aid), download_api(aid, option, downloader, **kwargs), None)
+                except Exception as e:
+                    jm_log('batch.failed', f'批量下载失败: [{aid}], 异常: [{e}]', e)
+                    item = BatchItem(str(aid), None, e)
+        except BaseException as e:
+            # SystemExit 等非 Exception 的异常，同样要产出一项，否则迭代器会一直等待这个本子
+            item = BatchItem(str(aid), None, e)
+            raise
+        finally:
+            done_queue.put(item)
+
+    run = bind_jm_task_context(_safe_download)
+    in_flight = 0
+    for jmid in _iter_jm_id(jm_id_iter):
+        # 在途数达到上限时，先等有本子完成
+        while max_in_flight is not None and in_flight >= max_in_flight:
+            yield done_queue.get()
+            in_flight -= 1
+
+        threading.Thread(target=run, args=(jmid,)).start()
+        in_flight += 1
+
+        while not done_queue.empty():
+            yield done_queue.get()
+            in_flight -= 1
+
+    while in_flight > 0:
+        yield done_queue.get()
+        in_flight -= 1
+
+
 def download_batch(download_api,
                    jm_id_iter: Union[Iterable, Generator],
                    option=None,
@@ -31,7 +151,7 @@ def download_batch(download_api,
     """
     批量下载 album / photo
 
-    一个album/photo，对应一个线程，对应一个option。
+    一个album/photo，对应一个线程，对应一个option，同时在途的本子数见 download_batch_iter。
     返回 BatchResult(set)，支持 for album, dler in result 遍历。
     失败项收集在 result.failed 中，不会静默丢失。
 
@@ -40,34 +160,9 @@ def download_batch(download_api,
     :param option: 下载选项，所有的jmid共用一个option
     :param downloader: 下载器类
     """
-    from common import multi_thread_launcher
-
-    if option is None:
-        option = JmModuleConfig.option_class().default()
-
     result = BatchResult()
-
-    download_type = _download_type(download_api)
-
-    def _safe_download(aid):
-        """batch 内部的单任务包装：确保异常被收集而非静默丢失"""
-        with jm_task_context(download_type=download_type, jm_id=str(aid)):
-            try:
-                ret = download_api(aid, option, downloader, **kwargs)
-                result.add(ret)
-            except Exception as e:
-                jm_log('batch.failed', f'批量下载失败: [{aid}], 异常: [{e}]', e)
-                result.failed[str(aid)] = e
-
-    multi_thread_launcher(
-        iter_objs=set(
-            JmcomicText.parse_to_jm_id(jmid)
-            for jmid in jm_id_iter
-        ),
-        apply_each_obj_func=bind_jm_task_context(_safe_download),
-        wait_finish=True
-    )
-
+    for item in download_batch_iter(download_api, jm_id_iter, option, downloader, **kwargs):
+        result.add_item(item)
     return result
 
 
@@ -171,14 +266,32 @@ def create_option_by_str(text: str, mode=None):
 create_option = create_option_by_file
 
 
-def new_async_downloader(option=None, downloader=None):
+def new_async_downloader(option=None, downloader=None, engine=None):
     if option is None:
         option = JmModuleConfig.option_class().default()
 
     if downloader is None:
         downloader = JmModuleConfig.async_downloader_class()
 
-    return downloader(option)
+    if engine is None:
+        return downloader(option)
+    return downloader(option, engine=engine)
+
+
+def new_async_engine(option=None, downloader=None):
+    """
+    创建异步下载器共享的下载引擎（client、解密池、全局并发限制），下载器不支持共享引擎时返回 None
+    """
+    if option is None:
+        option = JmModuleConfig.option_class().default()
+
+    if downloader is None:
+        downloader = JmModuleConfig.async_downloader_class()
+
+    create_engine = getattr(downloader, 'create_engine', None)
+    if create_engine is None:
+        return None
+    return create_engine(option)
 
 
 async def download_album_async(jm_album_id,
@@ -187,6 +300,7 @@ async def download_album_async(jm_album_id,
                                *,
                                check_exception=True,
                                extra=None,
+                               engine=None,
                                ):
     """
     异步下载一个本子（album），包含其所有的章节（photo）。
@@ -195,6 +309,7 @@ async def download_album_async(jm_album_id,
     - 返回 (album, downloader) 元组，其中 downloader 的网络和线程池资源已关闭，仅用于读取下载结果
     - check_exception 仅当 jm_album_id 是单个 ID 时生效。多 ID 场景请检查 BatchResult.failed，
       或自行封装 download_batch_async 处理批量异常
+    - engine: 共享的下载引擎（见 JmAsyncDownloadEngine），由 download_batch_async 传入，不传时下载器独占一个引擎
     """
     if not isinstance(jm_album_id, (str, int)):
         return await download_batch_async(download_album_async,
@@ -206,7 +321,7 @@ async def download_album_async(jm_album_id,
 
     task_started_at = perf_counter()
     with jm_task_context(download_type='album', jm_id=str(jm_album_id), task_started_at=task_started_at):
-        async with new_async_downloader(option, downloader) as dler:
+        async with new_async_downloader(option, downloader, engine) as dler:
             dler.add_features(extra)
             album = await dler.download_album(jm_album_id)
 
@@ -222,12 +337,14 @@ async def download_photo_async(jm_photo_id,
                                *,
                                check_exception=True,
                                extra=None,
+                               engine=None,
                                ):
     """
     异步下载一个章节（photo）。
     返回的 downloader 已关闭网络和线程池资源，仅用于读取下载结果。
     check_exception 仅当 jm_photo_id 是单个 ID 时生效。多 ID 场景请检查
     BatchResult.failed，或自行封装 download_batch_async 处理批量异常。
+    engine 同 download_album_async。
     """
     if not isinstance(jm_photo_id, (str, int)):
         return await download_batch_async(download_photo_async,
@@ -239,7 +356,7 @@ async def download_photo_async(jm_photo_id,
 
     task_started_at = perf_counter()
     with jm_task_context(download_type='photo', jm_id=str(jm_photo_id), task_started_at=task_started_at):
-        async with new_async_downloader(option, downloader) as dler:
+        async with new_async_downloader(option, downloader, engine) as dler:
             dler.add_features(extra)
             photo = await dler.download_photo(jm_photo_id)
 
@@ -249,6 +366,99 @@ async def download_photo_async(jm_photo_id,
         return _finish_download_result(photo, dler, task_started_at)
 
 
+async def _enter_batch_engine(download_api, option, downloader):
+    """
+    打开批量下载共用的下载引擎，download_api 不是 download_album_async / download_photo_async 或下载器不支持共享引擎时返回 None
+    """
+    if download_api not in (download_album_async, download_photo_async):
+        return None
+
+    engine = new_async_engine(option, downloader)
+    if engine is not None:
+        await engine.__aenter__()
+    return engine
+
+
+async def _stream_batch_async(download_api,
+                              jm_id_iter,
+                              option,
+                              downloader,
+                              engine,
+                              max_in_flight,
+                              **kwargs,
+                              ) -> AsyncGenerator[BatchItem, None]:
+    """download_batch_stream_async 的实现，engine 已打开，结束时负责关闭"""
+    download_type = _download_type(download_api)
+
+    async def _download_one(jmid):
+        with jm_task_context(download_type=download_type, jm_id=str(jmid)):
+            try:
+                if engine is None:
+                    return BatchItem(str(jmid), await download_api(jmid, option, downloader, **kwargs), None)
+
+                async with engine.album_slot():
+                    ret = await download_api(jmid, option, downloader, engine=engine, **kwargs)
+                return BatchItem(str(jmid), ret, None)
+            except Exception as e:
+                # 失败不抛出，但要记录到 BatchItem.error，便于调用者排查
+                jm_log('async.batch.failed', f'批量下载失败: [{jmid}], 异常: [{e}]', e)
+                return BatchItem(str(jmid), None, e)
+
+    pending = set()
+    try:
+        async for jmid in _aiter_jm_id(jm_id_iter):
+            if max_in_flight is not None and len(pending) >= max_in_flight:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+
+            pending.add(asyncio.ensure_future(_download_one(jmid)))
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        if engine is not None:
+            await engine.__aexit__(None, None, None)
+
+
+async def download_batch_stream_async(download_api,
+                                      jm_id_iter,
+                                      option=None,
+                                      downloader=None,
+                                      max_in_flight=None,
+                                      **kwargs,
+                                      ) -> AsyncGenerator[BatchItem, None]:
+    """
+    异步流式批量下载 album / photo，每下载完一个就产出一个 BatchItem（按完成顺序）。
+
+    - jm_id_iter 可以是普通迭代器或异步迭代器，按需逐个读取
+    - 同时在途的本子最多 max_in_flight 个（默认为 download.threading.album，未配置时不限制），达到上限时等有本子下载完成再读取下一个 id
+    - download_album_async / download_photo_async 的批量下载共用一个下载引擎：一个 client（AsyncSession）、一个解密池，
+      图片 / 章节并发数是整批的全局上限。每个本子仍使用自己的下载器，下载结果和 DownloadManifest 互相独立。
+    - 提前结束迭代（break / aclose）时，取消还在下载的本子并关闭引擎
+    - 下载引擎初始化失败（例如 client setup 失败）时直接抛出异常，不读取 jm_id_iter
+    """
+    if option is None:
+        option = JmModuleConfig.option_class().default()
+
+    max_in_flight = _decide_max_in_flight(option, max_in_flight)
+    # 初始化失败时直接抛出：jm_id_iter 可能是无限长的生成器，不能逐项记为失败
+    engine = await _enter_batch_engine(download_api, option, downloader)
+
+    stream = _stream_batch_async(download_api, jm_id_iter, option, downloader, engine, max_in_flight, **kwargs)
+    try:
+        async for item in stream:
+            yield item
+    finally:
+        await stream.aclose()
+
+
 async def download_batch_async(download_api,
                                jm_id_iter,
                                option=None,
@@ -258,31 +468,28 @@ async def download_batch_async(download_api,
     """
     异步批量下载 album / photo。
     - 容错机制：单个 album/photo 失败不会中止整批，也不会丢失其它已完成结果。
+      下载引擎初始化失败时，jm_id_iter 中的每一项都记为失败。
     - 返回 BatchResult(set)，失败项收集在 result.failed 中。
+    - 同时在途的本子数、共享的下载引擎见 download_batch_stream_async。
     """
     if option is None:
         option = JmModuleConfig.option_class().default()
 
-    jm_ids = list(dict.fromkeys(JmcomicText.parse_to_jm_id(jmid) for jmid in jm_id_iter))
-    download_type = _download_type(download_api)
-
-    async def _download_one(jmid):
-        with jm_task_context(download_type=download_type, jm_id=str(jmid)):
-            return await download_api(jmid, option, downloader, **kwargs)
-
-    results = await asyncio.gather(
-        *(_download_one(jmid) for jmid in jm_ids),
-        return_exceptions=True,
-    )
-
-    # 失败不抛出，但要记录到 result.failed，便于调用者排查
+    max_in_flight = _decide_max_in_flight(option, kwargs.pop('max_in_flight', None))
     result = BatchResult()
-    for jmid, r in zip(jm_ids, results):
-        if isinstance(r, BaseException):
+
+    try:
+        engine = await _enter_batch_engine(download_api, option, downloader)
+    except Exception as e:
+        # 引擎初始化失败（例如 client setup 失败），整批的每一项都记为失败
+        download_type = _download_type(download_api)
+        async for jmid in _aiter_jm_id(jm_id_iter):
             with jm_task_context(download_type=download_type, jm_id=str(jmid)):
-                jm_log('async.batch.failed', f'批量下载失败: [{jmid}], 异常: [{r}]', r)
-            result.failed[str(jmid)] = r
-        else:
-            result.add(r)
+                jm_log('async.batch.failed', f'批量下载失败: [{jmid}], 异常: [{e}]', e)
+            result.failed[str(jmid)] = e
+        return result
 
+    async for item in _stream_batch_async(download_api, jm_id_iter, option, downloader, engine, max_in_flight,
+                                          **kwargs):
+        result.add_item(item)
     return result
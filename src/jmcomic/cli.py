@@ -5,7 +5,13 @@ command-line usage
 
   $ jmcomic 123 456 p333 --option="D:/option.yml"
 
-2. jmv - view album detail (extract digits from text as album id):
+2. jmcomic worker - drain a persistent job queue (see jm_job_queue.py):
+
+  $ jmcomic worker --queue="D:/jobs.db" --add 123 456 p333
+  $ jmcomic worker --queue="D:/jobs.db" --option="D:/option.yml"
+  $ jmcomic worker --queue="D:/jobs.db" --stats
+
+3. jmv - view album detail (extract digits from text as album id):
 
   $ jmv 350234
   $ jmv 350谁还没看过234
@@ -157,7 +163,133 @@ class JmcomicUI:
             launcher.wait_finish()
 
 
+class JmWorkerUI:
+
+    def __init__(self) -> None:
+        self.queue_path: str = ''
+        self.option_path: Optional[str] = None
+        self.raw_id_list: List[str] = []
+        self.priority: int = 0
+        self.concurrency: Optional[int] = None
+        self.exit_when_empty = False
+        self.estimate_page_count = False
+        self.show_stats = False
+
+    def parse_arg(self, argv):
+        import argparse
+        parser = argparse.ArgumentParser(
+            prog='jmcomic worker',
+            description='JMComic Queue Worker - 持续下载任务队列中的本子/章节，重启后从上次停下的地方继续',
+        )
+        parser.add_argument(
+            '--queue',
+            help='任务队列文件路径（SQLite），不存在时自动创建',
+            type=str,
+            required=True,
+        )
+        parser.add_argument(
+            '--option',
+            help='option 文件路径，也可通过环境变量 JM_OPTION_PATH 指定',
+            type=str,
+            default=get_env('JM_OPTION_PATH', ''),
+        )
+        parser.add_argument(
+            '--add',
+            nargs='+',
+            default=[],
+            help='只把这些 album/photo id 添加到队列，不下载。章节 id 需要加 "p" 前缀，例如 `--add 123 456 p333`',
+        )
+        parser.add_argument(
+            '--priority',
+            type=int,
+            default=0,
+            help='--add 添加的任务的优先级，越大越先下载，默认为0',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=None,
+            help='同时下载的任务数，默认为 option 中的 download.threading.album，未配置时为8',
+        )
+        parser.add_argument(
+            '--exit-when-empty',
+            action='store_true',
+            help='队列中没有未完成的任务时退出，默认会一直等待新任务',
+        )
+        parser.add_argument(
+            '--estimate',
+            action='store_true',
+            help='下载前先获取页数未知的本子的页数，使短任务优先对所有本子生效',
+        )
+        parser.add_argument(
+            '--stats',
+            action='store_true',
+            help='只输出队列统计（各状态任务数、吞吐量），不下载',
+        )
+
+        args = parser.parse_args(argv)
+        self.queue_path = os.path.abspath(args.queue)
+        self.raw_id_list = args.add
+        self.priority = args.priority
+        self.concurrency = args.concurrency
+        self.exit_when_empty = args.exit_when_empty
+        self.estimate_page_count = args.estimate
+        self.show_stats = args.stats
+
+        option = args.option
+        if len(option) == 0 or option == "''":
+            self.option_path = None
+        else:
+            self.option_path = os.path.abspath(option)
+
+    def main(self, argv=None):
+        self.parse_arg(argv)
+        from .jm_job_queue import JmJobQueue, JmQueueWorker
+        queue = JmJobQueue(self.queue_path)
+
+        if self.raw_id_list:
+            self.add_jobs(queue)
+            return
+
+        if self.show_stats:
+            for key, value in queue.stats().items():
+                print(f'{key}: {value:g}' if isinstance(value, float) else f'{key}: {value}')
+            return
+
+        from .api import create_option, JmOption, jm_log
+        option = create_option(self.option_path) if self.option_path is not None else JmOption.default()
+        worker = JmQueueWorker(
+            queue,
+            option,
+            concurrency=self.concurrency,
+            exit_when_empty=self.exit_when_empty,
+            estimate_page_count=self.estimate_page_count,
+        )
+        jm_log('command_line',
+               f'start queue worker...\n'
+               f'- using option: [{self.option_path or "default"}]\n'
+               f'- queue: [{self.queue_path}], {queue.depth()} job(s) to be downloaded')
+        try:
+            worker.run_forever()
+        except KeyboardInterrupt:
+            # 正在下载的任务已放回队列，下次启动时继续
+            pass
+
+    def add_jobs(self, queue):
+        jmcomic_ui = JmcomicUI()
+        jmcomic_ui.raw_id_list = self.raw_id_list
+        jmcomic_ui.parse_raw_id()
+        added = queue.put_many(jmcomic_ui.album_id_list, 'album', self.priority) \
+            + queue.put_many(jmcomic_ui.photo_id_list, 'photo', self.priority)
+        print(f'added {added} job(s), {queue.depth()} job(s) to be downloaded')
+
+
 def main():
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        JmWorkerUI().main(sys.argv[2:])
+        return
+
     JmcomicUI().main()
 
 
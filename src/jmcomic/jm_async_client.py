@@ -7,6 +7,8 @@ from __future__ import annotations
 
 import asyncio
 import json
+import time
+from collections import deque
 from copy import deepcopy
 from typing import Sequence
 from urllib.parse import urlencode
@@ -15,11 +17,11 @@ from curl_cffi.requests import AsyncSession
 
 from .jm_client_interface import (
     JmApiResp, JmImageResp, JmAlbumCommentResp,
-    AsyncJmcomicClient,
+    AsyncJmcomicClient, DomainHealthRegistry, ImageHostCircuitBreaker, RetryPolicy, RateLimiter,
 )
 from .jm_entity import (
     JmAlbumDetail, JmPhotoDetail, JmSearchPage, JmCategoryPage,
-    JmFavoritePage, DetailType, JmAlbumCommentPage
+    JmFavoritePage, DetailType, JmAlbumCommentPage, EntitySnapshot,
 )
 from .jm_config import JmModuleConfig, JmMagicConstants, time_stamp, jm_log
 from .jm_toolkit import (
@@ -52,6 +54,8 @@ class AsyncJmApiClient(AsyncJmcomicClient):
 
     # 缓存未命中标记
     _SENTINEL = object()
+    # 正在进行中的请求，见 _single_flight（首次使用时创建，每个实例各自一份）
+    _flight_dict: dict | None = None
 
     # 类级别初始化标记与锁，防止并发更新域名
     _has_setup_domain = False
@@ -66,6 +70,17 @@ class AsyncJmApiClient(AsyncJmcomicClient):
         retry_times = option.client.get('retry_times')
         self._retry_times = retry_times if retry_times is not None else 5
         self._timeout = option.client.get('timeout', 30) or 30
+        self.retry_policy = RetryPolicy.from_config(option.client.get('retry', None))
+        RateLimiter.configure(option.client.get('rate_limit', None))
+        # 响应解码，见 req_api
+        decode_config = option.client.get('decode', None) or {}
+        JmcomicText.configure_json(decode_config.get('json', None))
+        self._decode_offload_bytes = decode_config.get('offload_bytes', None)
+        # 图片对冲请求，见 _get_jm_image_hedged
+        self._hedge_config = option.client.get('hedge', None) or {}
+        self._image_latency_list = deque(maxlen=200)
+        self.image_request_count = 0
+        self.image_hedge_count = 0
         # AsyncSession 句柄池大小：优先用调用方（下载器）传入的实际图片并发，
         # 否则回退到 option 配置；避免因默认限制导致真实并发被隐式压低。
         if max_clients:
@@ -172,6 +187,30 @@ class AsyncJmApiClient(AsyncJmcomicClient):
     # 而是直接在 _fetch_detail_entity / search 内部通过 _cache_get/_cache_set 进行结果级缓存操作。
     # 启停状态由 self._cache 对象驱动。
 
+    async def _single_flight(self, key, request_func) -> tuple:
+        """
+        请求合并：同一个 key 的请求正在进行时，后来的调用方不再发请求，而是等待同一个结果（异常也一样）。
+        缓存只能在第一个请求完成后命中，这里补上请求进行中的这段时间，作用同同步端的 PhotoConcurrentFetcherProxy.get_future。
+
+        :param key: 请求的标识，例如 ('detail', jmid, clazz)
+        :param request_func: 无参函数，返回发起请求的协程
+        :return: (结果, 结果是否被多个调用方共享)，共享的结果如果会被修改，调用方需要自行复制
+        """
+        if self._flight_dict is None:
+            self._flight_dict = {}
+
+        flight = self._flight_dict.get(key)
+        if flight is None:
+            flight = self._flight_dict[key] = [asyncio.ensure_future(request_func()), 0]
+            # 完成后移除，之后的调用走缓存
+            flight[0].add_done_callback(lambda _: self._flight_dict.pop(key, None))
+        else:
+            flight[1] += 1
+
+        # shield：一个调用方被取消时，不影响其他调用方等待的请求
+        result = await asyncio.shield(flight[0])
+        return result, flight[1] != 0
+
     # ======================================================================
     # Session 管理
     # ======================================================================
@@ -255,40 +294,54 @@ class AsyncJmApiClient(AsyncJmcomicClient):
         """
         带域名切换机制的请求重试策略。
         机制：在当前域名下重试指定的次数，如全数失败则切换至备选域名，直至遍历完所有可用域名。
+        域名顺序由 DomainHealthRegistry 按健康度排序（与同步客户端共用统计）。
         """
-        domain_list = self._domain_list
-        if not domain_list:
+        if not self._domain_list:
             ExceptionTool.raises("无可用 API 域名列表")
+        domain_list = DomainHealthRegistry.rank(self._domain_list)
+        ctx = self.retry_policy.new_context(domain_list, self._retry_times)
 
-        for domain_index, domain in enumerate(domain_list):
+        while True:
+            domain = ctx.target
             url = self._build_api_url(url_path, domain)
 
-            for retry in range(self._retry_times + 1):
-                # 记录重试信息
-                if domain_index != 0 or retry != 0:
-                    jm_log('req.retry',
-                           f'次数: [{retry}/{self._retry_times}], '
-                           f'域名: [{domain_index} of {domain_list}], '
-                           f'路径: [{url}]')
-
-                # 记录请求日志
-                jm_log(self.client_key, self._decode_url_for_log(url))
-
-                try:
-                    if get:
-                        # noinspection PyUnresolvedReferences
-                        resp = await self._session.get(url, headers=headers, **kwargs)
-                    else:
-                        # noinspection PyUnresolvedReferences
-                        resp = await self._session.post(url, headers=headers, **kwargs)
-
-                    # 校验 API 响应的有效性并决定是否触发重试
-                    if is_api:
-                        self._raise_if_resp_should_retry(resp)
-
-                    return resp
-                except Exception as e:
-                    self.before_retry(e, url, retry, domain_index)
+            # 记录重试信息
+            if ctx.index != 0 or ctx.retry_count != 0:
+                jm_log('req.retry',
+                       f'次数: [{ctx.retry_count}/{self._retry_times}], '
+                       f'域名: [{ctx.index} of {domain_list}], '
+                       f'路径: [{url}]')
+
+            # 记录请求日志
+            jm_log(self.client_key, self._decode_url_for_log(url))
+
+            begin = time.perf_counter()
+            try:
+                await RateLimiter.async_acquire(url)
+                if get:
+                    # noinspection PyUnresolvedReferences
+                    resp = await self._session.get(url, headers=headers, **kwargs)
+                else:
+                    # noinspection PyUnresolvedReferences
+                    resp = await self._session.post(url, headers=headers, **kwargs)
+                await RateLimiter.async_consume(url, False, len(resp.content))
+
+                # 校验 API 响应的有效性并决定是否触发重试
+                if is_api:
+                    self._raise_if_resp_should_retry(resp)
+
+                await DomainHealthRegistry.async_record_success(domain, time.perf_counter() - begin)
+                return resp
+            except Exception as e:
+                await DomainHealthRegistry.async_record_failure(domain)
+                self.before_retry(e, url, ctx.retry_count, ctx.index)
+                delay = ctx.on_failure(e)
+                if ctx.aborted:
+                    raise e
+                if delay is None:
+                    break
+                if delay > 0:
+                    await asyncio.sleep(delay)
 
         # 所有域名都失败
         msg = f"请求重试全部失败: [{url_path}], {domain_list}"
@@ -314,7 +367,7 @@ class AsyncJmApiClient(AsyncJmcomicClient):
     def _raise_if_resp_should_retry(resp):
         """内部校验 API 响应报文内容，若存在异常格式或无法处理的数据则抛出异常以触发重试"""
         code = resp.status_code
-        if code >= 500:
+        if code >= 500 or code == 429:
             msg = JmModuleConfig.JM_ERROR_STATUS_CODE.get(code, f'HTTP状态码: {code}')
             ExceptionTool.raises_resp(f"禁漫API异常响应, {msg}", resp)
 
@@ -375,6 +428,9 @@ class AsyncJmApiClient(AsyncJmcomicClient):
 
         # 封装为 JmApiResp，复用完整的校验链
         api_resp = JmApiResp(resp, ts)
+        if self._decode_offload_bytes is not None and len(resp.content) >= self._decode_offload_bytes:
+            # 大的响应在线程池中完成json解析和解密，不阻塞正在下载图片的其他协程
+            await asyncio.get_running_loop().run_in_executor(None, api_resp.preload)
         if require_success:
             self._require_resp_success(api_resp)
 
@@ -392,18 +448,26 @@ class AsyncJmApiClient(AsyncJmcomicClient):
         cache_key = ('detail', jmid, clazz)
         cached = self._cache_get(cache_key)
         if cached is not self._SENTINEL:
+            # 实体以不可变快照的形式缓存，每次命中还原出一个新的实体
             # noinspection PyTypeChecker
-            return deepcopy(cached)
+            return cached.materialize() if isinstance(cached, EntitySnapshot) else deepcopy(cached)
 
-        url = self.API_ALBUM if issubclass(clazz, JmAlbumDetail) else self.API_CHAPTER
-        resp = await self.req_api(url, params={'id': jmid})
+        async def fetch():
+            url = self.API_ALBUM if issubclass(clazz, JmAlbumDetail) else self.API_CHAPTER
+            resp = await self.req_api(url, params={'id': jmid})
 
-        if not resp.encoded_data or resp.res_data.get('name') is None:
-            ExceptionTool.raise_missing(resp, jmid)
+            if not resp.encoded_data or resp.res_data.get('name') is None:
+                ExceptionTool.raise_missing(resp, jmid)
 
-        result = JmApiAdaptTool.parse_entity(resp.res_data, clazz)
-        self._cache_set(cache_key, deepcopy(result))
-        return result
+            entity = JmApiAdaptTool.parse_entity(resp.res_data, clazz)
+            snapshot = entity.snapshot()
+            self._cache_set(cache_key, snapshot)
+            return entity, snapshot
+
+        (result, snapshot), shared = await self._single_flight(cache_key, fetch)
+        # 实体会被调用方修改（例如 photo.from_album），共享时每个调用方各自从快照还原一份
+        # noinspection PyTypeChecker
+        return snapshot.materialize() if shared else result
 
     async def get_album_detail(self, album_id) -> JmAlbumDetail:
         """获取图集详情信息"""
@@ -449,14 +513,26 @@ class AsyncJmApiClient(AsyncJmcomicClient):
     # ======================================================================
 
     async def get_scramble_id(self, photo_id, album_id=None) -> str:
-        """获取指定图片的 scramble_id（支持内存级缓存）"""
+        """获取指定图片的 scramble_id（缓存位于 JmModuleConfig.SCRAMBLE_CACHE 和客户端缓存）"""
         cache = JmModuleConfig.SCRAMBLE_CACHE
         if photo_id in cache:
             return cache[photo_id]
         if album_id is not None and album_id in cache:
             return cache[album_id]
 
-        scramble_id = await self.fetch_scramble_id(photo_id)
+        # 开启了客户端缓存时（例如 level_disk），scramble_id 也存一份，进程重启后依然可用
+        scramble_id = self._cache_get(('scramble', photo_id))
+        if scramble_id is self._SENTINEL and album_id is not None:
+            scramble_id = self._cache_get(('scramble', album_id))
+
+        if scramble_id is self._SENTINEL:
+            # 同一本子的章节共用 scramble_id（同上面的缓存逻辑），并发请求时只请求一次
+            scramble_id, _ = await self._single_flight(('scramble', album_id if album_id is not None else photo_id),
+                                                       lambda: self.fetch_scramble_id(photo_id))
+            self._cache_set(('scramble', photo_id), scramble_id)
+            if album_id is not None:
+                self._cache_set(('scramble', album_id), scramble_id)
+
         cache[photo_id] = scramble_id
         if album_id is not None:
             cache[album_id] = scramble_id
@@ -554,16 +630,21 @@ class AsyncJmApiClient(AsyncJmcomicClient):
             'o': order_by,
             't': time,
         }
-        resp = await self.req_api(self.API_SEARCH, params=params)
 
-        data = resp.model_data
-        if data.get('redirect_aid', None) is not None:
-            aid = data.redirect_aid
-            result = JmSearchPage.wrap_single_album(await self.get_album_detail(aid), page)
-        else:
-            result = JmPageTool.parse_api_to_search_page(data, page)
+        async def fetch():
+            resp = await self.req_api(self.API_SEARCH, params=params)
+
+            data = resp.model_data
+            if data.get('redirect_aid', None) is not None:
+                aid = data.redirect_aid
+                page_result = JmSearchPage.wrap_single_album(await self.get_album_detail(aid), page)
+            else:
+                page_result = JmPageTool.parse_api_to_search_page(data, page)
 
-        self._cache_set(cache_key, result)
+            self._cache_set(cache_key, page_result)
+            return page_result
+
+        result, _ = await self._single_flight(cache_key, fetch)
         return result
 
     # search_site / search_work / search_author / search_tag / search_actor
@@ -693,31 +774,124 @@ class AsyncJmApiClient(AsyncJmcomicClient):
     # 图片下载
     # ======================================================================
 
-    async def get_jm_image(self, img_url: str) -> JmImageResp:
+    async def get_jm_image(self, img_url: str, stream=False, stream_to: str | None = None) -> JmImageResp:
         """
         异步下载指定 URL 的图片原始字节数据。
+        每次失败后换到下一个未熔断的图片域名，见 ImageHostCircuitBreaker。
+
+        :param stream: 是否使用流式响应，为 True 时需调用 JmImageResp.astream_to 读取响应体
+        :param stream_to: 流式响应体的保存路径。指定时在每次请求内写盘，
+                          读响应体时连接中断、响应体为空和请求失败一样重试、切换图片域名、计入熔断
         """
+        stream = (stream or stream_to is not None, stream_to)
         await self.setup()
         headers = {**JmModuleConfig.APP_HEADERS_TEMPLATE, **JmModuleConfig.APP_HEADERS_IMAGE}
+        url_list = ImageHostCircuitBreaker.candidate_url_list(img_url)
+        ctx = self.retry_policy.new_context(url_list, self._retry_times, rotate=True)
 
-        last_error = None
-        for retry in range(self._retry_times + 1):
+        while True:
+            img_url = ctx.target
             try:
+                return await self._get_jm_image_hedged(img_url, url_list[(ctx.index + 1) % len(url_list)], headers, stream)
+            except Exception as e:
+                jm_log('req.error',
+                       f'图片下载失败: [{img_url}], Retry=[{ctx.retry_count}/{self._retry_times}], Error=[{e}]')
+                delay = ctx.on_failure(e)
+                if ctx.aborted:
+                    raise e
+                if delay is None:
+                    break
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+        raise ExceptionTool.raises(f'图片下载重试全部失败: {ctx.last_error}', {}, RequestRetryAllFailException)
+
+    async def _get_jm_image_once(self, img_url: str, headers: dict, stream: tuple) -> JmImageResp:
+        """
+        请求一次图片，记录耗时和图片域名熔断状态
+
+        :param stream: (是否流式响应, 流式响应体的保存路径)
+        """
+        stream, stream_to = stream
+        host = ImageHostCircuitBreaker.host_of(img_url)
+        begin = time.perf_counter()
+        try:
+            await RateLimiter.async_acquire(img_url, True)
+            if stream:
+                # noinspection PyUnresolvedReferences
+                resp = await self._session.get(img_url, headers=headers, timeout=self._timeout, stream=True)
+                img_resp = JmImageResp(resp)
+                if img_resp.is_not_success:
+                    await resp.aclose()
+                    img_resp.require_success()
+                if stream_to is not None:
+                    await img_resp.astream_to(stream_to)
+            else:
                 # noinspection PyUnresolvedReferences
                 resp = await self._session.get(img_url, headers=headers, timeout=self._timeout)
+                await RateLimiter.async_consume(img_url, True, len(resp.content))
                 # 对图片资源的数据进行基础有效性校验
                 img_resp = JmImageResp(resp)
                 if resp.status_code != 200 or len(resp.content) == 0:
                     img_resp.require_success()  # 会抛出描述性异常
-                return img_resp
-            except Exception as e:
-                last_error = e
-                jm_log('req.error',
-                       f'图片下载失败: [{img_url}], Retry=[{retry}/{self._retry_times}], Error=[{e}]')
-                if retry < self._retry_times:
-                    await asyncio.sleep(0.3)
+        except Exception:
+            ImageHostCircuitBreaker.record_failure(host)
+            raise
+
+        ImageHostCircuitBreaker.record_success(host)
+        self._image_latency_list.append(time.perf_counter() - begin)
+        return img_resp
 
-        raise ExceptionTool.raises(f'图片下载重试全部失败: {last_error}', {}, RequestRetryAllFailException)
+    def _hedge_delay(self):
+        """
+        返回发出对冲请求前的等待秒数，不满足对冲条件时返回 None
+        """
+        percentile = self._hedge_config.get('percentile', None)
+        latency_list = self._image_latency_list
+        if not percentile or len(latency_list) < (self._hedge_config.get('min_sample', None) or 20):
+            return None
+
+        latency_list = sorted(latency_list)
+        return latency_list[min(len(latency_list) - 1, int(len(latency_list) * percentile))]
+
+    async def _get_jm_image_hedged(self, img_url: str, hedge_url: str, headers: dict, stream: tuple) -> JmImageResp:
+        """
+        对冲请求：img_url 超过 _hedge_delay 仍未完成时，向 hedge_url（下一个图片域名）再发一个请求，
+        谁先成功用谁，另一个取消。对冲请求数受 hedge.budget 限制。
+        """
+        self.image_request_count += 1
+        delay = self._hedge_delay()
+        if delay is None:
+            return await self._get_jm_image_once(img_url, headers, stream)
+
+        primary = asyncio.ensure_future(self._get_jm_image_once(img_url, headers, stream))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        budget = self._hedge_config.get('budget', None) or 0
+        if done or self.image_hedge_count + 1 > budget * self.image_request_count:
+            return await primary
+
+        self.image_hedge_count += 1
+        jm_log('req.hedge', f'图片请求超过 {delay:.2f}s 未完成，对冲请求: [{hedge_url}]')
+        hedge = asyncio.ensure_future(self._get_jm_image_once(hedge_url, headers, stream))
+
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                success_list = [task for task in done if task.exception() is None]
+                if success_list:
+                    # 两个请求同时成功时，关闭多余的（还没有读取的）流式响应
+                    for task in success_list[1:]:
+                        if task.result().is_stream and task.result().stream_size is None:
+                            await task.result().resp.aclose()
+                    return success_list[0].result()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        # 都失败了，抛出原请求的异常
+        return primary.result()
 
     # ======================================================================
     # 域名与状态自动刷新
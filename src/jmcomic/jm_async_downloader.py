@@ -9,34 +9,238 @@
 from __future__ import annotations
 
 import asyncio
-import os
-from concurrent.futures import ThreadPoolExecutor
-
-from .jm_downloader import BaseDownloader, record_download_duration
+import multiprocessing
+import sys
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+from .jm_client_interface import JmImageClient
+from .jm_downloader import BaseDownloader, PhotoPrefetcher, record_download_duration
 from .jm_entity import JmAlbumDetail, JmPhotoDetail, JmImageDetail
 from .jm_toolkit import JmImageTool
 from .jm_config import JmModuleConfig, jm_log
-from .jm_task_context import bind_jm_task_context
+from .jm_task_context import bind_jm_task_context, get_jm_task_context
 from .jm_option import JmOption
 
 
-class JmAsyncDownloader(BaseDownloader):
+def _attach_shared_memory(shm_name: str) -> SharedMemory:
     """
-    全异步流水线下载器。
+    子进程打开父进程创建的共享内存。共享内存由父进程负责 unlink，子进程不能登记到 resource_tracker：
+    Python 3.13 以前打开已有的共享内存也会登记，子进程退出时 resource_tracker 会报泄漏并提前 unlink，
+    而登记后再注销又会删掉父进程自己的登记（spawn 的子进程和父进程共用一个 resource_tracker）
+    """
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=shm_name, track=False)
 
-    核心设计：
-    - 下载 IO 与 CPU 解密（ThreadPoolExecutor）完全流水线化
-    - 通过 asyncio.Semaphore 实现并发控制
-    - 继承 JmDownloader 的回调体系和 Plugin 调用
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+
+    def skip_shared_memory(name, rtype):
+        if rtype != 'shared_memory':
+            register(name, rtype)
+
+    # 子进程中只有当前线程在执行任务，临时替换 register 不会影响其他代码
+    resource_tracker.register = skip_shared_memory
+    try:
+        return SharedMemory(name=shm_name)
+    finally:
+        resource_tracker.register = register
+
+
+def _run_batch_in_process(shm_name: str, task_list: list) -> list:
+    """
+    子进程入口：在提交时的 task context 下执行写盘函数，图片数据是共享内存上的 memoryview，不再拷贝一份。
+
+    :param shm_name: 父进程创建的共享内存名
+    :param task_list: [(offset, size, func, args, context)]
+    :return: 与 task_list 一一对应的 (是否成功, 返回值或异常)
+    """
+    shm = _attach_shared_memory(shm_name)
+    try:
+        result_list = []
+        for offset, size, func, args, context in task_list:
+            with shm.buf[offset:offset + size] as view:
+                try:
+                    result_list.append((True, bind_jm_task_context(func, context)(view, *args)))
+                except Exception as e:
+                    result_list.append((False, e))
+        return result_list
+    finally:
+        shm.close()
+
+
+# 图片写盘函数。定义在模块级，提交到进程池时按名字 pickle，不会带上下载器实例
+
+def _decode_and_save_image(image_bytes, scramble_id, aid, img_file_name, save_path):
+    """
+    解密图片并保存到磁盘（在线程池或进程池中执行）。
+    保存目录已由 decide_image_filepath(ensure_exists=True) 创建，此处不重复 makedirs。
+    """
+    num = JmImageTool.get_num(scramble_id, aid, img_file_name)
+    img_src = JmImageTool.open_image(image_bytes)
+    JmImageTool.decode_and_save(num, img_src, save_path)
+
+
+def _save_raw_image(image_bytes, save_path, need_convert=False):
+    """
+    不解密保存。
+    - need_convert=False：直接写原始字节（如 .gif，或后缀与原图一致时）。
+    - need_convert=True：经 PIL 按 save_path 后缀做格式转换（对齐 sync save_resp_img）。
+    保存目录已由 decide_image_filepath(ensure_exists=True) 创建，此处不重复 makedirs。
+    """
+    if need_convert:
+        JmImageTool.save_image(JmImageTool.open_image(image_bytes), save_path)
+    else:
+        JmImageTool.save_bytes(image_bytes, save_path)
+
+
+class JmProcessDecodePool:
+    """
+    进程池解密后端。
+
+    PIL 的 crop/paste/encode 大部分时间持有 GIL，线程池解密只能用满 2~3 个核。
+    该后端把解密交给 ProcessPoolExecutor：
+    - 图片字节写入一块 multiprocessing.shared_memory 交给子进程，不经过 pickle 拷贝，子进程直接读共享内存上的 memoryview
+    - 子进程用 spawn 方式启动：此时事件循环、curl 和限速等线程都在运行，fork 出的子进程可能拿着这些线程持有的锁而死锁
+    - 同一轮事件循环内提交的图片合并为一批（最多 batch 张）提交给一个子进程，摊薄调度开销
+    - 提交时的 task context 随任务带到子进程，子进程内的 jm_log 可以按 context 关联
+    """
+
+    def __init__(self, max_workers: int | None = None, batch: int = 4):
+        self.max_workers = max_workers
+        self.batch = max(1, int(batch))
+        self._executor: ProcessPoolExecutor | None = None
+        self._pending: list = []
+        self._flush_handle = None
+
+    def submit(self, func, image_bytes: bytes, *args) -> asyncio.Future:
+        """
+        提交一张图片的写盘任务，func 必须可被 pickle（模块级函数或类的 staticmethod）。
+        func 的调用方式为 func(image_bytes, *args)，子进程中 image_bytes 为 memoryview，只在调用期间有效
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((func, image_bytes, args, get_jm_task_context(), future))
+
+        if len(self._pending) >= self.batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_soon(self._flush)
+
+        return future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        pending, self._pending = self._pending, []
+        if len(pending) == 0:
+            return
+
+        shm = None
+        try:
+            shm = SharedMemory(create=True, size=max(1, sum(len(item[1]) for item in pending)))
+            task_list = []
+            offset = 0
+            for func, image_bytes, args, context, _ in pending:
+                size = len(image_bytes)
+                shm.buf[offset:offset + size] = image_bytes
+                task_list.append((offset, size, func, args, context))
+                offset += size
+
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            batch_future = asyncio.wrap_future(self._executor.submit(_run_batch_in_process, shm.name, task_list))
+        except Exception as e:
+            self._release(shm)
+            self._set_batch_exception(pending, e)
+            return
+
+        batch_future.add_done_callback(lambda f: self._on_batch_done(f, shm, pending))
+
+    def _on_batch_done(self, batch_future: asyncio.Future, shm: SharedMemory, pending: list):
+        self._release(shm)
+
+        if batch_future.cancelled():
+            self._set_batch_exception(pending, asyncio.CancelledError())
+            return
+
+        e = batch_future.exception()
+        if e is not None:
+            self._set_batch_exception(pending, e)
+            return
+
+        for (*_, future), (success, value) in zip(pending, batch_future.result()):
+            if future.done():
+                continue
+            if success:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    @staticmethod
+    def _set_batch_exception(pending: list, e: BaseException):
+        for *_, future in pending:
+            if not future.done():
+                future.set_exception(e)
+
+    @staticmethod
+    def _release(shm: SharedMemory | None):
+        if shm is None:
+            return
+        shm.close()
+        shm.unlink()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class AsyncPhotoPrefetcher(PhotoPrefetcher):
+    """
+    异步版本的章节元数据预取，预取以 asyncio.Task 的形式并行执行，不占用 _photo_semaphore。
+    """
+
+    async def resolve(self, photo: JmPhotoDetail):
+        task, _, _ = self.take(photo, lambda p: asyncio.ensure_future(self.check_photo(p)))
+        return await task
+
+    def close(self):
+        for task in list(self.task_dict.values()):
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                # 该章节没有等待预取结果时，取出异常，避免 asyncio 告警
+                task.exception()
+
+
+class JmAsyncDownloadEngine:
+    """
+    异步下载引擎，持有下载需要的共享资源：
+    - 一个 async client（一个 AsyncSession，只做一次 setup 和 cookie 握手）
+    - 解密线程池，以及 decode_backend=process 时的解密进程池
+    - 图片 / 章节的并发限制，以及同时下载的本子数限制 album_slot
+
+    单独下载时每个 JmAsyncDownloader 独占一个引擎。
+    download_batch_async 中所有本子共用一个引擎，连接池、线程池只创建一次，
+    图片 / 章节 / 本子的并发数是整批的全局上限；每个本子仍使用自己的下载器，下载结果、失败记录、DownloadManifest 互相独立。
     """
 
     def __init__(self,
                  option: JmOption,
                  image_concurrency: int | None = None,
                  photo_concurrency: int | None = None,
+                 album_concurrency: int | None = None,
                  decode_worker: int | None = None,
+                 decode_backend: str | None = None,
                  ) -> None:
-        super().__init__(option)
+        self.option = option
+        self.client = None
+
         # 提取图片并发配置（使用 is None 判断，避免 0 被 or 静默替换为默认值）
         image_concurrency = int(image_concurrency if image_concurrency is not None else option.download.threading.image)
         if image_concurrency <= 0:
@@ -46,12 +250,130 @@ class JmAsyncDownloader(BaseDownloader):
         if photo_concurrency <= 0:
             raise ValueError(f"photo_concurrency must be > 0, got {photo_concurrency}")
 
-        self._image_concurrency = image_concurrency
-        self._image_semaphore = asyncio.Semaphore(image_concurrency)
-        self._photo_semaphore = asyncio.Semaphore(photo_concurrency)
+        if album_concurrency is None:
+            album_concurrency = BaseDownloader._threading_config(option, 'album', None)
+        if album_concurrency is not None and int(album_concurrency) <= 0:
+            raise ValueError(f"album_concurrency must be > 0, got {album_concurrency}")
+
+        self.image_concurrency = image_concurrency
+        self.image_semaphore = asyncio.Semaphore(image_concurrency)
+        # 开启 download.threading.adaptive 时由自适应限制器代替 image_semaphore
+        self.image_limiter = BaseDownloader.new_image_limiter(option, image_concurrency)
+        self.photo_semaphore = asyncio.Semaphore(photo_concurrency)
+        self.album_semaphore = asyncio.Semaphore(int(album_concurrency)) if album_concurrency is not None else None
+
+        # 解密线程池（CPU 密集操作卸载），大小和进程池一样由 decode_worker / download.decode_worker 决定
+        if decode_worker is None:
+            decode_worker = BaseDownloader._download_config(option, 'decode_worker', None)
+        self.decode_pool = ThreadPoolExecutor(max_workers=decode_worker, thread_name_prefix='jm-async-decode')
+
+        # 解密进程池，回调和插件仍在线程池中执行
+        decode_backend = decode_backend or BaseDownloader._download_config(option, 'decode_backend', 'thread')
+        if decode_backend not in ('thread', 'process'):
+            raise ValueError(f"decode_backend must be 'thread' or 'process', got {decode_backend}")
+
+        self.process_decode_pool: JmProcessDecodePool | None = None
+        if decode_backend == 'process':
+            self.process_decode_pool = JmProcessDecodePool(
+                max_workers=decode_worker,
+                batch=BaseDownloader._download_config(option, 'decode_batch', 4),
+            )
+
+    @asynccontextmanager
+    async def album_slot(self):
+        """限制同时下载的本子数（download.threading.album），未配置时不限制"""
+        if self.album_semaphore is None:
+            yield
+            return
+
+        async with self.album_semaphore:
+            yield
 
-        # 解密线程池（CPU 密集操作卸载）
-        self._decode_pool = ThreadPoolExecutor(max_workers=decode_worker, thread_name_prefix='jm-async-decode')
+    def shutdown(self):
+        """关闭解密线程池和进程池"""
+        self.decode_pool.shutdown(wait=False)
+        if self.process_decode_pool is not None:
+            self.process_decode_pool.shutdown()
+
+    async def __aenter__(self):
+        # 创建并独占一个 async client（含 AsyncSession）。
+        self.client = self.option.new_jm_async_client(max_clients=self.image_concurrency)
+        try:
+            await self.client.setup()
+        except BaseException:
+            try:
+                await self.client.close()
+            except BaseException as cleanup_error:
+                jm_log('dler.cleanup.exception',
+                       f'初始化失败后的资源清理也发生异常: {cleanup_error}', cleanup_error)
+            finally:
+                self.client = None
+                self.shutdown()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        # 关闭顺序：先关网络 client（释放 AsyncSession / libcurl multi handle / 后台任务），
+        # 再关解密线程池。两者都要在异常路径下保证释放。
+        try:
+            if self.client is not None:
+                await self.client.close()
+        finally:
+            self.client = None
+            self.shutdown()
+
+
+class JmAsyncDownloader(BaseDownloader):
+    """
+    全异步流水线下载器。
+
+    核心设计：
+    - 下载 IO 与 CPU 解密（ThreadPoolExecutor）完全流水线化
+    - 通过 asyncio.Semaphore 实现并发控制
+    - 继承 JmDownloader 的回调体系和 Plugin 调用
+    - 配置 download.decode_backend=process 时，解密改由 JmProcessDecodePool 在子进程中执行
+    - client、解密池、并发限制来自 JmAsyncDownloadEngine，传入 engine 时借用共享的引擎（见 download_batch_async）
+    """
+
+    _process_decode_pool: JmProcessDecodePool | None = None
+    # 是否独占引擎，独占时由下载器负责打开和关闭引擎
+    _own_engine = True
+
+    def __init__(self,
+                 option: JmOption,
+                 image_concurrency: int | None = None,
+                 photo_concurrency: int | None = None,
+                 decode_worker: int | None = None,
+                 decode_backend: str | None = None,
+                 engine: JmAsyncDownloadEngine | None = None,
+                 ) -> None:
+        super().__init__(option)
+        self._own_engine = engine is None
+        if engine is None:
+            engine = self.create_engine(
+                option,
+                image_concurrency=image_concurrency,
+                photo_concurrency=photo_concurrency,
+                decode_worker=decode_worker,
+                decode_backend=decode_backend,
+            )
+
+        self.engine = engine
+        self._image_concurrency = engine.image_concurrency
+        self._image_semaphore = engine.image_semaphore
+        self.image_limiter = engine.image_limiter
+        self._photo_semaphore = engine.photo_semaphore
+        self._decode_pool = engine.decode_pool
+        self._process_decode_pool = engine.process_decode_pool
+
+    @classmethod
+    def create_engine(cls, option: JmOption, **kwargs) -> JmAsyncDownloadEngine:
+        return JmAsyncDownloadEngine(option, **kwargs)
+
+    def _image_slot(self):
+        if self.image_limiter is not None:
+            return self.image_limiter.async_slot()
+        return self._image_semaphore
 
     @classmethod
     def use(cls, *args, **kwargs):
@@ -77,6 +399,16 @@ class JmAsyncDownloader(BaseDownloader):
             *args,
         )
 
+    async def _run_image_write(self, func, image_bytes, *args, cpu_bound=True):
+        """
+        执行图片写盘函数 func(image_bytes, *args)。
+        CPU 密集的写盘（解密、格式转换）在配置了进程池时交给进程池，其余在线程池执行。
+        """
+        if cpu_bound and self._process_decode_pool is not None:
+            return await self._process_decode_pool.submit(func, image_bytes, *args)
+
+        return await self._run_in_decode_pool(func, image_bytes, *args)
+
     @record_download_duration('album_started_at')
     async def download_album(self, album_id) -> JmAlbumDetail:
         """对齐 sync JmDownloader.download_album"""
@@ -105,8 +437,13 @@ class JmAsyncDownloader(BaseDownloader):
         # 在 count_real==0 时提前返回，但调用方仍会走到 after_album，触发其插件与 Feature）。
         if photos:
             # photo 级并发由 _photo_semaphore 控制（默认 3），包裹整段 photo 下载（见 download_by_photo_detail）。
-            photo_tasks = [self._safe_download_photo(photo) for photo in photos]
-            await asyncio.gather(*photo_tasks)
+            # 章节在下载图片的同时，预取之后章节的元数据
+            prefetcher = self.begin_prefetch(photos)
+            try:
+                photo_tasks = [self._safe_download_photo(photo) for photo in photos]
+                await asyncio.gather(*photo_tasks)
+            finally:
+                self.end_prefetch(prefetcher)
 
         await self.after_album(album)
 
@@ -140,7 +477,7 @@ class JmAsyncDownloader(BaseDownloader):
         # 真正限制「同时下载的章节数」（对齐 sync：每个 photo 占用 photo 线程池一个槽位）。
         # 章节内图片再由共享的 _image_semaphore 二级限流。
         async with self._photo_semaphore:
-            await self.client.check_photo(photo)
+            await self.check_photo(photo)
 
             await self.before_photo(photo)
             if photo.skip:
@@ -160,6 +497,16 @@ class JmAsyncDownloader(BaseDownloader):
 
             await self.after_photo(photo)
 
+    async def check_photo(self, photo: JmPhotoDetail):
+        """对齐 sync JmDownloader.check_photo"""
+        prefetcher = self._prefetcher_dict.get(photo)
+        if prefetcher is None:
+            return await self.client.check_photo(photo)
+        return await prefetcher.resolve(photo)
+
+    def create_prefetcher(self, photo_list, depth):
+        return AsyncPhotoPrefetcher(photo_list, depth, self.client.check_photo)
+
     async def _safe_download_image(self, image: JmImageDetail):
         """
         包装 _download_single_image，对齐 sync @catch_exception 的异常记录。
@@ -179,7 +526,7 @@ class JmAsyncDownloader(BaseDownloader):
         """
         img_save_path = self.option.decide_image_filepath(image)
         image.save_path = img_save_path
-        image.exists = os.path.exists(img_save_path)
+        image.exists = self.check_image_exists(image, img_save_path)
         image.cache = self.option.decide_download_cache(image)
 
         await self.before_image(image, img_save_path)
@@ -190,39 +537,45 @@ class JmAsyncDownloader(BaseDownloader):
             await self.after_image(image, img_save_path)
             return
 
-        decode_image = self.option.decide_download_image_decode(image)
+        decode_image = self.decide_image_decode(image, img_save_path)
 
         # 异步下载图片（受 image semaphore 限流，并将解密写盘过程也锁入信号量范围内，防大字节积压）
-        async with self._image_semaphore:
-            img_resp = await self.client.get_jm_image(image.download_url)
-            img_bytes = img_resp.content
-
-            # 提交到线程池解密并保存
-            if decode_image and image.scramble_id:
-                await self._run_in_decode_pool(
-                    self._decode_and_save,
-                    img_bytes,
-                    int(image.scramble_id),
-                    int(image.aid),
-                    image.img_file_name,
-                    img_save_path,
-                )
+        async with self._image_slot():
+            if image.passthrough and JmImageClient.support_stream_to(self.client.get_jm_image):
+                # 无需解密和格式转换：流式下载，分块写入临时文件后原子重命名，图片字节不在内存中缓冲。
+                # 写盘在请求的重试范围内，读响应体失败也会重试、切换图片域名
+                await self.client.get_jm_image(image.download_url, stream=True, stream_to=img_save_path)
             else:
-                # 不解密保存。对齐 sync transfer_to(decode_image=False)：
-                # 当目标后缀与原图后缀不一致时，需经 PIL 做格式转换。
-                # 与 sync 一致：比较后缀前先剥离 url 的 ?query 部分，避免 query 干扰后缀判定。
-                from common import suffix_not_equal
-                img_url = image.download_url
-                qi = img_url.find('?')
-                if qi != -1:
-                    img_url = img_url[:qi]
-                need_convert = suffix_not_equal(img_url, img_save_path)
-                await self._run_in_decode_pool(
-                    self._save_raw,
-                    img_bytes,
-                    img_save_path,
-                    need_convert,
-                )
+                img_resp = await self.client.get_jm_image(image.download_url)
+                img_bytes = img_resp.content
+
+                # 提交到线程池解密并保存
+                if decode_image and image.scramble_id:
+                    await self._run_image_write(
+                        _decode_and_save_image,
+                        img_bytes,
+                        int(image.scramble_id),
+                        int(image.aid),
+                        image.img_file_name,
+                        img_save_path,
+                    )
+                else:
+                    # 不解密保存。对齐 sync transfer_to(decode_image=False)：
+                    # 当目标后缀与原图后缀不一致时，需经 PIL 做格式转换。
+                    # 与 sync 一致：比较后缀前先剥离 url 的 ?query 部分，避免 query 干扰后缀判定。
+                    from common import suffix_not_equal
+                    img_url = image.download_url
+                    qi = img_url.find('?')
+                    if qi != -1:
+                        img_url = img_url[:qi]
+                    need_convert = suffix_not_equal(img_url, img_save_path)
+                    await self._run_image_write(
+                        _save_raw_image,
+                        img_bytes,
+                        img_save_path,
+                        need_convert,
+                        cpu_bound=need_convert,
+                    )
 
         await self.after_image(image, img_save_path)
 
@@ -230,30 +583,9 @@ class JmAsyncDownloader(BaseDownloader):
     # 磁盘写入（在线程池中执行）
     # ======================================================================
 
-    @staticmethod
-    def _decode_and_save(image_bytes, scramble_id, aid, img_file_name, save_path):
-        """
-        解密图片并保存到磁盘（在线程池中执行）。
-        与 Sync 版对齐的直接写文件方式。
-        保存目录已由 decide_image_filepath(ensure_exists=True) 创建，此处不重复 makedirs。
-        """
-        num = JmImageTool.get_num(scramble_id, aid, img_file_name)
-        img_src = JmImageTool.open_image(image_bytes)
-        JmImageTool.decode_and_save(num, img_src, save_path)
-
-    @staticmethod
-    def _save_raw(image_bytes, save_path, need_convert=False):
-        """
-        不解密保存。
-        - need_convert=False：直接写原始字节（如 .gif，或后缀与原图一致时）。
-        - need_convert=True：经 PIL 按 save_path 后缀做格式转换（对齐 sync save_resp_img）。
-        保存目录已由 decide_image_filepath(ensure_exists=True) 创建，此处不重复 makedirs。
-        """
-        if need_convert:
-            JmImageTool.save_image(JmImageTool.open_image(image_bytes), save_path)
-        else:
-            with open(save_path, 'wb') as f:
-                f.write(image_bytes)
+    # 保留旧名字，写盘函数见模块级的 _decode_and_save_image / _save_raw_image
+    _decode_and_save = staticmethod(_decode_and_save_image)
+    _save_raw = staticmethod(_save_raw_image)
 
     # ======================================================================
     # 生命周期
@@ -278,35 +610,30 @@ class JmAsyncDownloader(BaseDownloader):
         await self._run_in_decode_pool(super().after_image, image, img_save_path)
 
     def shutdown(self):
-        """关闭解密线程池"""
+        """关闭解密线程池和进程池，共享引擎的资源由引擎自己关闭"""
+        if not self._own_engine:
+            return
         self._decode_pool.shutdown(wait=False)
+        if self._process_decode_pool is not None:
+            self._process_decode_pool.shutdown()
 
     async def __aenter__(self):
-        # 创建并独占一个 async client（含 AsyncSession）。
-        self.client = self.option.new_jm_async_client(max_clients=self._image_concurrency)
-        try:
-            await self.client.setup()
-        except BaseException:
+        # 独占引擎时由下载器打开引擎，打开失败时引擎自行释放已创建的资源。
+        if self._own_engine:
             try:
-                await self.client.close()
-            except BaseException as cleanup_error:
-                jm_log('dler.cleanup.exception',
-                       f'初始化失败后的资源清理也发生异常: {cleanup_error}', cleanup_error)
-            finally:
+                await self.engine.__aenter__()
+            except BaseException:
                 self.client = None
-                self.shutdown()
-            raise
+                raise
+        self.client = self.engine.client
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        # 关闭顺序：先关网络 client（释放 AsyncSession / libcurl multi handle / 后台任务），
-        # 再关解密线程池。两者都要在异常路径下保证释放。
         try:
-            if self.client is not None:
-                await self.client.close()
+            if self._own_engine:
+                await self.engine.__aexit__(exc_type, exc_val, exc_tb)
         finally:
             self.client = None
-            self.shutdown()
 
         if exc_type is not None:
             jm_log('dler.exception',
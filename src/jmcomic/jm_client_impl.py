@@ -1,3 +1,4 @@
+import time
 from copy import deepcopy
 from threading import Lock
 
@@ -13,6 +14,8 @@ class AbstractJmClient(
 ):
     client_key = '__just_for_placeholder_do_not_use_me__'
     func_to_cache = []
+    # 重试策略，JmOption.new_jm_client 会按 client.retry 配置替换
+    retry_policy = RetryPolicy()
 
     def __init__(self,
                  postman: Postman,
@@ -50,8 +53,13 @@ class AbstractJmClient(
     def of_api_url(self, api_path, domain):
         return JmcomicText.format_url(api_path, domain)
 
-    def get_jm_image(self, img_url) -> JmImageResp:
-        return self.get(img_url, is_image=True, headers=JmModuleConfig.new_html_headers())
+    def get_jm_image(self, img_url, stream=False, stream_to=None) -> JmImageResp:
+        return self.get(img_url,
+                        is_image=True,
+                        headers=JmModuleConfig.new_html_headers(),
+                        stream=(stream or stream_to is not None) or None,
+                        stream_to=stream_to,
+                        )
 
     def request_with_retry(self,
                            request,
@@ -62,19 +70,21 @@ class AbstractJmClient(
                            **kwargs,
                            ):
         """
-        支持重试和切换域名的机制
+        支持重试和切换域名的机制，重试的等待时间、是否换域名由 self.retry_policy 决定
 
-        如果url包含了指定域名，则不会切换域名，例如图片URL。
+        如果url包含了指定域名，则不会切换域名，图片URL见 request_image_with_failover。
 
         如果需要拿到域名进行回调处理，可以重写 self.update_request_with_specify_domain 方法，例如更新headers
 
         :param request: 请求方法
         :param url: 图片url / path (/album/xxx)
-        :param domain_index: 域名下标
-        :param retry_count: 重试次数
+        :param domain_index: 从第几个域名开始（域名顺序由 DomainHealthRegistry 按健康度排序）
+        :param retry_count: 已重试次数
         :param is_image: 是否是图片请求
         :param kwargs: 请求方法的kwargs
         """
+        request = self.shape_request(request, is_image)
+
         if self.domain_retry_strategy:
             return self.domain_retry_strategy(self,
                                               request,
@@ -83,48 +93,124 @@ class AbstractJmClient(
                                               **kwargs,
                                               )
 
-        if domain_index >= len(self.domain_list):
+        if is_image and not url.startswith('/'):
+            return self.request_image_with_failover(request, url, **kwargs)
+
+        domain_list = DomainHealthRegistry.rank(self.domain_list)
+        if domain_index >= len(domain_list):
             return self.fallback(request, url, domain_index, retry_count, is_image, **kwargs)
 
-        url_backup = url
+        ctx = self.retry_policy.new_context(domain_list, self.retry_times)
+        ctx.index, ctx.retry_count = domain_index, retry_count
+
+        while True:
+            req_url = url
+            domain = None
+
+            if url.startswith('/'):
+                # path → url
+                domain = ctx.target
+                req_url = self.of_api_url(url, domain)
+
+                self.update_request_with_specify_domain(kwargs, domain, is_image)
+
+                jm_log(self.log_topic(), self.decode(req_url))
+
+            if ctx.index != 0 or ctx.retry_count != 0:
+                jm_log(f'req.retry',
+                       ', '.join([
+                           f'次数: [{ctx.retry_count}/{self.retry_times}]',
+                           f'域名: [{ctx.index} of {domain_list}]',
+                           f'路径: [{req_url}]',
+                           f'参数: [{kwargs if "login" not in req_url else "#login_form#"}]'
+                       ])
+                       )
+
+            begin = time.perf_counter()
+            try:
+                resp = request(req_url, **kwargs)
+                # 在最后返回之前，还可以判断resp是否重试
+                resp = self.raise_if_resp_should_retry(resp, is_image)
+                if domain is not None:
+                    DomainHealthRegistry.record_success(domain, time.perf_counter() - begin)
+                return resp
+            except Exception as e:
+                if domain is not None:
+                    DomainHealthRegistry.record_failure(domain)
+
+                if self.retry_times == 0:
+                    raise e
 
-        if url.startswith('/'):
-            # path → url
-            domain = self.domain_list[domain_index]
-            url = self.of_api_url(url, domain)
+                self.before_retry(e, kwargs, ctx.retry_count, req_url)
+                delay = ctx.on_failure(e)
+                if ctx.aborted:
+                    raise e
+                if delay is None:
+                    break
+                if delay > 0:
+                    time.sleep(delay)
 
-            self.update_request_with_specify_domain(kwargs, domain, is_image)
+        return self.fallback(request, url, ctx.index, ctx.retry_count, is_image, **kwargs)
 
-            jm_log(self.log_topic(), self.decode(url))
-        elif is_image:
-            # 图片url
-            self.update_request_with_specify_domain(kwargs, None, is_image)
+    def request_image_with_failover(self, request, img_url, **kwargs):
+        """
+        图片请求的重试机制：每次失败后换到下一个未熔断的图片域名，见 ImageHostCircuitBreaker
+        """
+        ctx = self.retry_policy.new_context(ImageHostCircuitBreaker.candidate_url_list(img_url),
+                                            self.retry_times,
+                                            rotate=True)
+        self.update_request_with_specify_domain(kwargs, None, True)
+
+        while True:
+            url = ctx.target
+            host = ImageHostCircuitBreaker.host_of(url)
+            if ctx.retry_count != 0:
+                jm_log('req.retry', f'次数: [{ctx.retry_count}/{self.retry_times}], 图片: [{url}]')
+
+            try:
+                resp = request(url, **kwargs)
+                resp = self.raise_if_resp_should_retry(resp, True)
+                ImageHostCircuitBreaker.record_success(host)
+                return resp
+            except Exception as e:
+                ImageHostCircuitBreaker.record_failure(host)
+                if self.retry_times == 0:
+                    raise e
+
+                self.before_retry(e, kwargs, ctx.retry_count, url)
+                delay = ctx.on_failure(e)
+                if ctx.aborted:
+                    raise e
+                if delay is None:
+                    break
+                if delay > 0:
+                    time.sleep(delay)
+
+        return self.fallback(request, img_url, 0, ctx.retry_count, True, **kwargs)
+
+    @staticmethod
+    def shape_request(request, is_image):
+        """
+        包装请求方法，每次请求（包括重试）都受 RateLimiter 的速率和带宽限制。
 
-        if domain_index != 0 or retry_count != 0:
-            jm_log(f'req.retry',
-                   ', '.join([
-                       f'次数: [{retry_count}/{self.retry_times}]',
-                       f'域名: [{domain_index} of {self.domain_list}]',
-                       f'路径: [{url}]',
-                       f'参数: [{kwargs if "login" not in url else "#login_form#"}]'
-                   ])
-                   )
+        kwargs 中有 stream_to 时，流式响应体在这里写入该路径：写盘属于这次请求，
+        读响应体时连接中断、响应体为空，和请求失败一样重试、切换图片域名、计入熔断。
+        """
 
-        try:
+        def shaped_request(url, **kwargs):
+            stream_to = kwargs.pop('stream_to', None)
+            RateLimiter.acquire(url, is_image)
             resp = request(url, **kwargs)
-            # 在最后返回之前，还可以判断resp是否重试
-            resp = self.raise_if_resp_should_retry(resp, is_image)
+            if stream_to is not None:
+                resp = JmImageResp(resp)
+                resp.require_success()
+                resp.stream_to(stream_to)
+            elif not kwargs.get('stream', None):
+                # 流式响应体在 JmImageResp.stream_to 中按分块计入
+                RateLimiter.consume(url, is_image, len(resp.content))
             return resp
-        except Exception as e:
-            if self.retry_times == 0:
-                raise e
 
-            self.before_retry(e, kwargs, retry_count, url)
-
-        if retry_count < self.retry_times:
-            return self.request_with_retry(request, url_backup, domain_index, retry_count + 1, is_image, **kwargs)
-        else:
-            return self.request_with_retry(request, url_backup, domain_index + 1, 0, is_image, **kwargs)
+        return shaped_request
 
     # noinspection PyMethodMayBeStatic
     def raise_if_resp_should_retry(self, resp, is_image):
@@ -132,7 +218,8 @@ class AbstractJmClient(
         依然是回调，在最后返回之前，还可以判断resp是否重试
         """
         if is_image is True:
-            resp = JmImageResp(resp)
+            if not isinstance(resp, JmImageResp):
+                resp = JmImageResp(resp)
             resp.require_success()
 
         return resp
@@ -152,23 +239,13 @@ class AbstractJmClient(
         jm_log('req.error', str(e))
 
     def enable_cache(self):
-        # noinspection PyDefaultArgument,PyShadowingBuiltins
-        def make_key(args, kwds, typed,
-                     kwd_mark=(object(),),
-                     fasttypes={int, str},
-                     tuple=tuple, type=type, len=len):
-            key = args
+        def make_key(func_name, args, kwds):
+            # key 以方法名开头，不同方法的缓存互不冲突；
+            # 不使用 hash，因为字符串的 hash 每个进程不同，磁盘缓存（DiskCache）需要跨进程稳定的 key
+            key = (func_name,) + args
             if kwds:
-                key += kwd_mark
-                for item in kwds.items():
-                    key += item
-            if typed:
-                key += tuple(type(v) for v in args)
-                if kwds:
-                    key += tuple(type(v) for v in kwds.values())
-            elif len(key) == 1 and type(key[0]) in fasttypes:
-                return key[0]
-            return hash(key)
+                key += ('kwargs',) + tuple(kwds.items())
+            return key
 
         def wrap_func_with_cache(func_name, cache_field_name):
             if hasattr(self, cache_field_name):
@@ -183,15 +260,18 @@ class AbstractJmClient(
                 if cache is None:
                     return func(*args, **kwargs)
 
-                key = make_key(args, kwargs, False)
+                key = make_key(func_name, args, kwargs)
                 sentinel = object()  # unique object used to signal cache misses
 
                 result = cache.get(key, sentinel)
                 if result is not sentinel:
+                    # 实体以不可变快照的形式缓存，每次命中还原出一个新的实体
+                    if isinstance(result, EntitySnapshot):
+                        return result.materialize()
                     return deepcopy(result) if isinstance(result, DetailEntity) else result
 
                 result = func(*args, **kwargs)
-                cache[key] = deepcopy(result) if isinstance(result, DetailEntity) else result
+                cache[key] = result.snapshot() if isinstance(result, DetailEntity) else result
                 return result
 
             setattr(self, func_name, cache_wrapper)
@@ -737,7 +817,7 @@ class JmApiClient(AbstractJmClient):
 
     def get_scramble_id(self, photo_id, album_id=None):
         """
-        带有缓存的fetch_scramble_id，缓存位于 JmModuleConfig.SCRAMBLE_CACHE
+        带有缓存的fetch_scramble_id，缓存位于 JmModuleConfig.SCRAMBLE_CACHE 和客户端缓存
         """
         cache = JmModuleConfig.SCRAMBLE_CACHE
         if photo_id in cache:
@@ -746,7 +826,20 @@ class JmApiClient(AbstractJmClient):
         if album_id is not None and album_id in cache:
             return cache[album_id]
 
-        scramble_id = self.fetch_scramble_id(photo_id)
+        # 开启了客户端缓存时（例如 level_disk），scramble_id 也存一份，进程重启后依然可用
+        client_cache = self.get_cache_dict()
+        if client_cache is None:
+            client_cache = {}
+        scramble_id = client_cache.get(('scramble', photo_id), None)
+        if scramble_id is None and album_id is not None:
+            scramble_id = client_cache.get(('scramble', album_id), None)
+
+        if scramble_id is None:
+            scramble_id = self.fetch_scramble_id(photo_id)
+            client_cache[('scramble', photo_id)] = scramble_id
+            if album_id is not None:
+                client_cache[('scramble', album_id)] = scramble_id
+
         cache[photo_id] = scramble_id
         if album_id is not None:
             cache[album_id] = scramble_id
@@ -1047,7 +1140,7 @@ class JmApiClient(AbstractJmClient):
             return resp
 
         code = resp.status_code
-        if code >= 500:
+        if code >= 500 or code == 429:
             msg = JmModuleConfig.JM_ERROR_STATUS_CODE.get(code, f'HTTP状态码: {code}')
             ExceptionTool.raises_resp(f"禁漫API异常响应, {msg}", resp)
 
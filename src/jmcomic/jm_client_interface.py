@@ -1,3 +1,8 @@
+import asyncio
+import random
+import threading
+import time
+
 from .jm_toolkit import *
 
 """
@@ -46,12 +51,100 @@ class JmResp:
 
 
 class JmImageResp(JmResp):
+    """
+    图片响应。
+
+    支持流式响应（请求时 stream=True）：响应体不会缓冲在内存中，
+    由 stream_to / astream_to 分块写入临时文件，成功后原子重命名到目标路径，每个分块都计入 RateLimiter 的带宽限制。
+    流式响应在读取响应体之前只校验http状态码，读完后再校验响应体非空。
+    """
+
+    def __init__(self, resp):
+        super().__init__(resp)
+        self._stream_content = None
+        self.stream_size: Optional[int] = None  # 流式写盘的字节数，None 表示响应体尚未读取
+
+    @property
+    def is_stream(self) -> bool:
+        return getattr(self.resp, 'stream_task', None) is not None \
+            or getattr(self.resp, 'astream_task', None) is not None
+
+    @property
+    def is_success(self) -> bool:
+        if self.is_stream and self._stream_content is None:
+            return self.http_code == 200 and self.stream_size != 0
+
+        return super().is_success
+
+    def require_success(self):
+        if self.is_not_success and getattr(self.resp, 'stream_task', None) is not None and self.stream_size is None:
+            # 校验失败时还没有读取响应体，关闭流式响应释放连接（异步流式响应由调用方 aclose）
+            self.resp.close()
+        super().require_success()
+
+    @property
+    def content(self):
+        if not self.is_stream:
+            return self.resp.content
+
+        # 流式响应需要完整内容时（例如要解密），一次性读出
+        if self._stream_content is None:
+            ExceptionTool.require_true(self.stream_size is None, f'流式响应体已被读取: {self.url}')
+            try:
+                self._stream_content = b''.join(self.resp.iter_content())
+            finally:
+                self.resp.close()
+        return self._stream_content
+
+    def stream_to(self, path, chunk_size=None) -> int:
+        """
+        把流式响应体分块写到 path，返回写入的字节数
+        """
+        try:
+            with JmImageTool.open_atomic(path) as f:
+                self.stream_size = uncharged = 0
+                for chunk in self.resp.iter_content(chunk_size):
+                    f.write(chunk)
+                    self.stream_size += len(chunk)
+                    uncharged += len(chunk)
+                    if uncharged >= RateLimiter.STREAM_CHARGE_BYTES:
+                        RateLimiter.consume(self.url, True, uncharged)
+                        uncharged = 0
+                if uncharged != 0:
+                    RateLimiter.consume(self.url, True, uncharged)
+                self.require_success()
+        finally:
+            self.resp.close()
+
+        return self.stream_size
+
+    async def astream_to(self, path, chunk_size=None) -> int:
+        """
+        stream_to 的异步版本，用于 AsyncSession 的流式响应
+        """
+        try:
+            with JmImageTool.open_atomic(path) as f:
+                self.stream_size = uncharged = 0
+                async for chunk in self.resp.aiter_content(chunk_size):
+                    f.write(chunk)
+                    self.stream_size += len(chunk)
+                    uncharged += len(chunk)
+                    if uncharged >= RateLimiter.STREAM_CHARGE_BYTES:
+                        await RateLimiter.async_consume(self.url, True, uncharged)
+                        uncharged = 0
+                if uncharged != 0:
+                    await RateLimiter.async_consume(self.url, True, uncharged)
+                self.require_success()
+        finally:
+            await self.resp.aclose()
+
+        return self.stream_size
 
     def error_msg(self):
         msg = f'禁漫图片获取失败: [{self.url}]'
         if self.http_code != 200:
             msg += f'，http状态码={self.http_code}'
-        if len(self.content) == 0:
+        if (self.stream_size if self.is_stream and self._stream_content is None else len(self.content)) == 0:
             msg += f'，响应数据为空'
         return msg
 
@@ -66,17 +159,30 @@ class JmImageResp(JmResp):
         if index != -1:
             img_url = img_url[0:index]
 
-        if decode_image is False or scramble_id is None:
-            # 不解密图片，直接保存文件
+        num = 0
+        if decode_image is not False and scramble_id is not None:
+            num = JmImageTool.get_num_by_url(scramble_id, img_url)
+
+        if num == 0:
+            # 不解密图片，或者图片本身没有被切割（分割数为0），直接保存文件
+            need_convert = suffix_not_equal(img_url, path)
+            if self.is_stream and self.stream_size is not None and not need_convert:
+                # 流式响应体已在请求时写入 path（get_jm_image 的 stream_to）
+                return
+            if not need_convert and self.is_stream and self._stream_content is None:
+                # 流式响应，分块写盘
+                self.stream_to(path)
+                return
+
             JmImageTool.save_resp_img(
                 self,
                 path,
-                need_convert=suffix_not_equal(img_url, path),
+                need_convert=need_convert,
             )
         else:
             # 解密图片并保存文件
             JmImageTool.decode_and_save(
-                JmImageTool.get_num_by_url(scramble_id, img_url),
+                num,
                 JmImageTool.open_image(self.content),
                 path,
             )
@@ -128,18 +234,32 @@ class JmApiResp(JmJsonResp):
             ExceptionTool.raises_resp(f'data返回值异常: {self.text}', self)
 
     @property
+    @field_cache()
     def res_data(self) -> Any:
         self.require_success()
         self.require_have_data()
-        from json import loads
-        return loads(self.decoded_data)
+        return JmcomicText.json_loads(self.decoded_data)
 
     @property
+    @field_cache()
     def model_data(self) -> AdvancedDict:
+        # AdvancedDict 在访问时才包装嵌套的值，这里不会遍历整个返回值
         self.require_success()
         self.require_have_data()
         return AdvancedDict(self.res_data)
 
+    def preload(self):
+        """
+        提前完成json解析和解密，结果缓存在对象上。
+        异步客户端在线程池中调用，避免大的响应（收藏夹、搜索等）在事件循环线程中解码。
+        解码失败时不抛异常，之后访问 res_data 等属性时会正常抛出。
+        """
+        try:
+            if self.is_success and self.encoded_data:
+                _ = self.res_data
+        except Exception:
+            pass
+
 
 # album-comment
 class JmAlbumCommentResp(JmJsonResp):
@@ -149,6 +269,654 @@ class JmAlbumCommentResp(JmJsonResp):
         return super().is_success and self.json()['err'] is False
 
 
+"""
+
+Domain Health
+
+"""
+
+
+class DomainHealthRegistry:
+    """
+    进程级的域名健康度统计，同步/异步客户端共用，因此 JmOption.new_jm_client / new_jm_async_client
+    创建的新客户端会沿用之前客户端积累的统计。
+
+    每个域名记录请求耗时和失败率的 EWMA（指数加权移动平均），
+    发请求前用 rank 按得分（耗时 × 失败率惩罚）对域名列表排序，快且稳定的域名优先。
+    失败率超过 DEMOTE_ERROR_RATE 的域名被降级到列表末尾，
+    并由后台线程每隔 PROBE_INTERVAL 秒探测一次，探测成功后逐步恢复。
+    """
+
+    ALPHA = 0.3  # EWMA 权重，越大越看重最近的请求
+    DEMOTE_ERROR_RATE = 0.5
+    PROBE_INTERVAL = 60
+    PROBE_TIMEOUT = 10
+
+    REGISTRY: Dict[str, dict] = {}
+    _lock = threading.Lock()
+    _probe_thread: Optional[threading.Thread] = None
+    # 探测用的 postman，为 None 时使用 JmModuleConfig.new_postman()
+    probe_postman = None
+    # 多进程下载时为共享状态的代理（见 JmSharedState），统计在共享状态所在的进程中汇总。
+    # 每次记录先更新本进程的 REGISTRY，攒够 FLUSH_BATCH 条或距上次同步超过 FLUSH_INTERVAL 秒时，
+    # 再把这些记录一次发给共享状态，并把本进程的 REGISTRY 同步为汇总后的统计，请求不用每次都等一次 IPC
+    shared_state = None
+    FLUSH_BATCH = 32
+    FLUSH_INTERVAL = 1.0
+    _pending: List[Tuple[str, Optional[float]]] = []
+    _last_flush = 0.0
+
+    @classmethod
+    def _stat(cls, domain: str) -> dict:
+        stat = cls.REGISTRY.get(domain)
+        if stat is None:
+            stat = cls.REGISTRY[domain] = {'latency': None, 'error_rate': 0.0, 'success': 0, 'failure': 0}
+        return stat
+
+    @classmethod
+    def apply_success(cls, domain: str, latency: float) -> dict:
+        """更新本进程的统计，返回更新后的统计"""
+        alpha = cls.ALPHA
+        with cls._lock:
+            stat = cls._stat(domain)
+            stat['latency'] = latency if stat['latency'] is None else stat['latency'] * (1 - alpha) + latency * alpha
+            stat['error_rate'] *= 1 - alpha
+            stat['success'] += 1
+            return dict(stat)
+
+    @classmethod
+    def apply_failure(cls, domain: str) -> dict:
+        alpha = cls.ALPHA
+        with cls._lock:
+            stat = cls._stat(domain)
+            stat['error_rate'] = stat['error_rate'] * (1 - alpha) + alpha
+            stat['failure'] += 1
+            return dict(stat)
+
+    @classmethod
+    def merge(cls, stat_dict: Dict[str, dict]):
+        """用其他进程汇总的统计覆盖本进程的统计"""
+        with cls._lock:
+            for domain, stat in stat_dict.items():
+                cls.REGISTRY[domain] = {k: stat[k] for k in ('latency', 'error_rate', 'success', 'failure')}
+
+    @classmethod
+    def _record(cls, domain: str, latency: Optional[float]) -> bool:
+        """
+        记录一次请求结果（latency 为 None 表示失败），返回是否需要同步到共享状态（flush）
+        """
+        if latency is None:
+            cls.apply_failure(domain)
+        else:
+            cls.apply_success(domain, latency)
+
+        if cls.shared_state is None:
+            return False
+        with cls._lock:
+            cls._pending.append((domain, latency))
+            return len(cls._pending) >= cls.FLUSH_BATCH or time.monotonic() - cls._last_flush >= cls.FLUSH_INTERVAL
+
+    @classmethod
+    def flush(cls):
+        """
+        把攒下的记录发给共享状态汇总，本进程的统计同步为汇总后的统计。没有设置 shared_state 时什么都不做
+        """
+        shared_state = cls.shared_state
+        with cls._lock:
+            event_list, cls._pending = cls._pending, []
+            cls._last_flush = time.monotonic()
+
+        if shared_state is None or len(event_list) == 0:
+            return
+        cls.merge(shared_state.record_domain_events(event_list))
+
+    @classmethod
+    def record_success(cls, domain: str, latency: float):
+        if cls._record(domain, latency):
+            cls.flush()
+
+    @classmethod
+    def record_failure(cls, domain: str):
+        if cls._record(domain, None):
+            cls.flush()
+
+        if cls.is_demoted(domain):
+            cls._start_probe_thread()
+
+    @classmethod
+    async def async_record_success(cls, domain: str, latency: float):
+        """异步客户端使用，同步到共享状态是阻塞的 IPC，在线程池中执行"""
+        if cls._record(domain, latency):
+            await asyncio.get_running_loop().run_in_executor(None, cls.flush)
+
+    @classmethod
+    async def async_record_failure(cls, domain: str):
+        if cls._record(domain, None):
+            await asyncio.get_running_loop().run_in_executor(None, cls.flush)
+
+        if cls.is_demoted(domain):
+            cls._start_probe_thread()
+
+    @classmethod
+    def is_demoted(cls, domain: str) -> bool:
+        stat = cls.REGISTRY.get(domain)
+        return stat is not None and stat['error_rate'] >= cls.DEMOTE_ERROR_RATE
+
+    @classmethod
+    def score(cls, domain: str) -> float:
+        """
+        得分越小越优先。没有统计的域名得分为0，会被优先尝试一次以获得统计。
+        """
+        stat = cls.REGISTRY.get(domain)
+        if stat is None:
+            return 0.0
+        if stat['latency'] is None:
+            return float('inf') if stat['failure'] else 0.0
+        return stat['latency'] * (1 + 4 * stat['error_rate'])
+
+    @classmethod
+    def rank(cls, domain_list: List[str]) -> List[str]:
+        """
+        返回排序后的新列表：正常域名按得分排序，降级的域名在最后，得分相同时保持原顺序
+        """
+        return sorted(domain_list, key=lambda d: (cls.is_demoted(d), cls.score(d)))
+
+    @classmethod
+    def snapshot(cls) -> Dict[str, dict]:
+        with cls._lock:
+            return {domain: dict(stat, demoted=cls.is_demoted(domain)) for domain, stat in cls.REGISTRY.items()}
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls.REGISTRY.clear()
+            cls._pending = []
+            cls._last_flush = 0.0
+
+    @classmethod
+    def probe(cls, domain: str):
+        """
+        探测一次域名，能收到非 5xx 响应即视为可用
+        """
+        postman = cls.probe_postman or JmModuleConfig.new_postman()
+        url = domain if domain.startswith(JmModuleConfig.PROT) else f'{JmModuleConfig.PROT}{domain}'
+        begin = time.perf_counter()
+        try:
+            resp = postman.get(url, timeout=cls.PROBE_TIMEOUT)
+            ExceptionTool.require_true(resp.status_code < 500, f'域名探测失败: [{domain}], HTTP状态码: {resp.status_code}')
+        except Exception as e:
+            jm_log('domain.probe', f'域名探测失败: [{domain}], 异常: [{e}]')
+            cls.record_failure(domain)
+            return False
+
+        cls.record_success(domain, time.perf_counter() - begin)
+        jm_log('domain.probe', f'域名探测成功: [{domain}]')
+        return True
+
+    @classmethod
+    def probe_demoted(cls):
+        for domain in [d for d in list(cls.REGISTRY) if cls.is_demoted(d)]:
+            cls.probe(domain)
+
+    @classmethod
+    def _start_probe_thread(cls):
+        with cls._lock:
+            if cls._probe_thread is not None and cls._probe_thread.is_alive():
+                return
+            cls._probe_thread = threading.Thread(target=cls._probe_loop, name='jm-domain-probe', daemon=True)
+            cls._probe_thread.start()
+
+    @classmethod
+    def _probe_loop(cls):
+        # 没有降级的域名时退出，下次有域名被降级时再启动
+        while any(cls.is_demoted(d) for d in list(cls.REGISTRY)):
+            time.sleep(cls.PROBE_INTERVAL)
+            cls.probe_demoted()
+
+
+class RetryPolicy:
+    """
+    请求重试策略，同步/异步客户端、图片请求和 AdvancedRetryPlugin 共用。
+
+    - 根据异常对应的HTTP状态码决定动作（status_action）：
+      retry（等待后在当前域名重试）/ switch（立即换下一个域名）/ abort（不再重试，直接抛出）。
+      没有状态码的异常（网络异常、响应校验失败等）按 retry 处理
+    - 等待时间为指数退避：min(backoff_max, backoff_base * 2 ^ 当前域名已重试次数)，
+      开启 jitter 时在 [0, 该值] 之间随机（full jitter），避免大量请求同时重试
+    - 响应带有 Retry-After 时，等待 Retry-After 秒（不超过 retry_after_max）
+    - deadline：单个请求（含全部重试）的总耗时上限，秒，None 表示不限制
+
+    使用方式见 RetryContext。
+    """
+
+    RETRY = 'retry'
+    SWITCH = 'switch'
+    ABORT = 'abort'
+
+    DEFAULT_STATUS_ACTION = {
+        403: SWITCH,  # ip地区禁止访问/爬虫被识别，换域名
+        404: SWITCH,
+        429: RETRY,  # 请求过快，按 Retry-After 等待
+    }
+
+    def __init__(self,
+                 backoff_base: float = 0.5,
+                 backoff_max: float = 10,
+                 jitter: bool = True,
+                 retry_after_max: float = 60,
+                 deadline: Optional[float] = None,
+                 status_action: Optional[Dict[int, str]] = None,
+                 ):
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.retry_after_max = retry_after_max
+        self.deadline = deadline
+        self.status_action = {**self.DEFAULT_STATUS_ACTION, **{int(k): v for k, v in (status_action or {}).items()}}
+        for action in self.status_action.values():
+            ExceptionTool.require_true(action in (self.RETRY, self.SWITCH, self.ABORT), f'不支持的重试动作: {action}')
+
+    @classmethod
+    def from_config(cls, config: Optional[dict]) -> 'RetryPolicy':
+        """
+        由 option 的 client.retry 配置创建
+        """
+        return cls(**(config or {}))
+
+    @staticmethod
+    def resp_of(e: BaseException):
+        resp = e.context.get(ExceptionTool.CONTEXT_KEY_RESP, None) if isinstance(e, JmcomicException) else None
+        return resp.resp if isinstance(resp, JmResp) else resp
+
+    @classmethod
+    def status_of(cls, e: BaseException) -> Optional[int]:
+        return getattr(cls.resp_of(e), 'status_code', None)
+
+    @classmethod
+    def retry_after_of(cls, e: BaseException) -> Optional[float]:
+        headers = getattr(cls.resp_of(e), 'headers', None)
+        value = headers.get('Retry-After', None) if headers is not None else None
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            # HTTP-date 格式
+            from email.utils import parsedate_to_datetime
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
+
+    def classify(self, e: BaseException) -> str:
+        status = self.status_of(e)
+        if status is None:
+            return self.RETRY
+        return self.status_action.get(status, self.RETRY)
+
+    def delay(self, retry_count: int, e: BaseException) -> float:
+        """
+        第 retry_count 次重试前需要等待的秒数
+        """
+        retry_after = self.retry_after_of(e)
+        if retry_after is not None:
+            return min(retry_after, self.retry_after_max)
+
+        delay = min(self.backoff_max, self.backoff_base * (2 ** retry_count))
+        return random.uniform(0, delay) if self.jitter else delay
+
+    def new_context(self, target_list: List, retry_times: int, rotate=False) -> 'RetryContext':
+        return RetryContext(self, target_list, retry_times, rotate)
+
+
+class RetryContext:
+    """
+    单个请求的重试状态（迭代式，不递归）。用法：
+
+        ctx = policy.new_context(domain_list, retry_times)
+        while True:
+            try:
+                return request(ctx.target)
+            except Exception as e:
+                delay = ctx.on_failure(e)
+                if delay is None:
+                    break  # 不再重试，ctx.aborted 表示是被 abort 的
+                time.sleep(delay)  # 异步：await asyncio.sleep(delay)
+
+    rotate=False：每个 target（域名）重试 retry_times 次后换下一个，遍历完为止。
+    rotate=True：每次失败都换下一个 target 并循环，总共最多请求 retry_times + 1 次，用于图片域名切换。
+    """
+
+    def __init__(self, policy: RetryPolicy, target_list: List, retry_times: int, rotate=False):
+        ExceptionTool.require_true(len(target_list) != 0, '重试的目标列表不能为空')
+        self.policy = policy
+        self.target_list = target_list
+        self.retry_times = retry_times
+        self.rotate = rotate
+        self.index = 0
+        self.retry_count = 0  # rotate=False 时为当前 target 的重试次数，否则为总的重试次数
+        self.aborted = False
+        self.last_error: Optional[BaseException] = None
+        self.started_at = time.monotonic()
+
+    @property
+    def target(self):
+        return self.target_list[self.index % len(self.target_list)]
+
+    def on_failure(self, e: BaseException) -> Optional[float]:
+        """
+        记录一次失败，返回下次请求前需要等待的秒数，不再重试时返回 None
+        """
+        policy = self.policy
+        self.last_error = e
+        action = policy.classify(e)
+
+        if action == policy.ABORT:
+            self.aborted = True
+            return None
+
+        if self.rotate:
+            if self.retry_count >= self.retry_times:
+                return None
+            self.index += 1
+            self.retry_count += 1
+            delay = 0.0 if action == policy.SWITCH else policy.delay(self.retry_count - 1, e)
+        elif action == policy.SWITCH or self.retry_count >= self.retry_times:
+            self.index += 1
+            self.retry_count = 0
+            if self.index >= len(self.target_list):
+                return None
+            # 换到其他域名不需要等待
+            delay = 0.0
+        else:
+            self.retry_count += 1
+            delay = policy.delay(self.retry_count - 1, e)
+
+        if policy.deadline is not None and time.monotonic() - self.started_at + delay > policy.deadline:
+            jm_log('req.deadline', f'请求超过总耗时上限 {policy.deadline}s，不再重试')
+            return None
+
+        return delay
+
+
+class ImageHostCircuitBreaker:
+    """
+    图片域名的熔断器（进程级）。
+
+    - closed：正常请求。连续失败 FAILURE_THRESHOLD 次后进入 open
+    - open：不再向该域名发请求。经过 OPEN_DURATION 秒后进入 half_open
+    - half_open：放行一个试探请求，成功则恢复 closed，失败则重新 open
+
+    图片请求失败时，通过 candidate_url_list 把图片 url 的域名替换为 JmModuleConfig.DOMAIN_IMAGE_LIST 中的其他图片域名重试。
+    """
+
+    FAILURE_THRESHOLD = 3
+    OPEN_DURATION = 30
+
+    REGISTRY: Dict[str, dict] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def _state(cls, host: str) -> dict:
+        state = cls.REGISTRY.get(host)
+        if state is None:
+            state = cls.REGISTRY[host] = {'state': 'closed', 'failure': 0, 'opened_at': 0.0, 'trial_at': 0.0}
+        return state
+
+    @classmethod
+    def allow(cls, host: str) -> bool:
+        with cls._lock:
+            state = cls.REGISTRY.get(host)
+            if state is None or state['state'] == 'closed':
+                return True
+
+            now = time.time()
+            if state['state'] == 'open':
+                if now - state['opened_at'] < cls.OPEN_DURATION:
+                    return False
+                state['state'] = 'half_open'
+                state['trial_at'] = 0.0
+
+            # half_open：同一时间只放行一个试探请求，试探请求迟迟没有结果时重新放行
+            if now - state['trial_at'] < cls.OPEN_DURATION:
+                return False
+            state['trial_at'] = now
+            return True
+
+    @classmethod
+    def record_success(cls, host: str):
+        with cls._lock:
+            state = cls.REGISTRY.get(host)
+            if state is not None:
+                if state['state'] != 'closed':
+                    jm_log('image.host.close', f'图片域名恢复: [{host}]')
+                state.update(state='closed', failure=0)
+
+    @classmethod
+    def record_failure(cls, host: str):
+        with cls._lock:
+            state = cls._state(host)
+            state['failure'] += 1
+            if state['state'] == 'half_open' or state['failure'] >= cls.FAILURE_THRESHOLD:
+                if state['state'] != 'open':
+                    jm_log('image.host.open', f'图片域名熔断: [{host}], 连续失败次数: {state["failure"]}')
+                state.update(state='open', opened_at=time.time())
+
+    @classmethod
+    def is_open(cls, host: str) -> bool:
+        state = cls.REGISTRY.get(host)
+        return state is not None and state['state'] != 'closed'
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls.REGISTRY.clear()
+
+    @classmethod
+    def candidate_url_list(cls, img_url: str) -> List[str]:
+        """
+        返回图片请求依次尝试的 url：原域名在前，之后是 DOMAIN_IMAGE_LIST 中的其他图片域名，跳过已熔断的域名。
+        非禁漫图片（路径不是 /media/ 开头）不替换域名。所有域名都熔断时仍请求原 url。
+        """
+        parsed = urlparse(img_url)
+        host = parsed.netloc
+        if not parsed.path.startswith('/media/'):
+            return [img_url]
+
+        host_list = [host] + [h for h in JmModuleConfig.DOMAIN_IMAGE_LIST if h != host]
+        url_list = [parsed._replace(netloc=h).geturl() for h in host_list if cls.allow(h)]
+        return url_list or [img_url]
+
+    @staticmethod
+    def host_of(img_url: str) -> str:
+        return urlparse(img_url).netloc
+
+
+class TokenBucket:
+    """
+    令牌桶：每秒补充 rate 个令牌，最多积累 capacity 个。
+
+    reserve 立即扣除令牌（允许扣成负数），返回调用方需要等待的秒数。
+    这样同步（time.sleep）和异步（asyncio.sleep）可以共用一个桶，一次扣除超过 capacity 的令牌也不会一直等不到。
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        ExceptionTool.require_true(rate > 0, f'令牌桶速率必须大于0: {rate}')
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+
+class RateLimiter:
+    """
+    进程级的请求速率（rps，请求数/秒）和带宽（bps，字节/秒）限制，同步/异步客户端共用。
+
+    令牌桶分三个范围，请求需要通过所有适用的桶：
+    - global：所有请求共用
+    - api：每个API域名（网页端为网页域名）各自一个桶
+    - image：每个图片域名各自一个桶
+    host 下可以对某个域名单独配置，覆盖 api / image 的配置。
+
+    请求发出前扣 rps 令牌，并等待 bps 桶的欠账还清；收到响应体后按字节数扣 bps 令牌
+    （流式响应每累计 STREAM_CHARGE_BYTES 字节扣一次）。
+    每个域名的请求数、字节数、等待时间记录在 METRICS 中，可通过 snapshot 查看，用于调整限速配置。
+
+    设置了 shared_state（多进程下载）时，令牌桶在共享状态所在的进程中，扣令牌是一次 IPC：
+    没有配置对应的限速时不经过共享状态；异步版本（async_acquire / async_consume）在线程池中调用，不阻塞事件循环。
+    """
+
+    SCOPE_GLOBAL = 'global'
+    SCOPE_API = 'api'
+    SCOPE_IMAGE = 'image'
+
+    STREAM_CHARGE_BYTES = 256 * 1024
+
+    config: dict = {}
+    # 配置了的限速种类（rps / bps）
+    _limit_kind_set: set = set()
+    METRICS: Dict[str, dict] = {}
+    _bucket_dict: Dict[tuple, Optional[TokenBucket]] = {}
+    _lock = threading.Lock()
+    # 多进程下载时为共享状态的代理（见 JmSharedState），令牌桶在共享状态所在的进程中，各进程共用一份限速
+    shared_state = None
+
+    @classmethod
+    def configure(cls, config: Optional[dict]):
+        """
+        使用 option 的 client.rate_limit 配置，配置变化时重建令牌桶
+        """
+        config = dict(config or {})
+        with cls._lock:
+            if config == cls.config:
+                return
+            cls.config = config
+            cls._bucket_dict.clear()
+            rule_list = [config.get(scope, None) for scope in (cls.SCOPE_GLOBAL, cls.SCOPE_API, cls.SCOPE_IMAGE)]
+            rule_list += list((config.get('host', None) or {}).values())
+            cls._limit_kind_set = {kind for rule in rule_list for kind in ('rps', 'bps') if (rule or {}).get(kind, None)}
+
+    @classmethod
+    def _use_shared_state(cls, *kind: str) -> bool:
+        """是否需要通过共享状态扣令牌，没有配置 kind 中的任何一种限速时在本进程记录即可"""
+        return cls.shared_state is not None and not cls._limit_kind_set.isdisjoint(kind)
+
+    @classmethod
+    def _rule(cls, scope: str, host: str) -> dict:
+        if scope != cls.SCOPE_GLOBAL:
+            rule = (cls.config.get('host', None) or {}).get(host, None)
+            if rule is not None:
+                return rule
+        return cls.config.get(scope, None) or {}
+
+    @classmethod
+    def _bucket_list(cls, host: str, is_image: bool, kind: str) -> List[TokenBucket]:
+        scope = cls.SCOPE_IMAGE if is_image else cls.SCOPE_API
+        bucket_list = []
+        with cls._lock:
+            for key in ((cls.SCOPE_GLOBAL, '', kind), (scope, host, kind)):
+                if key not in cls._bucket_dict:
+                    rate = cls._rule(key[0], host).get(kind, None)
+                    burst = cls.config.get('burst', None) or 1
+                    cls._bucket_dict[key] = TokenBucket(rate, rate * burst) if rate else None
+                if cls._bucket_dict[key] is not None:
+                    bucket_list.append(cls._bucket_dict[key])
+        return bucket_list
+
+    @classmethod
+    def _record(cls, host: str, is_image: bool, request: int, size: int, wait: float):
+        with cls._lock:
+            metric = cls.METRICS.get(host)
+            if metric is None:
+                metric = cls.METRICS[host] = {
+                    'scope': cls.SCOPE_IMAGE if is_image else cls.SCOPE_API,
+                    'request': 0, 'bytes': 0, 'wait': 0.0, 'throttled': 0,
+                }
+            metric['request'] += request
+            metric['bytes'] += size
+            if wait > 0:
+                metric['wait'] += wait
+                metric['throttled'] += 1
+
+    @classmethod
+    def reserve_request(cls, url: str, is_image: bool = False) -> float:
+        """
+        发请求前调用，返回需要等待的秒数
+        """
+        host = urlparse(url).netloc
+        if cls._use_shared_state('rps', 'bps'):
+            delay = cls.shared_state.reserve_request(url, is_image)
+        else:
+            delay = max([bucket.reserve(1) for bucket in cls._bucket_list(host, is_image, 'rps')]
+                        + [bucket.reserve(0) for bucket in cls._bucket_list(host, is_image, 'bps')],
+                        default=0.0)
+        cls._record(host, is_image, 1, 0, delay)
+        return delay
+
+    @classmethod
+    def reserve_bytes(cls, url: str, is_image: bool, size: int) -> float:
+        """
+        收到 size 字节的响应体后调用，返回需要等待的秒数
+        """
+        host = urlparse(url).netloc
+        if cls._use_shared_state('bps'):
+            delay = cls.shared_state.reserve_bytes(url, is_image, size)
+        else:
+            delay = max([bucket.reserve(size) for bucket in cls._bucket_list(host, is_image, 'bps')], default=0.0)
+        cls._record(host, is_image, 0, size, delay)
+        return delay
+
+    @classmethod
+    def acquire(cls, url: str, is_image: bool = False):
+        delay = cls.reserve_request(url, is_image)
+        if delay > 0:
+            time.sleep(delay)
+
+    @classmethod
+    def consume(cls, url: str, is_image: bool, size: int):
+        delay = cls.reserve_bytes(url, is_image, size)
+        if delay > 0:
+            time.sleep(delay)
+
+    @classmethod
+    async def async_acquire(cls, url: str, is_image: bool = False):
+        if cls._use_shared_state('rps', 'bps'):
+            delay = await asyncio.get_running_loop().run_in_executor(None, cls.reserve_request, url, is_image)
+        else:
+            delay = cls.reserve_request(url, is_image)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    @classmethod
+    async def async_consume(cls, url: str, is_image: bool, size: int):
+        if cls._use_shared_state('bps'):
+            delay = await asyncio.get_running_loop().run_in_executor(None, cls.reserve_bytes, url, is_image, size)
+        else:
+            delay = cls.reserve_bytes(url, is_image, size)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    @classmethod
+    def snapshot(cls) -> Dict[str, dict]:
+        with cls._lock:
+            return {host: dict(metric) for host, metric in cls.METRICS.items()}
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls.METRICS.clear()
+            cls._bucket_dict.clear()
+
+
 """
 
 Client Interface
@@ -330,8 +1098,12 @@ class JmImageClient:
         :param scramble_id: 图片所在photo的scramble_id
         :param decode_image: 要保存的是解密后的图还是原图
         """
-        # 请求图片
-        resp = self.get_jm_image(img_url)
+        # 请求图片。不需要解密和格式转换时使用流式响应，在请求（含重试）中分块写盘，图片字节不在内存中缓冲
+        if self.is_stream_download(img_url, img_save_path, scramble_id, decode_image) \
+                and self.support_stream_to(self.get_jm_image):
+            resp = self.get_jm_image(img_url, stream=True, stream_to=img_save_path)
+        else:
+            resp = self.get_jm_image(img_url)
 
         resp.require_success()
 
@@ -353,9 +1125,45 @@ class JmImageClient:
             decode_image=decode_image,
         )
 
-    def get_jm_image(self, img_url) -> JmImageResp:
+    def get_jm_image(self, img_url, stream=False, stream_to=None) -> JmImageResp:
+        """
+        请求图片
+
+        :param img_url: 图片url
+        :param stream: 是否使用流式响应，见 JmImageResp
+        :param stream_to: 流式响应体的保存路径。指定时响应体在请求的重试范围内写入该路径，
+                          读响应体失败（连接中断、响应体为空）也会重试、切换图片域名
+        """
         raise NotImplementedError
 
+    @staticmethod
+    def support_stream_to(get_jm_image) -> bool:
+        """
+        get_jm_image 是否支持 stream / stream_to 参数。
+        旧版本的自定义客户端重写的是 get_jm_image(self, img_url)，这种客户端不使用流式下载，按原来的方式请求
+        """
+        import inspect
+        try:
+            parameters = inspect.signature(get_jm_image).parameters
+        except (ValueError, TypeError):
+            return False
+
+        return 'stream_to' in parameters or any(p.kind == p.VAR_KEYWORD for p in parameters.values())
+
+    # noinspection PyMethodMayBeStatic
+    def is_stream_download(self, img_url, img_save_path, scramble_id, decode_image) -> bool:
+        """
+        图片无需解密（不解密，或者分割数为0）且无需格式转换时，使用流式下载
+        """
+        index = img_url.find('?')
+        if index != -1:
+            img_url = img_url[0:index]
+
+        if suffix_not_equal(img_url, img_save_path):
+            return False
+
+        return decode_image is False or scramble_id is None or JmImageTool.get_num_by_url(scramble_id, img_url) == 0
+
     @classmethod
     def img_is_not_need_to_decode(cls, data_original: str, _resp) -> bool:
         # https://cdn-msp2.18comic.vip/media/photos/498976/00027.gif?v=1697541064
@@ -1176,5 +1984,5 @@ class AsyncJmcomicClient:
     async def setup(self):
         pass
 
-    async def get_jm_image(self, download_url):
+    async def get_jm_image(self, download_url, stream=False, stream_to=None):
         raise NotImplementedError
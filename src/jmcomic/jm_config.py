@@ -1,6 +1,10 @@
 from __future__ import annotations
 
 import logging
+import pickle
+import threading
+import time
+from collections import OrderedDict
 
 from common import time_stamp, field_cache, ProxyBuilder
 
@@ -50,6 +54,97 @@ def shuffled(lines):
     return ls
 
 
+class LruCache:
+    """
+    有界缓存，用于长时间运行的进程：
+    - 超过 max_entries 条或 max_bytes 字节时，淘汰最久未使用的记录
+    - 记录写入超过 ttl 秒后失效
+
+    实现了客户端缓存用到的 dict 接口（get / [] / in / pop），线程安全，
+    可以作为 client.set_cache_dict 的参数，也用于 JmModuleConfig.SCRAMBLE_CACHE。
+    记录的字节数按 pickle 后的长度估算，只有配置了 max_bytes 时才会计算。
+    """
+
+    def __init__(self,
+                 max_entries: int | None = None,
+                 max_bytes: int | None = None,
+                 ttl: float | None = None,
+                 ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0  # 当前记录的总字节数（未配置 max_bytes 时为0）
+        self.evict_count = 0
+        self._data: OrderedDict = OrderedDict()  # key -> (value, expire_at, size)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def size_of(value) -> int:
+        try:
+            return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            import sys
+            return sys.getsizeof(value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, None)
+            if item is None:
+                return default
+            if item[1] is not None and item[1] < time.monotonic():
+                self._remove(key)
+                return default
+            self._data.move_to_end(key)
+            return item[0]
+
+    def __setitem__(self, key, value):
+        size = self.size_of(value) if self.max_bytes is not None else 0
+        expire_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expire_at, size)
+            self.size += size
+            while self._data and (
+                    (self.max_entries is not None and len(self._data) > self.max_entries)
+                    or (self.max_bytes is not None and self.size > self.max_bytes)
+            ):
+                self._remove(next(iter(self._data)))
+                self.evict_count += 1
+
+    def _remove(self, key):
+        self.size -= self._data.pop(key)[2]
+
+    def __getitem__(self, key):
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def pop(self, key, *default):
+        with self._lock:
+            if key in self._data:
+                value = self._data[key][0]
+                self._remove(key)
+                return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
 def setup_default_jm_logger():
     # 为了保持原有默认向下兼容，如果没有 handler，我们加一个控制台 handler
     if not jm_logger.handlers:
@@ -172,8 +267,8 @@ class JmModuleConfig:
     PAGE_SIZE_SEARCH = 80
     PAGE_SIZE_FAVORITE = 20
 
-    # 图片分隔相关
-    SCRAMBLE_CACHE = {}
+    # 图片分隔相关，photo_id / album_id → scramble_id，有上限避免长时间运行的进程内存一直增长
+    SCRAMBLE_CACHE = LruCache(max_entries=10000)
 
     # 当本子没有作者名字时，顶替作者名字
     DEFAULT_AUTHOR = 'default_author'
@@ -511,14 +606,30 @@ class JmModuleConfig:
         'dir_rule': {'rule': 'Bd_Pname', 'base_dir': None, 'normalize_zh': None},
         'download': {
             'cache': True,
+            'cache_verify': False,  # 判断图片已下载时，是否额外校验文件完整性（文件头尾），不完整则重新下载
             'image': {'decode': True, 'suffix': None},
             'threading': {
                 'image': 30,
                 'photo': None,
+                'scope': 'downloader',  # 线程池范围：downloader（每个下载器一个）/ process（进程内共享）
+                'adaptive': False,  # 是否根据耗时和失败率自动调整图片并发数（AIMD）
+                'image_floor': 4,  # 自适应时图片并发数的下限
+                'image_ceiling': 64,  # 自适应时图片并发数的上限
+                'prefetch': 2,  # 章节下载时提前并行获取之后几个章节的元数据，0 表示不预取
+                'album': None,  # 批量下载时同时下载的本子数，null 表示不限制
             },
+            # 异步下载器的图片解密方式：thread（线程池）/ process（进程池，图片字节经共享内存传给子进程）
+            'decode_backend': 'thread',
+            'decode_worker': None,  # 解密线程池 / 进程池的大小，None 表示使用 Executor 的默认值
+            'decode_batch': 4,  # process 后端单次提交给一个子进程的最大图片数
         },
         'client': {
             'cache': None,  # see CacheRegistry
+            # cache 为 level_disk 时的磁盘缓存配置，见 DiskCache
+            'disk_cache': {
+                'path': None,  # None 表示 {base_dir}/.jmcomic_cache.sqlite3
+                'ttl': None,  # 各种类的过期时间（秒），会覆盖 DiskCache.DEFAULT_TTL
+            },
             'domain': [],
             'postman': {
                 'type': 'curl_cffi',
@@ -531,6 +642,34 @@ class JmModuleConfig:
             'impl': None,
             'async_impl': 'async_api',  # 异步客户端实现类型
             'retry_times': 5,
+            # 重试策略，见 RetryPolicy
+            'retry': {
+                'backoff_base': 0.5,  # 指数退避的基数（秒）
+                'backoff_max': 10,  # 单次等待的上限（秒）
+                'jitter': True,  # 在 [0, 退避时间] 之间随机等待
+                'retry_after_max': 60,  # 遵循响应头 Retry-After 时的等待上限（秒）
+                'deadline': None,  # 单个请求含重试的总耗时上限（秒），None 表示不限制
+                'status_action': None,  # HTTP状态码 → retry/switch/abort，会覆盖默认的 {403: switch, 404: switch, 429: retry}
+            },
+            # 异步客户端的图片对冲请求：请求耗时超过最近耗时的 percentile 分位数仍未完成时，向另一个图片域名再发一个请求
+            'hedge': {
+                'percentile': None,  # None 表示不对冲，例如 0.95
+                'budget': 0.05,  # 对冲请求数不超过图片请求数的 5%
+                'min_sample': 20,  # 至少有这么多次耗时记录后才开始对冲
+            },
+            # 请求速率（rps，请求数/秒）和带宽（bps，字节/秒）限制，见 RateLimiter，None 表示不限制
+            'rate_limit': {
+                'global': {'rps': None, 'bps': None},  # 所有请求共用
+                'api': {'rps': None, 'bps': None},  # 每个API域名各自限制
+                'image': {'rps': None, 'bps': None},  # 每个图片域名各自限制
+                'host': None,  # 域名 → {'rps': ..., 'bps': ...}，对个别域名单独配置
+                'burst': 1,  # 令牌桶容量 = 速率 × burst，即允许的突发量（秒）
+            },
+            # 移动端API响应的解码（json解析、解密）
+            'decode': {
+                'json': 'auto',  # json解析库：auto（安装了 orjson 时使用 orjson）/ orjson / json
+                'offload_bytes': 65536,  # 异步客户端中，响应体不小于这么多字节时在线程池中解码，避免阻塞事件循环，None 表示不使用线程池
+            },
         },
         'plugins': {
             # 如果插件抛出参数校验异常，只log。（全局配置，可以被插件的局部配置覆盖）
@@ -1,5 +1,12 @@
 import os
 import inspect
+import json
+import threading
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, nullcontext
 from functools import wraps
 from typing import NamedTuple
 from time import perf_counter
@@ -69,12 +76,277 @@ class DownloadManifest:
         self.image_filepath_list: List[str] = []
         self.export_filepath_dict: Dict[str, List[str]] = {}
         self.duration: Optional[float] = None  # 顶层任务完整耗时（秒）
+        self.passthrough_image_count: int = 0  # 原样写盘（跳过解密和重新编码）的图片数
 
     def get_export_filepath_list(self, suffix: str) -> List[str]:
         normalized_suffix = str(suffix).lower().lstrip('.')
         return self.export_filepath_dict.get(normalized_suffix, [])
 
 
+class PhotoCompletionIndex:
+    """
+    章节完成索引。
+
+    断点续传时，逐张图片判断文件是否存在需要一次 stat，上千张图片在 NFS 等网络文件系统上很慢。
+    该索引在章节下载完成后记录章节目录中已完成的图片文件名，以及当时的目录 mtime，
+    下次下载时只需读一次索引 + stat 一次目录，就能批量得到已完成的图片。
+
+    索引文件保存在 {base_dir}/.jmcomic_index/{photo_id}.json，不放在章节目录中，
+    避免被压缩、转pdf等按目录收集文件的插件当作图片。
+    目录 mtime 与索引不一致（例如用户删改了文件）时，索引失效，退化为对章节目录做一次 os.scandir。
+    """
+
+    index_dirname = '.jmcomic_index'
+
+    def __init__(self, base_dir: str):
+        self.index_dir = os.path.join(base_dir, self.index_dirname)
+
+    def index_filepath(self, photo: JmPhotoDetail) -> str:
+        return os.path.join(self.index_dir, f'{photo.photo_id}.json')
+
+    def load(self, photo: JmPhotoDetail, save_dir: str) -> Set[str]:
+        """
+        返回章节目录中已存在的图片文件名
+        """
+        try:
+            dir_mtime = os.stat(save_dir).st_mtime_ns
+        except OSError:
+            return set()
+
+        try:
+            with open(self.index_filepath(photo), 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index['save_dir'] == save_dir and index['dir_mtime'] == dir_mtime:
+                return set(index['filename_list'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        return self.scan(save_dir)
+
+    def save(self, photo: JmPhotoDetail, save_dir: str, filename_list: List[str]):
+        try:
+            dir_mtime = os.stat(save_dir).st_mtime_ns
+            data = json.dumps({
+                'save_dir': save_dir,
+                'dir_mtime': dir_mtime,
+                'filename_list': sorted(filename_list),
+            }, ensure_ascii=False).encode('utf-8')
+            JmImageTool.save_bytes(data, self.index_filepath(photo))
+        except OSError as e:
+            jm_log('photo.index.error', f'章节完成索引写入失败: [{photo.photo_id}], 异常: [{e}]', e)
+
+    @staticmethod
+    def scan(save_dir: str) -> Set[str]:
+        try:
+            with os.scandir(save_dir) as it:
+                return {entry.name for entry in it if entry.is_file()}
+        except OSError:
+            return set()
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    自适应并发限制器（AIMD：加性增、乘性减）。
+
+    - 请求成功且耗时正常（不超过平均耗时的 latency_tolerance 倍）时，每完成约 limit 个请求，limit 加 increase
+    - 请求失败（异常、超时、5xx、空响应等）时，limit 乘以 decrease，但不低于 floor
+    - 同一轮已经降过一次的话，该轮中先发出的请求再失败不会重复降低，避免一批并发失败把 limit 直接压到 floor
+
+    同步下载器使用 slot()，异步下载器使用 async_slot()，一个实例只应在其中一种场景使用。
+    limit 为当前并发上限，history 记录每次 limit 变化：(时间戳, limit, 原因)，可用于监控。
+    """
+
+    def __init__(self,
+                 initial: int,
+                 floor: int = 1,
+                 ceiling: Optional[int] = None,
+                 increase: float = 1.0,
+                 decrease: float = 0.5,
+                 latency_tolerance: float = 2.0,
+                 history_size: int = 256,
+                 ):
+        ceiling = ceiling if ceiling is not None else initial
+        if not 1 <= floor <= ceiling:
+            raise ValueError(f'adaptive limiter requires 1 <= floor <= ceiling, got floor={floor}, ceiling={ceiling}')
+        if not 0 < decrease < 1:
+            raise ValueError(f'adaptive limiter requires 0 < decrease < 1, got {decrease}')
+
+        self.floor = floor
+        self.ceiling = ceiling
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.history: deque = deque(maxlen=history_size)
+
+        self._limit = float(min(max(initial, floor), ceiling))
+        self._avg_latency: Optional[float] = None
+        self._last_decrease_at = 0.0
+        self._cond = threading.Condition()
+        self._async_cond: Optional[asyncio.Condition] = None
+        self._record('init')
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def _record(self, reason: str):
+        self.history.append((time.time(), self.limit, reason))
+
+    def on_success(self, latency: float):
+        with self._cond:
+            avg = self._avg_latency
+            self._avg_latency = latency if avg is None else avg * 0.9 + latency * 0.1
+            if avg is not None and latency > avg * self.latency_tolerance:
+                # 耗时明显变长，说明已接近瓶颈，不再加大并发
+                return
+
+            before = self.limit
+            self._limit = min(float(self.ceiling), self._limit + self.increase / self._limit)
+            if self.limit != before:
+                self._record('increase')
+                self._cond.notify_all()
+
+    def on_failure(self, started_at: float, reason: str):
+        with self._cond:
+            if started_at < self._last_decrease_at:
+                return
+
+            self._last_decrease_at = perf_counter()
+            before = self.limit
+            self._limit = max(float(self.floor), self._limit * self.decrease)
+            if self.limit != before:
+                self._record(reason)
+                jm_log('limiter.decrease', f'并发上限下调: {before} → {self.limit}, 原因: [{reason}]')
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        started_at = perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.on_failure(started_at, type(e).__name__)
+            raise
+        else:
+            self.on_success(perf_counter() - started_at)
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def async_slot(self):
+        if self._async_cond is None:
+            self._async_cond = asyncio.Condition()
+        cond = self._async_cond
+
+        async with cond:
+            await cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+        started_at = perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.on_failure(started_at, type(e).__name__)
+            raise
+        else:
+            self.on_success(perf_counter() - started_at)
+        finally:
+            async with cond:
+                self.in_flight -= 1
+                cond.notify_all()
+
+
+class PhotoPrefetcher:
+    """
+    章节元数据预取（流水线）。
+
+    本子中的章节下载图片前需要 check_photo（一次 get_photo_detail 请求）补全 page_arr / data_original_domain。
+    没有预取时，后面的章节要等到占上 photo 槽位才开始请求元数据，图片管道会在章节切换时出现空档。
+
+    每个章节开始时调用 resolve(photo)：
+    - 该章节已被预取则等待预取结果，否则在当前线程补全
+    - 同时把之后 depth 个还没开始的章节的 check_photo 提交到预取线程池并行执行
+
+    每个章节的 check_photo 只会执行一次，预取失败的异常由该章节的 resolve 抛出，按章节下载失败处理。
+    """
+
+    def __init__(self,
+                 photo_list: Iterable[JmPhotoDetail],
+                 depth: int,
+                 check_photo: Callable,
+                 executor: Optional[ThreadPoolExecutor] = None,
+                 ):
+        self.photo_list: List[JmPhotoDetail] = list(photo_list)
+        self.depth = depth
+        self.check_photo = check_photo
+        self.executor = executor
+        self.index_dict: Dict[JmPhotoDetail, int] = {photo: i for i, photo in enumerate(self.photo_list)}
+        # 章节 -> 该章节 check_photo 的 future / task
+        self.task_dict: Dict[JmPhotoDetail, Any] = {}
+        self._lock = threading.Lock()
+
+    def take(self, photo: JmPhotoDetail, create: Callable) -> Tuple[Any, bool, List[Tuple[JmPhotoDetail, Any]]]:
+        """
+        取出 photo 的任务（不存在时用 create(photo) 创建），并为之后 depth 个还没开始的章节创建任务。
+
+        :returns: (photo 的任务, photo 的任务是否本次创建, [(之后的章节, 任务)])
+        """
+        with self._lock:
+            task = self.task_dict.get(photo)
+            created = task is None
+            if created:
+                task = self.task_dict[photo] = create(photo)
+
+            upcoming = []
+            index = self.index_dict.get(photo)
+            if index is not None:
+                for next_photo in self.photo_list[index + 1: index + 1 + self.depth]:
+                    if next_photo not in self.task_dict:
+                        next_task = self.task_dict[next_photo] = create(next_photo)
+                        upcoming.append((next_photo, next_task))
+
+            return task, created, upcoming
+
+    def resolve(self, photo: JmPhotoDetail):
+        future, created, upcoming = self.take(photo, lambda _: Future())
+        run = bind_jm_task_context(self.run)
+        for next_photo, next_future in upcoming:
+            self.executor.submit(run, next_photo, next_future)
+
+        if created:
+            self.run(photo, future)
+        return future.result()
+
+    def run(self, photo: JmPhotoDetail, future: Future):
+        # close() 取消了还没执行的预取
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            future.set_result(self.check_photo(photo))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def close(self):
+        """取消还没开始执行的预取"""
+        with self._lock:
+            task_list = list(self.task_dict.values())
+        for task in task_list:
+            task.cancel()
+
+
 def catch_exception(func):
     @wraps(func)
     def wrapper(self, *args, **kwargs):
@@ -98,6 +370,29 @@ def catch_exception(func):
     return wrapper
 
 
+def shutdown_executor_on_finish(func):
+    """
+    JmDownloader 的下载入口使用：没有用 with 管理的下载器，在最外层的下载结束时关闭自己的线程池，不会留下空闲线程，
+    之后再下载时 get_executor 会重新创建线程池。with 块内的多次下载复用线程池，由 __exit__ 关闭。
+    """
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        self: JmDownloader
+        with self._download_depth_lock:
+            self._download_depth += 1
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            with self._download_depth_lock:
+                self._download_depth -= 1
+                finished = self._download_depth == 0 and not self._entered
+            if finished:
+                self.shutdown()
+
+    return wrapper
+
+
 # noinspection PyMethodMayBeStatic
 class DownloadCallback:
 
@@ -145,6 +440,9 @@ class BaseDownloader(DownloadCallback):
     不含 I/O 调度的公共基类，负责回调、钩子、Features 注册等无 I/O 通用逻辑。
     """
 
+    # 图片下载的自适应并发限制器，未开启 download.threading.adaptive 时为 None，见 create_image_limiter
+    image_limiter: Optional[AdaptiveConcurrencyLimiter] = None
+
     def __init__(self, option: JmOption):
         self.option = option
         self.client = None
@@ -157,6 +455,10 @@ class BaseDownloader(DownloadCallback):
         self.manifest_dict: Dict[DetailEntity, DownloadManifest] = {}
         # 当前顶层下载注册的 Feature 列表
         self._feature_list: List = []
+        # 章节目录中已存在的图片文件名，由 do_filter 批量加载，见 PhotoCompletionIndex
+        self._photo_file_dict: Dict[JmPhotoDetail, Set[str]] = {}
+        # 本子中正在下载的章节 -> 章节元数据预取器，见 begin_prefetch
+        self._prefetcher_dict: Dict[JmPhotoDetail, PhotoPrefetcher] = {}
 
     def do_filter(self, detail: DetailEntity):
         """
@@ -168,8 +470,24 @@ class BaseDownloader(DownloadCallback):
         :param detail: 可能是本子或者章节，需要自行使用 isinstance / detail.is_xxx 判断
         :returns: 只想要下载的 本子的章节 或 章节的图片
         """
+        if isinstance(detail, JmPhotoDetail):
+            self.load_photo_file_set(detail)
         return detail
 
+    @property
+    def photo_completion_index(self) -> PhotoCompletionIndex:
+        return PhotoCompletionIndex(self.option.dir_rule.base_dir)
+
+    def load_photo_file_set(self, photo: JmPhotoDetail):
+        """
+        批量加载章节目录中已完成的图片，之后该章节的图片判断是否已下载时不再逐张 stat。
+        未开启 download.cache 时不需要判断，不加载。
+        """
+        if not self._download_config(self.option, 'cache', True) or not photo.save_path:
+            return
+
+        self._photo_file_dict[photo] = self.photo_completion_index.load(photo, photo.save_path)
+
     @property
     def all_success(self) -> bool:
         """
@@ -196,6 +514,103 @@ class BaseDownloader(DownloadCallback):
     def has_download_failures(self):
         return len(self.download_failed_image) != 0 or len(self.download_failed_photo) != 0
 
+    def check_image_exists(self, image: JmImageDetail, img_save_path: str) -> bool:
+        """
+        判断图片是否已下载。
+        章节已批量加载文件列表时直接查表，否则 stat 文件。
+        配置了 download.cache_verify 时，还会校验文件是否完整，不完整的文件视为不存在。
+        """
+        save_dir, filename = os.path.split(img_save_path)
+        file_set = self._photo_file_dict.get(image.from_photo)
+        if file_set is not None and save_dir == image.from_photo.save_path:
+            if filename not in file_set:
+                return False
+        elif not file_exists(img_save_path):
+            return False
+
+        if not self._download_config(self.option, 'cache_verify', False):
+            return True
+
+        if JmImageTool.is_image_complete(img_save_path):
+            return True
+
+        jm_log('image.cache.broken', f'图片文件不完整，将重新下载: [{img_save_path}]')
+        return False
+
+    @staticmethod
+    def _download_config(option, key, default):
+        # 兼容不经过 JmOption.construct 合并默认配置的 option
+        try:
+            return getattr(option.download, key)
+        except (AttributeError, KeyError):
+            return default
+
+    @staticmethod
+    def _threading_config(option, key, default):
+        try:
+            return getattr(option.download.threading, key)
+        except (AttributeError, KeyError):
+            return default
+
+    def create_image_limiter(self, initial: int) -> Optional[AdaptiveConcurrencyLimiter]:
+        """
+        配置了 download.threading.adaptive 时，创建图片下载的自适应并发限制器，
+        上下限为 download.threading.image_floor / image_ceiling，initial 为初始并发数。
+        """
+        return self.new_image_limiter(self.option, initial)
+
+    @classmethod
+    def new_image_limiter(cls, option, initial: int) -> Optional[AdaptiveConcurrencyLimiter]:
+        if not cls._threading_config(option, 'adaptive', False):
+            return None
+
+        return AdaptiveConcurrencyLimiter(
+            initial=initial,
+            floor=cls._threading_config(option, 'image_floor', 1),
+            ceiling=cls._threading_config(option, 'image_ceiling', None) or initial,
+        )
+
+    def create_prefetcher(self, photo_list: List[JmPhotoDetail], depth: int) -> PhotoPrefetcher:
+        raise NotImplementedError
+
+    def begin_prefetch(self, photo_list: List[JmPhotoDetail]) -> Optional[PhotoPrefetcher]:
+        """
+        为本子的章节开启元数据预取，每个章节开始时提前补全之后 download.threading.prefetch 个章节。
+        配置为 0 或只有一个章节时不预取，返回 None。
+        """
+        depth = int(self._threading_config(self.option, 'prefetch', 0) or 0)
+        if depth <= 0 or len(photo_list) <= 1:
+            return None
+
+        prefetcher = self.create_prefetcher(photo_list, depth)
+        for photo in prefetcher.photo_list:
+            self._prefetcher_dict[photo] = prefetcher
+        return prefetcher
+
+    def end_prefetch(self, prefetcher: Optional[PhotoPrefetcher]):
+        if prefetcher is None:
+            return
+
+        for photo in prefetcher.photo_list:
+            if self._prefetcher_dict.get(photo) is prefetcher:
+                self._prefetcher_dict.pop(photo, None)
+        prefetcher.close()
+
+    def decide_image_decode(self, image: JmImageDetail, img_save_path: str) -> bool:
+        """
+        决定图片是否需要解密，同时标记 image.passthrough。
+
+        图片分割数为0时（aid < scramble_id）没有被切割，即使配置了解密也无需解密，
+        改为按不解密保存，后缀一致时直接写原始字节，省去 PIL 解码 + 重新编码。
+        """
+        decode_image = self.option.decide_download_image_decode(image)
+        image.passthrough = JmImageTool.is_passthrough(image, img_save_path, decode_image)
+
+        if decode_image and JmImageTool.get_num_by_detail(image) == 0:
+            return False
+
+        return decode_image
+
     # 下面是回调方法
 
     def before_album(self, album: JmAlbumDetail):
@@ -229,6 +644,7 @@ class BaseDownloader(DownloadCallback):
 
     def after_photo(self, photo: JmPhotoDetail):
         super().after_photo(photo)
+        self.save_photo_completion_index(photo)
         self.option.call_all_plugin(
             'after_photo',
             photo=photo,
@@ -237,6 +653,23 @@ class BaseDownloader(DownloadCallback):
         # 触发匹配 after_photo 的 Feature
         self._invoke_features_for('after_photo', photo=photo, downloader=self)
 
+    def save_photo_completion_index(self, photo: JmPhotoDetail):
+        """
+        章节下载完成后，记录章节目录中已完成的图片（在插件之前执行，插件对目录的改动会使索引失效）。
+        和 load_photo_file_set 一样，未开启 download.cache 时不记录。
+        """
+        self._photo_file_dict.pop(photo, None)
+        if not self._download_config(self.option, 'cache', True) or not photo.save_path:
+            return
+
+        image_list = self.download_success_dict.get(photo.from_album, {}).get(photo, [])
+        filename_list = [
+            os.path.basename(image.save_path)
+            for _, image in image_list
+            if os.path.dirname(image.save_path) == photo.save_path
+        ]
+        self.photo_completion_index.save(photo, photo.save_path, filename_list)
+
     def before_image(self, image: JmImageDetail, img_save_path):
         super().before_image(image, img_save_path)
         self.option.call_all_plugin(
@@ -304,6 +737,12 @@ class BaseDownloader(DownloadCallback):
             for success_list in success_groups
             for _, image in sorted(success_list, key=lambda item: item[1].index)
         ]
+        manifest.passthrough_image_count = sum(
+            1
+            for success_list in success_groups
+            for _, image in success_list
+            if image.passthrough
+        )
         return manifest
 
     @staticmethod
@@ -420,14 +859,45 @@ class BatchResult(set):
         """预期总数（成功 + 失败）"""
         return len(self) + len(self.failed)
 
+    def add_item(self, item: 'BatchItem'):
+        if item.error is not None:
+            self.failed[item.jm_id] = item.error
+        else:
+            self.add(item.result)
+
+
+class BatchItem(NamedTuple):
+    """流式批量下载中一个 jm_id 的结果，成功时 error 为 None，失败时 result 为 None"""
+    jm_id: str
+    result: Optional[DownloadResult]
+    error: Optional[BaseException]
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
 
 class JmDownloader(BaseDownloader):
     """
     JmDownloader = BaseDownloader + 同步 I/O 调度逻辑
     """
 
+    # 进程内共享的线程池，key: (层级, 线程数)，见 get_executor
+    _process_executor_dict: Dict[Tuple[str, int], ThreadPoolExecutor] = {}
+    _process_executor_lock = threading.Lock()
+    # 下载器自己的线程池，类属性作为默认值
+    _executor_dict: Optional[Dict[str, ThreadPoolExecutor]] = None
+    # 正在进行的下载入口调用数（含线程池中嵌套的章节下载）和是否在 with 块内，见 shutdown_executor_on_finish。
+    # 只在进入、退出下载入口时加锁，所有下载器共用一把锁
+    _download_depth = 0
+    _download_depth_lock = threading.Lock()
+    _entered = False
+
     def __init__(self, option: JmOption):
         super().__init__(option)
+        self._executor_dict = {}
+        self._executor_lock = threading.Lock()
+        self.image_limiter = self.create_image_limiter(option.download.threading.image)
         self.client = self.create_client()
 
     def create_client(self):
@@ -436,6 +906,7 @@ class JmDownloader(BaseDownloader):
         """
         return self.option.build_jm_client()
 
+    @shutdown_executor_on_finish
     @record_download_duration('album_started_at')
     def download_album(self, album_id):
         album = self.client.get_album_detail(album_id)
@@ -446,6 +917,7 @@ class JmDownloader(BaseDownloader):
             self.finish_manifest(album)
         return album
 
+    @shutdown_executor_on_finish
     @record_download_duration('album_started_at')
     def download_by_album_detail(self, album: JmAlbumDetail):
         album.save_path = self.option.dir_rule.decide_album_root_dir(album)
@@ -459,6 +931,7 @@ class JmDownloader(BaseDownloader):
         )
         self.after_album(album)
 
+    @shutdown_executor_on_finish
     @record_download_duration('photo_started_at')
     def download_photo(self, photo_id):
         photo = self.client.get_photo_detail(photo_id)
@@ -469,11 +942,12 @@ class JmDownloader(BaseDownloader):
             self.finish_manifest(photo)
         return photo
 
+    @shutdown_executor_on_finish
     @catch_exception
     @record_download_duration('photo_started_at')
     def download_by_photo_detail(self, photo: JmPhotoDetail):
         photo.save_path = self.option.decide_image_save_dir(photo)
-        self.client.check_photo(photo)
+        self.check_photo(photo)
         self.before_photo(photo)
         if photo.skip:
             return
@@ -484,12 +958,24 @@ class JmDownloader(BaseDownloader):
         )
         self.after_photo(photo)
 
+    def check_photo(self, photo: JmPhotoDetail):
+        """
+        补全章节的元数据，章节所在本子开启了预取时，由预取器补全（或等待预取结果）
+        """
+        prefetcher = self._prefetcher_dict.get(photo)
+        if prefetcher is None:
+            return self.client.check_photo(photo)
+        return prefetcher.resolve(photo)
+
+    def create_prefetcher(self, photo_list, depth):
+        return PhotoPrefetcher(photo_list, depth, self.client.check_photo, self.get_executor('prefetch'))
+
     @catch_exception
     @record_download_duration('image_started_at')
     def download_by_image_detail(self, image: JmImageDetail):
         img_save_path = self.option.decide_image_filepath(image)
         image.save_path = img_save_path
-        image.exists = file_exists(img_save_path)
+        image.exists = self.check_image_exists(image, img_save_path)
         image.cache = self.option.decide_download_cache(image)
 
         self.before_image(image, img_save_path)
@@ -500,12 +986,13 @@ class JmDownloader(BaseDownloader):
             self.after_image(image, img_save_path)
             return
 
-        decode_image = self.option.decide_download_image_decode(image)
-        self.client.download_by_image_detail(
-            image,
-            img_save_path,
-            decode_image=decode_image,
-        )
+        decode_image = self.decide_image_decode(image, img_save_path)
+        with self.image_limiter.slot() if self.image_limiter is not None else nullcontext():
+            self.client.download_by_image_detail(
+                image,
+                img_save_path,
+                decode_image=decode_image,
+            )
 
         self.after_image(image, img_save_path)
 
@@ -517,6 +1004,13 @@ class JmDownloader(BaseDownloader):
         """
         调度本子/章节的下载
         """
+        if isinstance(iter_objs, JmAlbumDetail):
+            level = 'photo'
+        elif isinstance(iter_objs, JmPhotoDetail):
+            level = 'image'
+        else:
+            level = None
+
         iter_objs = self.do_filter(iter_objs)
         count_real = len(iter_objs)
 
@@ -525,7 +1019,20 @@ class JmDownloader(BaseDownloader):
 
         apply = bind_jm_task_context(apply)
 
-        if count_batch >= count_real:
+        if level is not None:
+            # 章节在下载图片的同时，预取之后章节的元数据
+            prefetcher = self.begin_prefetch(iter_objs) if level == 'photo' else None
+            try:
+                # 提交到该层级的共享线程池
+                self.execute_in_executor(
+                    executor=self.get_executor(level),
+                    iter_objs=iter_objs,
+                    apply=apply,
+                    count_batch=count_batch,
+                )
+            finally:
+                self.end_prefetch(prefetcher)
+        elif count_batch >= count_real:
             # 一个图/章节 对应 一个线程
             multi_thread_launcher(
                 iter_objs=iter_objs,
@@ -539,12 +1046,78 @@ class JmDownloader(BaseDownloader):
                 max_workers=count_batch,
             )
 
+    def get_executor(self, level: str) -> ThreadPoolExecutor:
+        """
+        返回 photo / image 层级共享的线程池，线程数为 download.threading.{level}。
+
+        所有章节的图片任务都提交到同一个图片线程池，总并发是一个全局上限，而不是 章节数 × 图片数，
+        线程在池中复用，预热后不再反复创建线程。
+        download.threading.scope 为 process 时，进程内所有下载器共用线程池（例如 download_batch），
+        默认为 downloader，每个下载器一个，最外层的下载结束或下载器退出时关闭。
+        """
+        max_workers = getattr(self.option.download.threading, level)
+        if level == 'image' and self.image_limiter is not None:
+            # 线程数取上限，实际并发由 image_limiter 控制
+            max_workers = self.image_limiter.ceiling
+        scope = self._threading_config(self.option, 'scope', 'downloader')
+
+        if scope == 'process':
+            executor_dict, lock, key = self._process_executor_dict, self._process_executor_lock, (level, max_workers)
+        else:
+            ExceptionTool.require_true(scope == 'downloader', f'不支持的 download.threading.scope: {scope}')
+            executor_dict, lock, key = self._executor_dict, self._executor_lock, level
+
+        executor = executor_dict.get(key)
+        if executor is None:
+            with lock:
+                executor = executor_dict.get(key)
+                if executor is None:
+                    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'jm_{level}')
+                    executor_dict[key] = executor
+        return executor
+
+    @staticmethod
+    def execute_in_executor(executor: ThreadPoolExecutor,
+                            iter_objs: Iterable,
+                            apply: Callable,
+                            count_batch: int,
+                            ):
+        """
+        把任务提交到共享线程池并等待完成，同一批任务最多 count_batch 个同时在池中。
+        """
+        window = threading.BoundedSemaphore(max(1, count_batch))
+
+        def do_work(obj):
+            try:
+                apply(obj)
+            except BaseException:
+                traceback_print_exec()
+            finally:
+                window.release()
+
+        future_list = []
+        for obj in iter_objs:
+            window.acquire()
+            future_list.append(executor.submit(do_work, obj))
+
+        for future in future_list:
+            future.result()
+
+    def shutdown(self):
+        """关闭下载器自己的线程池，进程共享的线程池不受影响"""
+        executor_dict, self._executor_dict = self._executor_dict or {}, {}
+        for executor in executor_dict.values():
+            executor.shutdown(wait=False)
+
     # 下面是对with语法的支持
 
     def __enter__(self):
+        self._entered = True
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self._entered = False
+        self.shutdown()
         if exc_type is not None:
             jm_log('dler.exception',
                    f'{self.__class__.__name__} Exit with exception: {exc_type, str(exc_val)}'
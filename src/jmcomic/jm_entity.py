@@ -201,6 +201,106 @@ class DetailEntity(JmBaseEntity, IndexedEntity):
 
         return result
 
+    def snapshot(self) -> 'EntitySnapshot':
+        """
+        返回当前状态的不可变快照，客户端缓存保存的是快照，见 EntitySnapshot
+        """
+        return EntitySnapshot(self)
+
+
+class FrozenValue:
+    """
+    EntitySnapshot 中冻结后的 list / dict / set / tuple。
+    flat 表示元素全部不可变，还原时直接 list(items) / dict(items)，不用逐个还原元素
+    """
+
+    __slots__ = ('kind', 'items', 'flat')
+
+    def __init__(self, kind: str, items, flat: bool):
+        self.kind = kind
+        self.items = items
+        self.flat = flat
+
+
+class EntitySnapshot:
+    """
+    实体的不可变快照，用于客户端缓存。
+
+    缓存命中时需要返回独立的实体（调用方会修改 save_path、from_album 等字段），以前是存、取各 deepcopy 一次。
+    快照创建时把实体字段中的 list / dict 冻结为元组，str、int、tuple 等不可变的字段直接共享；
+    materialize 只需要为可变字段重建 list / dict，就能得到一个新的实体，开销比 deepcopy 小得多。
+    """
+
+    __slots__ = ('clazz', 'shared', 'frozen')
+
+    IMMUTABLE_TYPES = (str, int, float, bool, bytes, type(None))
+
+    def __init__(self, entity: DetailEntity):
+        self.clazz = type(entity)
+        self.shared = {}  # 不可变字段，所有实体共享
+        self.frozen = {}  # 可变字段冻结后的值，还原时重建
+        for k, v in entity.__dict__.items():
+            if self.is_immutable(v):
+                self.shared[k] = v
+            else:
+                self.frozen[k] = self.freeze(v)
+
+    @classmethod
+    def is_immutable(cls, v) -> bool:
+        if type(v) is tuple:
+            return all(cls.is_immutable(e) for e in v)
+        return type(v) in cls.IMMUTABLE_TYPES
+
+    @classmethod
+    def freeze(cls, v):
+        if cls.is_immutable(v):
+            return v
+        if isinstance(v, DetailEntity):
+            return EntitySnapshot(v)
+
+        if isinstance(v, dict):
+            items = tuple((k, cls.freeze(e)) for k, e in v.items())
+            return FrozenValue('dict', items, all(cls.is_immutable(e) for e in v.values()))
+        for kind, clazz in (('list', list), ('tuple', tuple), ('set', set)):
+            if isinstance(v, clazz):
+                items = tuple(cls.freeze(e) for e in v)
+                return FrozenValue(kind, items, all(cls.is_immutable(e) for e in v))
+
+        # 其他类型的对象（例如用户自定义字段）无法冻结，还原时 deepcopy
+        from copy import deepcopy
+        return FrozenValue('object', deepcopy(v), False)
+
+    @classmethod
+    def thaw(cls, v):
+        if type(v) is EntitySnapshot:
+            return v.materialize()
+        if type(v) is not FrozenValue:
+            return v
+
+        kind, items = v.kind, v.items
+        if kind == 'dict':
+            return dict(items) if v.flat else {k: cls.thaw(e) for k, e in items}
+        if kind == 'list':
+            return list(items) if v.flat else [cls.thaw(e) for e in items]
+        if kind == 'tuple':
+            return tuple(cls.thaw(e) for e in items)
+        if kind == 'set':
+            return set(items) if v.flat else {cls.thaw(e) for e in items}
+
+        from copy import deepcopy
+        return deepcopy(items)
+
+    def materialize(self) -> DetailEntity:
+        """
+        返回一个新的实体，与快照和其他 materialize 出来的实体互不影响
+        """
+        entity = self.clazz.__new__(self.clazz)
+        state = entity.__dict__
+        state.update(self.shared)
+        for k, v in self.frozen.items():
+            state[k] = self.thaw(v)
+        return entity
+
 
 class JmImageDetail(JmBaseEntity, Downloadable):
 
@@ -228,6 +328,7 @@ class JmImageDetail(JmBaseEntity, Downloadable):
         self.from_photo: 'JmPhotoDetail' = from_photo  # type: ignore
         self.query_params: Optional[str] = query_params
         self.index = index  # 从1开始
+        self.passthrough = False  # 本次下载是否原样写入图片字节（无需解密和格式转换）
 
     @property
     def filename_without_suffix(self):
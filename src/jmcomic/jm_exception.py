@@ -1,6 +1,7 @@
 # 该文件存放jmcomic的异常机制设计和实现
 from __future__ import annotations
 
+import pickle
 from typing import NoReturn
 
 from .jm_entity import *
@@ -20,6 +21,17 @@ class JmcomicException(Exception):
     def __str__(self):
         return self.msg
 
+    def __reduce__(self):
+        # 多进程下载时异常需要传回父进程，context 中不能 pickle 的值（例如 downloader、resp）会被丢弃
+        context = {}
+        for k, v in self.context.items():
+            try:
+                pickle.dumps(v)
+            except Exception:
+                continue
+            context[k] = v
+        return self.__class__, (self.msg, context)
+
 
 class ResponseUnexpectedException(JmcomicException):
     description = '响应不符合预期异常'
@@ -72,6 +84,10 @@ class PartialDownloadFailedException(JmcomicException):
         return self.from_context(ExceptionTool.CONTEXT_KEY_DOWNLOADER)
 
 
+class LeaseLostException(JmcomicException):
+    description = '租约已被其他节点接手异常'
+
+
 class ExceptionTool:
     """
     抛异常的工具
@@ -0,0 +1,494 @@
+"""
+持久化下载任务队列
+
+队列保存在一个 SQLite 文件中，每一行是一个下载任务（本子或章节），JmQueueWorker 反复领取任务并用异步下载器下载：
+
+- 优先级高的先下载，同优先级按本子页数从少到多（短任务优先），页数未知的排在最后
+- 数据库操作在 JmQueueWorker 的单独线程中执行，数据库被其他进程锁住时不会阻塞下载
+- 领取任务时加租约（lease），worker 崩溃后租约过期，任务会被其他 worker 重新领取
+- 下载失败按指数退避重试，超过最大次数后标记为 failed
+- 已完成的任务不会被重复添加和下载，worker 重启后从上次停下的地方继续
+"""
+import asyncio
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from .api import download_album_async, download_photo_async, new_async_engine
+from .jm_config import JmModuleConfig, jm_log
+from .jm_toolkit import JmcomicText, ExceptionTool
+from common import mkdir_if_not_exists, of_dir_path
+
+
+class JmJob(NamedTuple):
+    """队列中的一个下载任务"""
+    job_id: int
+    kind: str  # album / photo
+    jm_id: str
+    priority: int
+    page_count: Optional[int]
+    status: str
+    attempts: int
+    last_error: Optional[str]
+
+
+class JmJobQueue:
+    """
+    基于 SQLite 单文件的持久化下载任务队列。
+
+    使用 WAL 模式，每个线程（以及 fork 出的子进程）使用各自的连接，多个 worker 进程可以同时领取同一个队列的任务，
+    领取时使用 BEGIN IMMEDIATE 加写锁，同一个任务不会被两个 worker 同时领取。
+    """
+
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+
+    def __init__(self,
+                 path: str,
+                 lease_seconds: float = 600,
+                 max_attempts: int = 5,
+                 backoff_base: float = 30,
+                 backoff_max: float = 3600,
+                 ):
+        """
+        :param path: 队列文件路径
+        :param lease_seconds: 租约时长，worker 需要在租约过期前续约（见 renew），否则任务会被重新领取
+        :param max_attempts: 最大尝试次数，超过后任务标记为 failed
+        :param backoff_base: 第 n 次失败后等待 backoff_base * 2^(n-1) 秒再重试
+        :param backoff_max: 重试等待时间的上限
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._local = threading.local()
+        mkdir_if_not_exists(of_dir_path(path))
+        with self._conn() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS job ('
+                         'job_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'kind TEXT NOT NULL, '
+                         'jm_id TEXT NOT NULL, '
+                         'priority INTEGER NOT NULL DEFAULT 0, '
+                         'page_count INTEGER, '
+                         'status TEXT NOT NULL, '
+                         'attempts INTEGER NOT NULL DEFAULT 0, '
+                         'available_at REAL NOT NULL, '
+                         'lease_owner TEXT, '
+                         'lease_until REAL, '
+                         'last_error TEXT, '
+                         'created_at REAL NOT NULL, '
+                         'started_at REAL, '
+                         'finished_at REAL, '
+                         'estimated INTEGER NOT NULL DEFAULT 0, '
+                         'UNIQUE (kind, jm_id))')
+            conn.execute('CREATE INDEX IF NOT EXISTS job_claim ON job (status, priority, page_count)')
+            if 'estimated' not in {row[1] for row in conn.execute('PRAGMA table_info(job)')}:
+                # 旧版本创建的队列文件
+                conn.execute('ALTER TABLE job ADD COLUMN estimated INTEGER NOT NULL DEFAULT 0')
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        return _Transaction(conn)
+
+    @staticmethod
+    def _to_job(row) -> JmJob:
+        return JmJob(*row)
+
+    _JOB_COLUMNS = 'job_id, kind, jm_id, priority, page_count, status, attempts, last_error'
+
+    # 添加任务
+
+    def put(self,
+            jm_id,
+            kind: str = 'album',
+            priority: int = 0,
+            page_count: Optional[int] = None,
+            ) -> bool:
+        """
+        添加一个任务，返回是否新添加。
+
+        任务已存在时不会重复添加（包括已完成的任务），还没完成的任务会取较高的优先级、补上页数；
+        已经 failed 的任务会重新放回队列。
+        """
+        ExceptionTool.require_true(kind in ('album', 'photo'), f'不支持的任务类型: {kind}')
+        jm_id = JmcomicText.parse_to_jm_id(jm_id)
+        now = time.time()
+        with self._transaction() as conn:
+            inserted = conn.execute(
+                'INSERT OR IGNORE INTO job (kind, jm_id, priority, page_count, status, available_at, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (kind, jm_id, priority, page_count, self.STATUS_PENDING, now, now),
+            ).rowcount == 1
+            if not inserted:
+                conn.execute(
+                    'UPDATE job SET priority = MAX(priority, ?), page_count = COALESCE(page_count, ?), '
+                    'status = CASE status WHEN ? THEN ? ELSE status END, '
+                    'attempts = CASE status WHEN ? THEN 0 ELSE attempts END, '
+                    'available_at = CASE status WHEN ? THEN ? ELSE available_at END '
+                    'WHERE kind = ? AND jm_id = ? AND status != ?',
+                    (priority, page_count,
+                     self.STATUS_FAILED, self.STATUS_PENDING,
+                     self.STATUS_FAILED,
+                     self.STATUS_FAILED, now,
+                     kind, jm_id, self.STATUS_DONE),
+                )
+        return inserted
+
+    def put_many(self, jm_id_iter: Iterable, kind: str = 'album', priority: int = 0) -> int:
+        """批量添加任务，返回新添加的任务数"""
+        return sum(self.put(jm_id, kind, priority) for jm_id in jm_id_iter)
+
+    def list_unknown_page_count(self, limit: int) -> List[JmJob]:
+        """页数未知、还没有估计过页数的待下载本子任务，按领取顺序"""
+        return [self._to_job(row) for row in self._conn().execute(
+            f'SELECT {self._JOB_COLUMNS} FROM job '
+            'WHERE kind = ? AND status = ? AND page_count IS NULL AND estimated = 0 '
+            'ORDER BY priority DESC, job_id LIMIT ?',
+            ('album', self.STATUS_PENDING, limit),
+        )]
+
+    def set_page_count(self, job_id: int, page_count: Optional[int]):
+        """
+        记录本子的页数，用于短任务优先排序，同时把任务标记为已估计过页数。
+        page_count 为 None（获取失败或页数未知）时页数仍为 NULL，排在最后，之后也不会再估计
+        """
+        with self._conn() as conn:
+            conn.execute('UPDATE job SET page_count = COALESCE(?, page_count), estimated = 1 WHERE job_id = ?',
+                         (page_count, job_id))
+
+    # 领取和完成任务
+
+    def claim(self, worker_id: str, limit: int = 1) -> List[JmJob]:
+        """
+        领取最多 limit 个可以执行的任务：到了重试时间的 pending 任务，以及租约已过期的 running 任务。
+        领取后任务变为 running，尝试次数加一，租约属于 worker_id。
+
+        租约过期的 running 任务已经用完 max_attempts 次尝试时（例如 worker 每次都在下载中途崩溃），
+        直接标记为 failed，不再领取。
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE job SET status = ?, lease_owner = NULL, lease_until = NULL, last_error = ? '
+                'WHERE status = ? AND lease_until < ? AND attempts >= ?',
+                (self.STATUS_FAILED, f'租约过期，已尝试{self.max_attempts}次',
+                 self.STATUS_RUNNING, now, self.max_attempts),
+            )
+            row_list = conn.execute(
+                f'SELECT {self._JOB_COLUMNS} FROM job '
+                'WHERE (status = ? AND available_at <= ?) OR (status = ? AND lease_until < ?) '
+                'ORDER BY priority DESC, page_count IS NULL, page_count, job_id '
+                'LIMIT ?',
+                (self.STATUS_PENDING, now, self.STATUS_RUNNING, now, limit),
+            ).fetchall()
+
+            job_list = []
+            for row in row_list:
+                job = self._to_job(row)
+                conn.execute(
+                    'UPDATE job SET status = ?, attempts = attempts + 1, lease_owner = ?, lease_until = ?, '
+                    'started_at = ? WHERE job_id = ?',
+                    (self.STATUS_RUNNING, worker_id, now + self.lease_seconds, now, job.job_id),
+                )
+                job_list.append(job._replace(status=self.STATUS_RUNNING, attempts=job.attempts + 1))
+            return job_list
+
+    def renew(self, worker_id: str) -> int:
+        """为 worker_id 持有的所有任务续约，返回续约的任务数"""
+        with self._conn() as conn:
+            return conn.execute(
+                'UPDATE job SET lease_until = ? WHERE status = ? AND lease_owner = ?',
+                (time.time() + self.lease_seconds, self.STATUS_RUNNING, worker_id),
+            ).rowcount
+
+    def complete(self, job: JmJob, worker_id: str) -> bool:
+        """
+        标记任务完成。租约已被其他 worker 接手时返回 False，不修改任务。
+        """
+        with self._conn() as conn:
+            return conn.execute(
+                'UPDATE job SET status = ?, lease_owner = NULL, lease_until = NULL, last_error = NULL, finished_at = ? '
+                'WHERE job_id = ? AND status = ? AND lease_owner = ?',
+                (self.STATUS_DONE, time.time(), job.job_id, self.STATUS_RUNNING, worker_id),
+            ).rowcount == 1
+
+    def fail(self, job: JmJob, worker_id: str, error: BaseException) -> bool:
+        """
+        记录任务失败。还没达到最大尝试次数时按指数退避放回队列，否则标记为 failed。
+        租约已被其他 worker 接手时返回 False，不修改任务。
+        """
+        now = time.time()
+        if job.attempts >= self.max_attempts:
+            status, available_at = self.STATUS_FAILED, now
+        else:
+            status = self.STATUS_PENDING
+            available_at = now + min(self.backoff_base * 2 ** (job.attempts - 1), self.backoff_max)
+
+        with self._conn() as conn:
+            return conn.execute(
+                'UPDATE job SET status = ?, available_at = ?, lease_owner = NULL, lease_until = NULL, last_error = ? '
+                'WHERE job_id = ? AND status = ? AND lease_owner = ?',
+                (status, available_at, f'{type(error).__name__}: {error}',
+                 job.job_id, self.STATUS_RUNNING, worker_id),
+            ).rowcount == 1
+
+    def release(self, worker_id: str) -> int:
+        """
+        worker 正常退出时放回它还没完成的任务，不计入尝试次数，返回放回的任务数
+        """
+        with self._conn() as conn:
+            return conn.execute(
+                'UPDATE job SET status = ?, attempts = MAX(attempts - 1, 0), available_at = ?, '
+                'lease_owner = NULL, lease_until = NULL WHERE status = ? AND lease_owner = ?',
+                (self.STATUS_PENDING, time.time(), self.STATUS_RUNNING, worker_id),
+            ).rowcount
+
+    # 查询
+
+    def get(self, jm_id, kind: str = 'album') -> Optional[JmJob]:
+        row = self._conn().execute(
+            f'SELECT {self._JOB_COLUMNS} FROM job WHERE kind = ? AND jm_id = ?',
+            (kind, JmcomicText.parse_to_jm_id(jm_id)),
+        ).fetchone()
+        return None if row is None else self._to_job(row)
+
+    def list_jobs(self, status: Optional[str] = None) -> List[JmJob]:
+        sql = f'SELECT {self._JOB_COLUMNS} FROM job'
+        args = ()
+        if status is not None:
+            sql, args = sql + ' WHERE status = ?', (status,)
+        return [self._to_job(row) for row in self._conn().execute(sql + ' ORDER BY job_id', args)]
+
+    def depth(self) -> int:
+        """还没完成的任务数（pending + running）"""
+        return self._conn().execute(
+            'SELECT COUNT(*) FROM job WHERE status IN (?, ?)',
+            (self.STATUS_PENDING, self.STATUS_RUNNING),
+        ).fetchone()[0]
+
+    def stats(self, window: float = 3600) -> Dict[str, float]:
+        """
+        队列统计：
+        - pending / running / done / failed: 各状态的任务数
+        - ready: 现在就可以领取的 pending 任务数（不含等待重试的）
+        - done_in_window: 最近 window 秒完成的任务数
+        - throughput: 最近 window 秒的吞吐量（任务数/分钟）
+        - avg_duration: 最近 window 秒完成的任务的平均耗时（秒）
+        """
+        now = time.time()
+        conn = self._conn()
+        stats = {status: 0 for status in (self.STATUS_PENDING, self.STATUS_RUNNING, self.STATUS_DONE, self.STATUS_FAILED)}
+        for status, count in conn.execute('SELECT status, COUNT(*) FROM job GROUP BY status'):
+            stats[status] = count
+
+        stats['ready'] = conn.execute(
+            'SELECT COUNT(*) FROM job WHERE status = ? AND available_at <= ?',
+            (self.STATUS_PENDING, now),
+        ).fetchone()[0]
+        done_count, avg_duration = conn.execute(
+            'SELECT COUNT(*), AVG(finished_at - started_at) FROM job WHERE status = ? AND finished_at >= ?',
+            (self.STATUS_DONE, now - window),
+        ).fetchone()
+        stats['done_in_window'] = done_count
+        stats['throughput'] = done_count * 60 / window
+        stats['avg_duration'] = avg_duration or 0.0
+        return stats
+
+
+class _Transaction:
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        return self.conn
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.conn.execute('ROLLBACK' if exc_type is not None else 'COMMIT')
+
+
+class JmQueueWorker:
+    """
+    从 JmJobQueue 领取任务并下载的 worker。
+
+    所有任务共用一个异步下载引擎（见 JmAsyncDownloadEngine），同时下载的任务数为 concurrency，
+    持有任务期间定时续约，下载成功标记完成，失败按队列的重试策略放回队列。
+    """
+
+    def __init__(self,
+                 queue: JmJobQueue,
+                 option=None,
+                 downloader=None,
+                 concurrency: Optional[int] = None,
+                 worker_id: Optional[str] = None,
+                 poll_interval: float = 5,
+                 exit_when_empty: bool = False,
+                 estimate_page_count: bool = False,
+                 ):
+        """
+        :param queue: 任务队列
+        :param option: 下载选项
+        :param downloader: 异步下载器类
+        :param concurrency: 同时下载的任务数，默认为 download.threading.album，未配置时为8
+        :param worker_id: worker 标识，用于租约，默认为 主机名:进程号
+        :param poll_interval: 队列中没有可领取的任务时，隔多久再查询一次（秒）
+        :param exit_when_empty: 为 True 时，队列中没有未完成的任务就退出
+        :param estimate_page_count: 为 True 时，领取任务前先请求页数未知的本子的详情，记录页数，使短任务优先对这些本子也生效。
+                                    会多请求一次本子详情，建议同时开启客户端缓存（client.cache）
+        """
+        if option is None:
+            option = JmModuleConfig.option_class().default()
+
+        if concurrency is None:
+            from .jm_downloader import BaseDownloader
+            concurrency = BaseDownloader._threading_config(option, 'album', None) or 8
+
+        self.queue = queue
+        self.option = option
+        self.downloader = downloader
+        self.concurrency = int(concurrency)
+        ExceptionTool.require_true(self.concurrency > 0, f'concurrency 必须大于0: {concurrency}')
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+        self.poll_interval = poll_interval
+        self.exit_when_empty = exit_when_empty
+        self.estimate_page_count = estimate_page_count
+        self.engine = None
+        self.done_count = 0
+        self.failed_count = 0
+        self._stop = False
+        # 执行队列操作的线程，sqlite3 的调用（数据库被锁时最长等待 30 秒）不在事件循环中执行
+        self._queue_executor: Optional[ThreadPoolExecutor] = None
+
+    def stop(self):
+        """领取完当前任务后不再领取新任务，等待正在下载的任务完成后退出"""
+        self._stop = True
+
+    async def download_job(self, job: JmJob):
+        """下载一个任务，返回下载结果"""
+        download_api = download_album_async if job.kind == 'album' else download_photo_async
+        kwargs = {} if self.engine is None else {'engine': self.engine}
+        return await download_api(job.jm_id, self.option, self.downloader, **kwargs)
+
+    async def call_queue(self, func, *args):
+        """在队列线程中执行 self.queue 的方法"""
+        if self._queue_executor is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._queue_executor, func, *args)
+
+    async def run_job(self, job: JmJob):
+        jm_log('queue.job.start', f'开始下载任务: [{job.kind} {job.jm_id}], 第{job.attempts}次尝试')
+        try:
+            result = await self.download_job(job)
+        except Exception as e:
+            self.failed_count += 1
+            await self.call_queue(self.queue.fail, job, self.worker_id, e)
+            jm_log('queue.job.failed', f'任务下载失败: [{job.kind} {job.jm_id}], 异常: [{e}]', e)
+            return
+
+        detail = result.detail
+        if job.kind == 'album' and job.page_count is None and getattr(detail, 'page_count', None):
+            await self.call_queue(self.queue.set_page_count, job.job_id, int(detail.page_count))
+        self.done_count += 1
+        await self.call_queue(self.queue.complete, job, self.worker_id)
+        jm_log('queue.job.done', f'任务下载完成: [{job.kind} {job.jm_id}]')
+
+    async def estimate(self, limit: int):
+        """
+        请求页数未知的本子的详情，记录页数。
+        每个任务只估计一次，获取失败或页数未知的任务页数仍为 NULL，排在同优先级的最后
+        """
+        client = getattr(self.engine, 'client', None)
+        if client is None:
+            return
+
+        async def estimate_one(job: JmJob):
+            page_count = None
+            try:
+                album = await client.get_album_detail(job.jm_id)
+                page_count = int(album.page_count or 0) or None
+            except Exception as e:
+                jm_log('queue.job.estimate', f'获取本子页数失败: [{job.jm_id}], 异常: [{e}]', e)
+            await self.call_queue(self.queue.set_page_count, job.job_id, page_count)
+
+        job_list = await self.call_queue(self.queue.list_unknown_page_count, limit)
+        await asyncio.gather(*(estimate_one(job) for job in job_list))
+
+    async def _renew_forever(self):
+        """
+        每过租约时长的三分之一续约一次。续约失败时记录日志并重试，
+        超过一个租约时长都没有续约成功（租约已经过期，任务可能被其他 worker 接手）时抛出异常，由 run() 停止。
+        """
+        last_renewed = time.monotonic()
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            try:
+                await self.call_queue(self.queue.renew, self.worker_id)
+                last_renewed = time.monotonic()
+            except Exception as e:
+                jm_log('queue.renew.failed', f'任务续约失败: [{self.worker_id}], 异常: [{e}]', e)
+                if time.monotonic() - last_renewed >= self.queue.lease_seconds:
+                    raise
+
+    async def run(self):
+        """持续领取并下载任务，直到 stop() 或队列为空（exit_when_empty）"""
+        self.engine = new_async_engine(self.option, self.downloader)
+        if self.engine is not None:
+            await self.engine.__aenter__()
+
+        self._queue_executor = ThreadPoolExecutor(1, thread_name_prefix='jm-queue')
+        renew_task = asyncio.ensure_future(self._renew_forever())
+        pending = set()
+        try:
+            while True:
+                if renew_task.done():
+                    # 续约失败，租约已经过期，不再领取任务，正在下载的任务在 finally 中取消
+                    renew_task.result()
+
+                if not self._stop and len(pending) < self.concurrency:
+                    if self.estimate_page_count:
+                        await self.estimate(self.concurrency)
+                    for job in await self.call_queue(self.queue.claim, self.worker_id, self.concurrency - len(pending)):
+                        pending.add(asyncio.ensure_future(self.run_job(job)))
+
+                if not pending:
+                    if self._stop or (self.exit_when_empty and await self.call_queue(self.queue.depth) == 0):
+                        break
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+
+                done, _ = await asyncio.wait(pending | {renew_task}, timeout=self.poll_interval,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                pending -= done
+        finally:
+            renew_task.cancel()
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            # 没有完成的任务放回队列，下次启动时继续
+            await self.call_queue(self.queue.release, self.worker_id)
+            self._queue_executor.shutdown(wait=False)
+            self._queue_executor = None
+            if self.engine is not None:
+                await self.engine.__aexit__(None, None, None)
+                self.engine = None
+
+    def run_forever(self):
+        asyncio.run(self.run())
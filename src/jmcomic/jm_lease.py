@@ -0,0 +1,435 @@
+"""
+多节点租约协调
+
+多台机器（或多个进程）对同一个下载目录（例如挂载的 NFS）下载同一批本子时，用租约文件分配任务：
+
+- 租约文件保存在 {base_dir}/.jmcomic_lease/ 下，一个本子 / 章节一个文件，用 O_EXCL 原子创建，只有一个节点能创建成功
+- 持有租约期间定时续约，节点崩溃后租约过期，其他节点可以接手
+- 下载成功后写一个完成标记，其他节点不会重复下载；下载失败时释放租约，由其他节点重试
+- 完成标记默认一直有效，可以设置有效期（done_ttl），或者用 clear_done / redo 清除后重新下载
+
+没有使用 SQLite：SQLite 的 WAL 模式依赖共享内存，不能用于网络文件系统。
+租约的过期时间按各节点的本地时钟计算，节点之间的时钟需要同步（例如开启 NTP）。
+"""
+import asyncio
+import json
+import os
+import socket
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from .api import download_album, download_photo, download_album_async, download_photo_async, new_async_engine
+from .api import _iter_jm_id, _download_type
+from .jm_config import JmModuleConfig, jm_log
+from .jm_downloader import BatchResult
+from .jm_exception import LeaseLostException
+from .jm_toolkit import ExceptionTool, JmImageTool
+from common import mkdir_if_not_exists
+
+
+class JmLeaseDir:
+    """
+    基于租约文件的任务分配，适用于共享的（网络）文件系统。
+
+    每个任务对应两个文件：
+    - {kind}_{jm_id}.lease：租约，内容为持有者、令牌和过期时间
+    - {kind}_{jm_id}.done：完成标记，按文件修改时间计算有效期（done_ttl），过期后视为没有完成
+
+    接手过期租约、续约、释放时需要先创建 .guard 文件（同样用 O_EXCL），保证读-改-写期间不会有其他节点同时修改租约。
+    """
+
+    lease_dirname = '.jmcomic_lease'
+
+    def __init__(self,
+                 lease_dir: str,
+                 lease_seconds: float = 600,
+                 owner: Optional[str] = None,
+                 done_ttl: Optional[float] = None,
+                 ):
+        """
+        :param lease_dir: 租约文件所在目录，所有节点需要使用同一个目录
+        :param lease_seconds: 租约时长（秒），持有者超过这个时间没有续约，租约可以被其他节点接手
+        :param owner: 持有者标识，默认为 主机名:进程号
+        :param done_ttl: 完成标记的有效期（秒），超过有效期的本子会被重新下载，默认为 None，完成标记一直有效
+        """
+        self.lease_dir = lease_dir
+        self.lease_seconds = lease_seconds
+        self.done_ttl = done_ttl
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+        # 本节点持有的租约 -> 令牌
+        self._held: Dict[str, str] = {}
+        mkdir_if_not_exists(lease_dir)
+
+    @classmethod
+    def of_option(cls, option, **kwargs) -> 'JmLeaseDir':
+        """使用 {dir_rule.base_dir}/.jmcomic_lease 作为租约目录"""
+        return cls(os.path.join(option.dir_rule.base_dir, cls.lease_dirname), **kwargs)
+
+    @staticmethod
+    def key(kind: str, jm_id) -> str:
+        return f'{kind}_{jm_id}'
+
+    def lease_path(self, key: str) -> str:
+        return os.path.join(self.lease_dir, f'{key}.lease')
+
+    def done_path(self, key: str) -> str:
+        return os.path.join(self.lease_dir, f'{key}.done')
+
+    # 查询
+
+    def is_done(self, key: str) -> bool:
+        """有完成标记，且没有超过 done_ttl"""
+        try:
+            mtime = os.stat(self.done_path(key)).st_mtime
+        except FileNotFoundError:
+            return False
+        return self.done_ttl is None or mtime + self.done_ttl > time.time()
+
+    def holding(self) -> List[str]:
+        return list(self._held)
+
+    def holder(self, key: str) -> Optional[dict]:
+        """返回租约内容（owner、token、expires_at），没有租约时返回 None"""
+        try:
+            with open(self.lease_path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            # 租约文件刚创建还没写完，视为被持有
+            return {}
+
+    def _expired(self, path: str, lease: Optional[dict]) -> bool:
+        if lease is None:
+            return True
+        now = time.time()
+        if 'expires_at' in lease:
+            return lease['expires_at'] <= now
+        # 内容不完整（持有者在创建后、写入前崩溃），按文件修改时间计算
+        try:
+            return os.stat(path).st_mtime + self.lease_seconds <= now
+        except FileNotFoundError:
+            return True
+
+    def _new_lease(self, token: str) -> bytes:
+        return json.dumps({
+            'owner': self.owner,
+            'token': token,
+            'expires_at': time.time() + self.lease_seconds,
+        }).encode('utf-8')
+
+    @contextmanager
+    def _guard(self, key: str, retry: int = 0):
+        """
+        创建 .guard 文件，with 块内独占该租约的读-改-写。创建失败时 as 的值为 False。
+        接手中途崩溃留下的 .guard 文件超过租约时长后会被删除。
+        """
+        path = os.path.join(self.lease_dir, f'{key}.guard')
+        for i in range(retry + 1):
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                if self._expired(path, {}):
+                    self._remove(path)
+                elif i < retry:
+                    time.sleep(0.05)
+        else:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    # 修改
+
+    def try_acquire(self, key: str) -> bool:
+        """
+        尝试获取租约。已完成、被其他节点持有且没有过期时返回 False。
+        """
+        if self.is_done(key):
+            return False
+
+        path = self.lease_path(key)
+        token = uuid.uuid4().hex
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not self._expired(path, self.holder(key)):
+                return False
+
+            with self._guard(key) as ok:
+                # 持有 guard 后重新检查，其他节点可能刚刚接手
+                if not ok or not self._expired(path, self.holder(key)) or self.is_done(key):
+                    return False
+                JmImageTool.save_bytes(self._new_lease(token), path)
+            jm_log('lease.takeover', f'接手过期的租约: [{key}]')
+        else:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._new_lease(token))
+
+        self._held[key] = token
+        # 其他节点可能在上面的 is_done 检查之后写完成标记、删除租约，这里再检查一次，避免重复下载
+        if self.is_done(key):
+            self.release(key)
+            return False
+        return True
+
+    def renew(self) -> List[str]:
+        """
+        为本节点持有的所有租约续约，返回已经被其他节点接手（丢失）的租约。
+        """
+        lost = []
+        for key, token in list(self._held.items()):
+            with self._guard(key, retry=3) as ok:
+                if not ok:
+                    # 这一轮续约不了，下一轮再续约
+                    continue
+                if (self.holder(key) or {}).get('token') != token:
+                    lost.append(key)
+                    continue
+                JmImageTool.save_bytes(self._new_lease(token), self.lease_path(key))
+
+        for key in lost:
+            self._held.pop(key, None)
+            jm_log('lease.lost', f'租约已被其他节点接手: [{key}]')
+        return lost
+
+    def release(self, key: str, done: bool = False):
+        """
+        释放租约。done 为 True 时先写完成标记，其他节点不会再下载该任务。
+        """
+        token = self._held.pop(key, None)
+        if done:
+            JmImageTool.save_bytes(self.owner.encode('utf-8'), self.done_path(key))
+        if token is None:
+            return
+
+        with self._guard(key, retry=20) as ok:
+            if ok and (self.holder(key) or {}).get('token') == token:
+                self._remove(self.lease_path(key))
+
+    def clear_done(self, key: str) -> bool:
+        """删除完成标记，之后该任务可以重新领取、下载。返回是否删除了完成标记"""
+        try:
+            os.remove(self.done_path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def release_all(self):
+        for key in list(self._held):
+            self.release(key)
+
+
+class JmLeaseWorker:
+    """
+    通过 JmLeaseDir 和其他节点分配任务并下载的 worker。
+
+    每个节点对同一批 id 运行 JmLeaseWorker，按顺序领取没有完成、没有被持有的 id，
+    被其他节点持有的 id 会定时重新检查：完成了就跳过，租约释放或过期了就领取。
+    所有任务共用一个异步下载引擎，同时下载的任务数为 concurrency，持有租约期间定时续约，
+    续约时发现租约已被其他节点接手的任务会被取消。
+    租约文件的读写（可能在网络文件系统上）都在一个单独的线程中执行，不阻塞事件循环中的下载。
+
+    注意：续约每过租约时长的三分之一才执行一次，本节点因为卡顿等原因没能按时续约、租约被其他节点接手后，
+    要到下一次续约时才会发现并取消下载。在这段时间（最长为租约时长的三分之一）内两个节点可能在下载同一个本子，
+    图片都是先写临时文件再原子重命名，不会写出损坏的文件，只是会重复下载一部分图片。
+    lease_seconds 需要明显大于节点可能卡顿的时长。
+    """
+
+    def __init__(self,
+                 lease: JmLeaseDir,
+                 option=None,
+                 downloader=None,
+                 kind: str = 'album',
+                 concurrency: Optional[int] = None,
+                 poll_interval: float = 5,
+                 redo: bool = False,
+                 ):
+        """
+        :param lease: 租约目录
+        :param option: 下载选项
+        :param downloader: 异步下载器类
+        :param kind: album / photo
+        :param concurrency: 同时下载的任务数，默认为 download.threading.album，未配置时为8
+        :param poll_interval: 没有可领取的 id 时，隔多久再检查一次被其他节点持有的 id（秒）
+        :param redo: 开始时删除这批 id 的完成标记，已经下载过的本子也会重新下载。
+                     多个节点协作时只需要在一个节点上使用（在其他节点启动之前），否则后启动的节点会删除先启动的节点刚写的完成标记
+        """
+        if option is None:
+            option = JmModuleConfig.option_class().default()
+
+        if concurrency is None:
+            from .jm_downloader import BaseDownloader
+            concurrency = BaseDownloader._threading_config(option, 'album', None) or 8
+
+        ExceptionTool.require_true(kind in ('album', 'photo'), f'不支持的任务类型: {kind}')
+        self.lease = lease
+        self.option = option
+        self.downloader = downloader
+        self.kind = kind
+        self.concurrency = int(concurrency)
+        ExceptionTool.require_true(self.concurrency > 0, f'concurrency 必须大于0: {concurrency}')
+        self.poll_interval = poll_interval
+        self.redo = redo
+        self.engine = None
+        # 已被其他节点完成的 id
+        self.skipped_list: List[str] = []
+        # 执行租约文件读写的线程
+        self._lease_executor: Optional[ThreadPoolExecutor] = None
+
+    async def download_one(self, jm_id: str):
+        """下载一个任务，返回下载结果"""
+        download_api = download_album_async if self.kind == 'album' else download_photo_async
+        kwargs = {} if self.engine is None else {'engine': self.engine}
+        return await download_api(jm_id, self.option, self.downloader, **kwargs)
+
+    def _claim(self, todo_list: List[str], limit: int) -> List[str]:
+        claimed = []
+        for jm_id in list(todo_list):
+            if len(claimed) >= limit:
+                break
+
+            key = self.lease.key(self.kind, jm_id)
+            if self.lease.is_done(key):
+                todo_list.remove(jm_id)
+                self.skipped_list.append(jm_id)
+            elif self.lease.try_acquire(key):
+                todo_list.remove(jm_id)
+                claimed.append(jm_id)
+        return claimed
+
+    def _clear_done(self, todo_list: List[str]):
+        for jm_id in todo_list:
+            self.lease.clear_done(self.lease.key(self.kind, jm_id))
+
+    async def call_lease(self, func, *args):
+        """在租约线程中执行租约文件的读写"""
+        if self._lease_executor is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._lease_executor, func, *args)
+
+    async def _renew_forever(self, task_dict: Dict[asyncio.Future, str]):
+        # 每过租约时长的三分之一续约一次，租约丢失的任务立即取消
+        while True:
+            await asyncio.sleep(self.lease.lease_seconds / 3)
+            lost = set(await self.call_lease(self.lease.renew))
+            for task, jm_id in task_dict.items():
+                if self.lease.key(self.kind, jm_id) in lost:
+                    task.cancel()
+
+    async def run(self, jm_id_iter) -> BatchResult:
+        """下载 jm_id_iter 中的所有 id，直到每个 id 都被本节点下载过或被其他节点完成"""
+        todo_list = list(_iter_jm_id(jm_id_iter))
+        result = BatchResult()
+
+        self.engine = new_async_engine(self.option, self.downloader)
+        if self.engine is not None:
+            await self.engine.__aenter__()
+
+        self._lease_executor = ThreadPoolExecutor(1, thread_name_prefix='jm-lease')
+        if self.redo:
+            await self.call_lease(self._clear_done, todo_list)
+        task_dict: Dict[asyncio.Future, str] = {}
+        renew_task = asyncio.ensure_future(self._renew_forever(task_dict))
+        try:
+            while True:
+                if len(task_dict) < self.concurrency:
+                    for jm_id in await self.call_lease(self._claim, todo_list, self.concurrency - len(task_dict)):
+                        task_dict[asyncio.ensure_future(self.download_one(jm_id))] = jm_id
+
+                if not task_dict:
+                    if not todo_list:
+                        break
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+
+                done, _ = await asyncio.wait(list(task_dict), timeout=self.poll_interval,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    await self.handle_done(task, task_dict.pop(task), result)
+        finally:
+            renew_task.cancel()
+            for task in task_dict:
+                task.cancel()
+            if task_dict:
+                await asyncio.gather(*task_dict, return_exceptions=True)
+            await asyncio.gather(renew_task, return_exceptions=True)
+            await self.call_lease(self.lease.release_all)
+            self._lease_executor.shutdown(wait=False)
+            self._lease_executor = None
+            if self.engine is not None:
+                await self.engine.__aexit__(None, None, None)
+                self.engine = None
+
+        return result
+
+    async def handle_done(self, task: asyncio.Future, jm_id: str, result: BatchResult):
+        key = self.lease.key(self.kind, jm_id)
+        if task.cancelled():
+            result.failed[jm_id] = LeaseLostException(f'租约已被其他节点接手，已取消下载: [{key}]', {})
+            return
+
+        e = task.exception()
+        if e is not None:
+            # 释放租约，由其他节点重试
+            await self.call_lease(self.lease.release, key)
+            result.failed[jm_id] = e
+            jm_log('lease.failed', f'下载失败: [{key}], 异常: [{e}]', e)
+            return
+
+        await self.call_lease(self.lease.release, key, True)
+        result.add(task.result())
+
+    def run_forever(self, jm_id_iter) -> BatchResult:
+        return asyncio.run(self.run(jm_id_iter))
+
+
+def download_batch_leased(download_api,
+                          jm_id_iter,
+                          option=None,
+                          downloader=None,
+                          lease_seconds: float = 600,
+                          poll_interval: float = 5,
+                          concurrency: Optional[int] = None,
+                          done_ttl: Optional[float] = None,
+                          redo: bool = False,
+                          ) -> BatchResult:
+    """
+    多节点协作批量下载 album / photo。每个节点对同一批 id 调用该函数，通过 {dir_rule.base_dir}/.jmcomic_lease 下的租约文件分配，
+    一个本子同一时间只会被一个节点下载，已完成的本子不会重复下载。
+
+    返回本节点下载的结果，失败项收集在 result.failed 中（失败的 id 会由其他还在运行的节点再尝试一次），
+    被其他节点完成的 id 既不在结果中也不在 failed 中。
+
+    :param done_ttl: 完成标记的有效期（秒），超过有效期的本子会被重新下载，默认一直有效
+    :param redo: 删除这批 id 的完成标记后再下载，见 JmLeaseWorker 的 redo 参数
+    """
+    if option is None:
+        option = JmModuleConfig.option_class().default()
+
+    ExceptionTool.require_true(download_api in (download_album, download_photo, download_album_async, download_photo_async),
+                               f'多节点批量下载只支持 download_album / download_photo: {download_api}')
+
+    worker = JmLeaseWorker(JmLeaseDir.of_option(option, lease_seconds=lease_seconds, done_ttl=done_ttl),
+                           option,
+                           downloader,
+                           kind=_download_type(download_api),
+                           concurrency=concurrency,
+                           poll_interval=poll_interval,
+                           redo=redo,
+                           )
+    return worker.run_forever(jm_id_iter)
@@ -0,0 +1,222 @@
+"""
+多进程分片批量下载
+
+单个进程的异步下载受限于一个 CPU 核（解析、解密、事件循环），批量下载大量本子时可以把 id 分片到多个进程：
+
+- 每个子进程用自己的事件循环和异步下载器（download_batch_async）下载一个分片
+- 限速（RateLimiter）和域名健康度（DomainHealthRegistry）放在一个共享状态进程中，各子进程通过本机 IPC 共用，
+  不会因为进程数变多而成倍放大请求速率。没有配置限速时请求不经过共享状态，域名统计在子进程中攒批后再同步，
+  异步下载中的 IPC 在线程池中执行
+- 父进程合并各分片的 DownloadResult / DownloadManifest，失败项和单进程的 download_batch 一样收集在 BatchResult.failed 中
+
+子进程使用 spawn 方式启动，调用方的脚本需要放在 if __name__ == '__main__': 下执行。
+"""
+import asyncio
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.managers import BaseManager
+from typing import Dict, List, Optional
+
+from .api import *
+from .api import _iter_jm_id
+
+
+class JmSharedState:
+    """
+    多进程下载时各进程共用的状态，运行在 JmSharedStateManager 启动的进程中，子进程通过代理调用。
+
+    方法直接调用本进程的 RateLimiter / DomainHealthRegistry，子进程中的 RateLimiter.shared_state、
+    DomainHealthRegistry.shared_state 设为该对象的代理后，令牌桶和域名统计就在这里汇总。
+    """
+
+    def configure(self, rate_limit: Optional[dict], domain_stat_dict: Dict[str, dict]):
+        RateLimiter.configure(rate_limit)
+        DomainHealthRegistry.merge(domain_stat_dict)
+
+    def reserve_request(self, url: str, is_image: bool) -> float:
+        return RateLimiter.reserve_request(url, is_image)
+
+    def reserve_bytes(self, url: str, is_image: bool, size: int) -> float:
+        return RateLimiter.reserve_bytes(url, is_image, size)
+
+    def record_domain_events(self, event_list: List[tuple]) -> Dict[str, dict]:
+        """
+        汇总子进程攒下的域名记录，event_list 的每一项为 (domain, latency)，latency 为 None 表示失败。
+        返回汇总后的全部域名统计
+        """
+        # 不在这里启动探测线程，降级后由发请求的子进程探测
+        for domain, latency in event_list:
+            if latency is None:
+                DomainHealthRegistry.apply_failure(domain)
+            else:
+                DomainHealthRegistry.apply_success(domain, latency)
+        return DomainHealthRegistry.snapshot()
+
+    def domain_snapshot(self) -> Dict[str, dict]:
+        return DomainHealthRegistry.snapshot()
+
+    def rate_limit_snapshot(self) -> Dict[str, dict]:
+        return RateLimiter.snapshot()
+
+
+class JmSharedStateManager(BaseManager):
+    pass
+
+
+JmSharedStateManager.register('JmSharedState', JmSharedState)
+
+
+def _init_shard_worker(shared_state):
+    RateLimiter.shared_state = shared_state
+    DomainHealthRegistry.shared_state = shared_state
+    DomainHealthRegistry.merge(shared_state.domain_snapshot())
+
+
+def _picklable_exception(e: BaseException) -> BaseException:
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        return JmcomicException(f'{e.__class__.__name__}: {e}', {})
+
+
+def _downloader_state(dler) -> tuple:
+    """下载器中可以 pickle 的部分：(manifest_dict, download_failed_photo, download_failed_image)"""
+    return (
+        dict(dler.manifest_dict),
+        [(photo, _picklable_exception(e)) for photo, e in dler.download_failed_photo],
+        [(image, _picklable_exception(e)) for image, e in dler.download_failed_image],
+    )
+
+
+def _rebuild_downloader(option, state: tuple):
+    """子进程的下载器无法传回父进程，用一个新的下载器承载它的清单和失败记录"""
+    manifest_dict, failed_photo, failed_image = state
+    dler = BaseDownloader(option)
+    dler.manifest_dict.update(manifest_dict)
+    dler.download_failed_photo.extend(failed_photo)
+    dler.download_failed_image.extend(failed_image)
+    return dler
+
+
+def _run_shard(download_api, jm_id_list: List[str], option_dict: dict, downloader, kwargs: dict) -> tuple:
+    """
+    子进程中下载一个分片，返回可以 pickle 的结果 (payload, 限速统计)，payload 的每一项为
+    ('ok', detail, downloader_state) 或 ('failed', jm_id, exception, downloader_state)，
+    异常的 context 中没有下载器时 downloader_state 为 None
+    """
+    # 限速统计在每个子进程中记录（没有配置限速的请求不经过共享状态），只统计这个分片
+    RateLimiter.reset()
+    option = JmModuleConfig.option_class().construct(option_dict)
+    try:
+        result = asyncio.run(download_batch_async(download_api, jm_id_list, option, downloader, **kwargs))
+    finally:
+        # 把还没同步的域名统计发给共享状态，父进程合并时才完整
+        DomainHealthRegistry.flush()
+
+    payload = []
+    for detail, dler in result:
+        state = _downloader_state(dler)
+        state[0].setdefault(detail, DownloadManifest())
+        payload.append(('ok', detail, state))
+    for jm_id, e in result.failed.items():
+        dler = e.context.get(ExceptionTool.CONTEXT_KEY_DOWNLOADER) if isinstance(e, JmcomicException) else None
+        state = _downloader_state(dler) if isinstance(dler, BaseDownloader) else None
+        payload.append(('failed', jm_id, _picklable_exception(e), state))
+    return payload, RateLimiter.snapshot()
+
+
+def _merge_shard(result: BatchResult, payload: list, option):
+    for item in payload:
+        if item[0] == 'failed':
+            _, jm_id, e, state = item
+            if state is not None and isinstance(e, JmcomicException):
+                # 例如 PartialDownloadFailedException，和单进程下载一样可以通过 e.downloader 读取下载结果
+                e.context[ExceptionTool.CONTEXT_KEY_DOWNLOADER] = _rebuild_downloader(option, state)
+            result.failed[jm_id] = e
+            continue
+
+        _, detail, state = item
+        result.add(DownloadResult(detail, _rebuild_downloader(option, state)))
+
+
+def _merge_rate_limit_metrics(metric_dict: Dict[str, dict]):
+    with RateLimiter._lock:
+        for host, metric in metric_dict.items():
+            local = RateLimiter.METRICS.setdefault(host, dict(metric, request=0, bytes=0, wait=0.0, throttled=0))
+            for key in ('request', 'bytes', 'wait', 'throttled'):
+                local[key] += metric[key]
+
+
+def download_batch_multiprocess(download_api,
+                                jm_id_iter,
+                                option=None,
+                                downloader=None,
+                                processes=None,
+                                **kwargs,
+                                ) -> BatchResult:
+    """
+    多进程批量下载 album / photo，用法和返回值与 download_batch 相同。
+
+    :param download_api: download_album / download_photo（或它们的 async 版本），子进程中使用异步版本下载
+    :param processes: 进程数，默认为 CPU 核数，不会超过 id 的个数
+    :param downloader: 下载器类，需要能在子进程中 import（模块级定义）
+    """
+    if option is None:
+        option = JmModuleConfig.option_class().default()
+
+    async_api_dict = {
+        download_album: download_album_async,
+        download_photo: download_photo_async,
+        download_album_async: download_album_async,
+        download_photo_async: download_photo_async,
+    }
+    ExceptionTool.require_true(download_api in async_api_dict,
+                               f'多进程批量下载只支持 download_album / download_photo: {download_api}')
+    download_api = async_api_dict[download_api]
+
+    jm_id_list = list(_iter_jm_id(jm_id_iter))
+    result = BatchResult()
+    if len(jm_id_list) == 0:
+        return result
+
+    processes = min(processes or os.cpu_count() or 1, len(jm_id_list))
+    ExceptionTool.require_true(processes > 0, f'processes 必须大于0: {processes}')
+    # 轮流分配，相邻的 id（通常大小相近）分到不同的进程
+    shard_list = [jm_id_list[i::processes] for i in range(processes)]
+
+    option_dict = option.deconstruct()
+    option_dict['filepath'] = option.filepath
+    context = multiprocessing.get_context('spawn')
+
+    with JmSharedStateManager(ctx=context) as manager:
+        shared_state = manager.JmSharedState()
+        shared_state.configure(option.client.get('rate_limit', None), DomainHealthRegistry.snapshot())
+
+        with ProcessPoolExecutor(processes,
+                                 mp_context=context,
+                                 initializer=_init_shard_worker,
+                                 initargs=(shared_state,),
+                                 ) as executor:
+            future_dict = {
+                executor.submit(_run_shard, download_api, shard, option_dict, downloader, kwargs): shard
+                for shard in shard_list
+            }
+            for future in as_completed(future_dict):
+                try:
+                    payload, rate_limit_metrics = future.result()
+                except Exception as e:
+                    # 子进程异常退出，整个分片记为失败
+                    jm_log('batch.process.failed', f'分片下载失败: {future_dict[future]}, 异常: [{e}]', e)
+                    for jm_id in future_dict[future]:
+                        result.failed[jm_id] = e
+                else:
+                    _merge_shard(result, payload, option)
+                    _merge_rate_limit_metrics(rate_limit_metrics)
+
+        # 把这批下载的域名统计并回本进程，后续的下载可以继续使用
+        DomainHealthRegistry.merge(shared_state.domain_snapshot())
+
+    return result
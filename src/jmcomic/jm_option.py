@@ -1,27 +1,271 @@
 from .jm_client_impl import *
+import json
+import sqlite3
+import weakref
 from typing import Optional, Sequence, Union
 
 
+class DiskCache:
+    """
+    基于 SQLite 单文件的元数据缓存，实现了客户端缓存用到的 dict 接口（get / [] / in / pop），
+    可以直接作为 client.set_cache_dict 的参数，供 JmApiClient 的 func_to_cache 和 AsyncJmApiClient 的 _cache_get/_cache_set 使用。
+
+    - 值序列化为 JSON（见 dump_value），保存解析后的 JmAlbumDetail / JmPhotoDetail / JmSearchPage 和 scramble_id。
+      缓存文件常放在共享的 base_dir 下，不使用 pickle：能写这个文件的人不能借此在读缓存的进程中执行代码
+    - 按种类（album / photo / search / scramble）设置过期时间（秒），None 表示永不过期
+    - 使用 WAL 模式，每个线程（以及 fork 出的子进程）使用各自的连接，多个进程可以同时读写同一个文件
+    """
+
+    DEFAULT_TTL = {
+        'album': 24 * 3600,  # 本子会更新章节
+        'photo': 7 * 24 * 3600,
+        'search': 3600,
+        'scramble': None,
+    }
+
+    def __init__(self, path: str, ttl: Optional[Dict[str, Optional[float]]] = None):
+        self.path = path
+        self.ttl = {**self.DEFAULT_TTL, **(ttl or {})}
+        self._local = threading.local()
+        mkdir_if_not_exists(of_dir_path(path))
+        with self._conn() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache ('
+                         'key TEXT PRIMARY KEY, kind TEXT, value BLOB, expire_at REAL)')
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @classmethod
+    def key_to_str(cls, key) -> str:
+        """
+        把缓存key转为跨进程稳定的字符串（不能用 hash，字符串的 hash 每个进程不同）
+        """
+        if isinstance(key, (tuple, list)):
+            return '(' + ','.join(cls.key_to_str(k) for k in key) + ')'
+        if isinstance(key, type):
+            return f'{key.__module__}.{key.__qualname__}'
+        return repr(key)
+
+    @classmethod
+    def kind_of(cls, key) -> str:
+        if not isinstance(key, tuple) or len(key) == 0:
+            return 'default'
+        for k in key:
+            if isinstance(k, type) and issubclass(k, JmAlbumDetail):
+                return 'album'
+            if isinstance(k, type) and issubclass(k, JmPhotoDetail):
+                return 'photo'
+        return key[0] if key[0] in ('search', 'scramble') else 'default'
+
+    def get(self, key, default=None):
+        key = self.key_to_str(key)
+        row = self._conn().execute('SELECT value, expire_at FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        value, expire_at = row
+        if expire_at is not None and expire_at < time.time():
+            self._delete(key)
+            return default
+        try:
+            return self.load_value(value)
+        except Exception as e:
+            # 实体类结构变化、旧版本写入的 pickle 数据等原因无法反序列化，视为未命中
+            jm_log('cache.disk', f'缓存反序列化失败，忽略: {e}')
+            return default
+
+    def __setitem__(self, key, value):
+        try:
+            value = self.dump_value(value)
+        except (TypeError, ValueError, RecursionError) as e:
+            # 不能转为 JSON 的值不写入磁盘缓存，视为不缓存
+            jm_log('cache.disk', f'缓存序列化失败，不写入磁盘: {e}')
+            return
+
+        kind = self.kind_of(key)
+        ttl = self.ttl.get(kind, None)
+        with self._conn() as conn:
+            conn.execute('INSERT OR REPLACE INTO cache (key, kind, value, expire_at) VALUES (?, ?, ?, ?)',
+                         (self.key_to_str(key),
+                          kind,
+                          value,
+                          None if ttl is None else time.time() + ttl,
+                          ))
+
+    @classmethod
+    def dump_value(cls, value) -> str:
+        """
+        把缓存值转为 JSON。JSON 没有的类型（tuple、set、bytes、非 str key 的 dict、实体、EntitySnapshot）
+        转为 {"@": 类型, ...} 的对象，实体只保存类名和 __dict__
+        """
+        return json.dumps(cls._encode(value), ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def load_value(cls, text: str):
+        """
+        dump_value 的逆过程。实体类只在已加载的 JmBaseEntity 子类中按类名查找，不会按名字 import 模块或调用其他代码
+        """
+        return cls._decode(json.loads(text))
+
+    @classmethod
+    def _encode(cls, v):
+        t = type(v)
+        if t in (type(None), bool, int, float, str):
+            return v
+        if t is list:
+            return [cls._encode(e) for e in v]
+        if t in (tuple, set, frozenset):
+            return {'@': t.__name__, 'v': [cls._encode(e) for e in v]}
+        if t is dict:
+            return {'@': 'dict', 'v': [[cls._encode(k), cls._encode(e)] for k, e in v.items()]}
+        if t is bytes:
+            from base64 import b64encode
+            return {'@': 'bytes', 'v': b64encode(v).decode()}
+        if t is EntitySnapshot:
+            return {'@': 'snapshot', 'cls': cls._class_name(v.clazz),
+                    'shared': cls._encode(v.shared), 'frozen': cls._encode(v.frozen)}
+        if t is FrozenValue:
+            return {'@': 'frozen', 'kind': v.kind, 'items': cls._encode(v.items), 'flat': v.flat}
+        if isinstance(v, JmBaseEntity):
+            return {'@': 'entity', 'cls': cls._class_name(t), 'state': cls._encode(v.__dict__)}
+        raise TypeError(f'不支持写入磁盘缓存的类型: {t}')
+
+    @classmethod
+    def _decode(cls, v):
+        if type(v) is list:
+            return [cls._decode(e) for e in v]
+        if type(v) is not dict:
+            return v
+
+        kind = v['@']
+        if kind == 'tuple':
+            return tuple(cls._decode(e) for e in v['v'])
+        if kind == 'set':
+            return {cls._decode(e) for e in v['v']}
+        if kind == 'frozenset':
+            return frozenset(cls._decode(e) for e in v['v'])
+        if kind == 'dict':
+            return {cls._decode(k): cls._decode(e) for k, e in v['v']}
+        if kind == 'bytes':
+            from base64 import b64decode
+            return b64decode(v['v'])
+        if kind == 'snapshot':
+            snapshot = EntitySnapshot.__new__(EntitySnapshot)
+            snapshot.clazz = cls._entity_class(v['cls'])
+            snapshot.shared = cls._decode(v['shared'])
+            snapshot.frozen = cls._decode(v['frozen'])
+            return snapshot
+        if kind == 'frozen':
+            return FrozenValue(v['kind'], cls._decode(v['items']), v['flat'])
+        if kind == 'entity':
+            clazz = cls._entity_class(v['cls'])
+            entity = clazz.__new__(clazz)
+            entity.__dict__.update(cls._decode(v['state']))
+            return entity
+        raise ValueError(f'未知的缓存值类型: {kind}')
+
+    @staticmethod
+    def _class_name(clazz: type) -> str:
+        return f'{clazz.__module__}.{clazz.__qualname__}'
+
+    @classmethod
+    def _entity_class(cls, name: str) -> type:
+        stack = [JmBaseEntity]
+        while stack:
+            clazz = stack.pop()
+            if cls._class_name(clazz) == name:
+                return clazz
+            stack.extend(clazz.__subclasses__())
+        raise ValueError(f'未知的实体类: {name}')
+
+    def __getitem__(self, key):
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def pop(self, key, *default):
+        value = self.get(key, *default) if default else self[key]
+        self._delete(self.key_to_str(key))
+        return value
+
+    def _delete(self, key: str):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM cache WHERE expire_at IS NULL OR expire_at >= ?',
+                                    (time.time(),)).fetchone()[0]
+
+    def clear(self):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM cache')
+
+    def purge_expired(self) -> int:
+        """
+        删除已过期的记录，返回删除的条数
+        """
+        with self._conn() as conn:
+            return conn.execute('DELETE FROM cache WHERE expire_at < ?', (time.time(),)).rowcount
+
+
 class CacheRegistry:
-    REGISTRY = {}
+    # option / client → 缓存。弱引用，option / client 被回收后缓存随之释放
+    REGISTRY = weakref.WeakKeyDictionary()
+    # 缓存文件路径 → DiskCache
+    DISK_REGISTRY: Dict[str, DiskCache] = {}
 
     @classmethod
-    def level_option(cls, option, _client):
-        registry = cls.REGISTRY
-        registry.setdefault(option, {})
-        return registry[option]
+    def level_option(cls, option, _client, **limit):
+        return cls.get_or_create(option, limit)
 
     @classmethod
-    def level_client(cls, _option, client):
+    def level_client(cls, _option, client, **limit):
+        return cls.get_or_create(client, limit)
+
+    @classmethod
+    def get_or_create(cls, owner, limit: dict):
+        """
+        :param owner: 缓存的所有者，option 或 client
+        :param limit: LruCache 的参数 max_entries / max_bytes / ttl，全部为空时使用不限大小的 dict
+        """
         registry = cls.REGISTRY
-        registry.setdefault(client, {})
-        return registry[client]
+        cache = registry.get(owner, None)
+        if cache is None:
+            limit = {k: v for k, v in limit.items() if v is not None}
+            cache = registry[owner] = LruCache(**limit) if limit else {}
+        return cache
+
+    @classmethod
+    def level_disk(cls, option, _client, **_limit):
+        """
+        磁盘缓存，进程重启后依然有效，见 DiskCache。
+        文件路径和过期时间由 client.disk_cache 配置，同一个文件的 client 共用一个 DiskCache 对象
+        """
+        config = option.client.get('disk_cache', None) or {}
+        path = config.get('path', None) or os.path.join(option.dir_rule.base_dir, '.jmcomic_cache.sqlite3')
+        path = JmcomicText.parse_to_abspath(path)
+
+        registry = cls.DISK_REGISTRY
+        if path not in registry:
+            registry[path] = DiskCache(path, config.get('ttl', None))
+        return registry[path]
 
     @classmethod
     def enable_client_cache_on_condition(cls,
                                          option: 'JmOption',
                                          client: JmcomicClient,
-                                         cache: Union[None, bool, str, Callable],
+                                         cache: Union[None, bool, str, dict, Callable],
                                          ):
         """
         cache parameter
@@ -35,11 +279,24 @@ class CacheRegistry:
 
         if str:
           (invoke corresponding Cache class method)
+          level_option / level_client: 内存缓存
+          level_disk: 磁盘缓存（SQLite），见 DiskCache
+
+        if dict:
+          {level: level_option, max_entries: 1000, max_bytes: 104857600, ttl: 3600}
+          level 同上（默认 level_option），其余为内存缓存的上限，见 LruCache
 
         :param option: JmOption
         :param client: JmcomicClient
         :param cache: config dsl
         """
+        limit = {}
+        if isinstance(cache, AdvancedDict):
+            cache = cache.src_dict
+        if isinstance(cache, dict):
+            limit = {k: v for k, v in cache.items() if k != 'level'}
+            cache = cache.get('level', None) or cls.level_option.__name__
+
         if cache is None:
             return
 
@@ -55,7 +312,7 @@ class CacheRegistry:
             cache = func
 
         cache: Callable
-        client.set_cache_dict(cache(option, client))
+        client.set_cache_dict(cache(option, client, **limit) if limit else cache(option, client))
 
 
 class DirRule:
@@ -518,6 +775,17 @@ class JmOption:
             domain_retry_strategy=domain_retry_strategy,
         )
 
+        # retry policy
+        retry_config = self.client.get('retry', None)
+        if retry_config:
+            client.retry_policy = RetryPolicy.from_config(retry_config)
+
+        # rate limit
+        RateLimiter.configure(self.client.get('rate_limit', None))
+
+        # json
+        JmcomicText.configure_json((self.client.get('decode', None) or {}).get('json', None))
+
         # enable cache
         CacheRegistry.enable_client_cache_on_condition(self, client, cache)
 
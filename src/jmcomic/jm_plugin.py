@@ -2,6 +2,7 @@
 该文件存放的是option插件
 """
 
+import time
 from collections import deque
 from threading import RLock
 
@@ -1765,7 +1766,8 @@ class AdvancedRetryPlugin(JmOptionPlugin):
         实现如下域名重试机制：
         - 对域名列表轮询请求，配置：retry_rounds
         - 限制单个域名最大失败次数，配置：retry_domain_max_times
-        - 轮询域名列表前，根据历史失败次数对域名列表排序，失败多的后置
+        - 轮询域名列表前，根据历史失败次数对域名列表排序，失败多的后置，失败次数相同时按 DomainHealthRegistry 的健康度排序
+        - 异常的处理遵循 client.retry_policy：abort 直接抛出，每轮之间按退避时间 / Retry-After 等待，超过 deadline 不再重试
         """
 
         def do_request(domain):
@@ -1779,13 +1781,32 @@ class AdvancedRetryPlugin(JmOptionPlugin):
                 # 图片url
                 client.update_request_with_specify_domain(kwargs, None, is_image)
 
-            resp = request(url_to_use, **kwargs)
-            resp = client.raise_if_resp_should_retry(resp, is_image)
+            begin = time.perf_counter()
+            try:
+                resp = request(url_to_use, **kwargs)
+                resp = client.raise_if_resp_should_retry(resp, is_image)
+            except Exception:
+                if url.startswith('/'):
+                    DomainHealthRegistry.record_failure(domain)
+                raise
+            if url.startswith('/'):
+                DomainHealthRegistry.record_success(domain, time.perf_counter() - begin)
             return resp
 
         retry_domain_max_times: int = self.retry_config['retry_domain_max_times']
         retry_rounds: int = self.retry_config['retry_rounds']
+        policy: RetryPolicy = client.retry_policy
+        started_at = time.monotonic()
+        last_error = None
+
         for rindex in range(retry_rounds):
+            if last_error is not None:
+                # 一轮全部失败，等待后再开始下一轮
+                delay = policy.delay(rindex - 1, last_error)
+                if policy.deadline is not None and time.monotonic() - started_at + delay > policy.deadline:
+                    break
+                time.sleep(delay)
+
             domain_list = self.get_sorted_domain(client, retry_domain_max_times)
             for i, domain in enumerate(domain_list):
                 if self.failed_count(client, domain) >= retry_domain_max_times:
@@ -1796,11 +1817,14 @@ class AdvancedRetryPlugin(JmOptionPlugin):
                 except Exception as e:
                     jm_log('req.error', e)
                     self.update_failed_count(client, domain)
+                    if policy.classify(e) == policy.ABORT:
+                        raise e
+                    last_error = e
 
         return client.fallback(request, url, 0, 0, is_image, **kwargs)
 
     def get_sorted_domain(self, client: JmcomicClient, times):
-        domain_list = client.get_domain_list()
+        domain_list = DomainHealthRegistry.rank(client.get_domain_list())
         return sorted(
             filter(lambda d: self.failed_count(client, d) < times, domain_list),
             key=lambda d: self.failed_count(client, d)
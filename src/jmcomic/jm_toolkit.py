@@ -1,4 +1,7 @@
+import threading
+from contextlib import contextmanager
 from html.parser import HTMLParser
+from typing import NamedTuple
 from urllib.parse import unquote, urlparse
 
 from PIL import Image
@@ -6,6 +9,17 @@ from PIL import Image
 from .jm_exception import *
 
 
+class HtmlFieldPlan(NamedTuple):
+    """JmcomicText.reflect_new_instance 的一个字段的解析计划，见 JmcomicText.compile_field_plan"""
+    field_name: str
+    pattern: Union[Pattern, List[Pattern]]  # 原始的 pattern，用于报错信息
+    default: Any
+    # 缩小范围的 pattern 链：((链的前缀, pattern), ...)，前缀用作缩小范围结果的共享 key
+    narrow_chain: Tuple[Tuple[tuple, Union[Pattern, 'AnchoredPattern']], ...]
+    match_pattern: Union[Pattern, 'AnchoredPattern']
+    find_all: bool
+
+
 class JmcomicText:
     pattern_jm_domain = compile(r'https://([\w.-]+)')
     pattern_jm_pa_id = [
@@ -69,6 +83,12 @@ class JmcomicText:
 
     pattern_html_comment_next_page = compile(r'id=["\']p_album_comments_\d+_(\d+)["\']')
 
+    # (cls, 字段前缀) -> (编译时 cls.__dict__ 的大小, 编译时的 pattern 属性, 字段计划)，见 compile_field_plan
+    _field_plan_dict: Dict[tuple, Tuple[int, tuple, List[HtmlFieldPlan]]] = {}
+    # json_loads 使用的第三方json库的 loads，为 None 时使用标准库，见 configure_json
+    _json_loads = None
+    _json_configured = False
+
     @classmethod
     def parse_to_jm_domain(cls, text: str):
         if text.startswith(JmModuleConfig.PROT):
@@ -141,64 +161,97 @@ class JmcomicText:
         )
 
     @classmethod
-    def reflect_new_instance(cls, html: str, cls_field_prefix: str, clazz: type):
+    def compile_field_plan(cls, cls_field_prefix: str) -> List['HtmlFieldPlan']:
+        """
+        把 cls 中以 cls_field_prefix 开头的 pattern 编译为字段计划，每个 (cls, 前缀) 只编译一次，
+        之后的解析不再遍历 cls.__dict__。能分析出字面量开头的 pattern 会包装为 AnchoredPattern，先用 str.find 定位再匹配。
+        复用字段计划前按对象身份检查 pattern 类属性，运行时替换、增删了 pattern（例如修复网页改版）时会重新编译。
+        """
+        key = (cls, cls_field_prefix)
+        cls_dict = cls.__dict__
+        cached = cls._field_plan_dict.get(key, None)
+        if cached is not None:
+            dict_size, source, plan = cached
+            if dict_size == len(cls_dict) and all(cls_dict.get(name) is pattern for name, pattern in source):
+                return plan
+
+        plan = []
+        source = tuple((name, pattern) for name, pattern in cls_dict.items() if name.startswith(cls_field_prefix))
+        pattern_name: str
+        for pattern_name, pattern in source:
 
-        def match_field(field_name: str, pattern: Union[Pattern, List[Pattern]], text):
+            # 支持如果不匹配，使用默认值
+            if isinstance(pattern, tuple):
+                pattern, default = pattern
+            else:
+                default = None
 
+            field_name = pattern_name[len(cls_field_prefix):]
             if isinstance(pattern, list):
                 # 如果是 pattern 是 List[re.Pattern]，
                 # 取最后一个 pattern 用于 match field，
                 # 其他的 pattern 用来给文本缩小范围（相当于多次正则匹配）
-                last_pattern = pattern[len(pattern) - 1]
-                # 缩小文本
-                for i in range(0, len(pattern) - 1):
-                    match: Match = pattern[i].search(text)
-                    if match is None:
-                        return None
-                    text = match[0]
-
-                return last_pattern.findall(text)
-
-            if field_name.endswith("_list"):
-                return pattern.findall(text)
+                narrow_list = pattern[:-1]
+                plan.append(HtmlFieldPlan(
+                    field_name, pattern, default,
+                    tuple((tuple(narrow_list[:i + 1]), PatternTool.anchored(p)) for i, p in enumerate(narrow_list)),
+                    PatternTool.anchored(pattern[-1]), True,
+                ))
             else:
-                match = pattern.search(text)
-                if match is not None:
-                    return match[1]
-                return None
+                plan.append(HtmlFieldPlan(field_name, pattern, default, (),
+                                          PatternTool.anchored(pattern), field_name.endswith("_list")))
+
+        cls._field_plan_dict[key] = (len(cls_dict), source, plan)
+        return plan
+
+    @classmethod
+    def clear_field_plan(cls):
+        cls._field_plan_dict.clear()
+
+    @classmethod
+    def reflect_new_instance(cls, html: str, cls_field_prefix: str, clazz: type):
+        # 缩小范围得到的文本，key 为缩小范围的 pattern 链，链相同的字段只匹配一次
+        region_dict: Dict[tuple, Optional[str]] = {}
+
+        def narrow(narrow_chain):
+            text = html
+            for chain, pattern in narrow_chain:
+                if chain not in region_dict:
+                    match: Match = pattern.search(text)
+                    region_dict[chain] = None if match is None else match[0]
+                text = region_dict[chain]
+                if text is None:
+                    return None
+            return text
 
         field_dict = {}
-        pattern_name: str
-        for pattern_name, pattern in cls.__dict__.items():
-            if not pattern_name.startswith(cls_field_prefix):
-                continue
+        for field in cls.compile_field_plan(cls_field_prefix):
+            text = narrow(field.narrow_chain) if field.narrow_chain else html
 
-            # 支持如果不匹配，使用默认值
-            if isinstance(pattern, tuple):
-                pattern, default = pattern
+            if text is None:
+                field_value = None
+            elif field.find_all:
+                field_value = field.match_pattern.findall(text)
             else:
-                default = None
-
-            # 获取字段名和值
-            field_name = pattern_name[pattern_name.index(cls_field_prefix) + len(cls_field_prefix):]
-            field_value = match_field(field_name, pattern, html)
+                match = field.match_pattern.search(text)
+                field_value = match[1] if match is not None else None
 
             if field_value is None:
-                if default is None:
+                if field.default is None:
                     msg_tail = '' if JmModuleConfig.FLAG_DUMP_HTML_ON_REGEX_ERROR else '，可通过设置 JmModuleConfig.FLAG_DUMP_HTML_ON_REGEX_ERROR = True 将响应文本保存到文件'
                     ExceptionTool.raises_regex(
-                        f"文本没有匹配上字段：字段名为'{field_name}'，pattern: [{pattern}]"
+                        f"文本没有匹配上字段：字段名为'{field.field_name}'，pattern: [{field.pattern}]"
                         + (f"\n响应文本=[{html}]" if len(html) < 200 else
                            f'响应文本过长(len={len(html)})，不打印{msg_tail}'
                            ),
                         html=html,
-                        pattern=pattern,
+                        pattern=field.pattern,
                     )
                 else:
-                    field_value = default
+                    field_value = field.default
 
             # 保存字段
-            field_dict[field_name] = field_value
+            field_dict[field.field_name] = field_value
 
         return clazz(**field_dict)
 
@@ -380,16 +433,51 @@ class JmcomicText:
 
     # noinspection PyTypeChecker
     @classmethod
-    def try_parse_json_object(cls, resp_text: str) -> dict:
+    def configure_json(cls, backend: Optional[str]):
+        """
+        选择解析接口返回值使用的json库（client.decode.json）：
+        auto（安装了 orjson 时使用 orjson，否则使用标准库 json）/ orjson / json
+        """
+        backend = backend or 'auto'
+        ExceptionTool.require_true(backend in ('auto', 'orjson', 'json'), f'不支持的json库: {backend}')
+
+        loads = None
+        if backend != 'json':
+            try:
+                import orjson
+                loads = orjson.loads
+            except ImportError:
+                ExceptionTool.require_true(backend == 'auto', '未安装 orjson，请先执行 pip install orjson')
+
+        cls._json_loads = loads
+        cls._json_configured = True
+
+    @classmethod
+    def json_loads(cls, text: Union[str, bytes]) -> Any:
+        if not cls._json_configured:
+            cls.configure_json('auto')
+
+        loads = cls._json_loads
+        if loads is not None:
+            try:
+                return loads(text)
+            except ValueError:
+                # orjson 比标准库严格（例如不接受 NaN、超过64位的整数），解析失败时交给标准库
+                pass
+
         import json
+        return json.loads(text)
+
+    @classmethod
+    def try_parse_json_object(cls, resp_text: str) -> dict:
         text = resp_text.strip()
         if text.startswith('{') and text.endswith('}'):
             # fast case
-            return json.loads(text)
+            return cls.json_loads(text)
 
         for match in cls.pattern_api_response_json_object.finditer(text):
             try:
-                return json.loads(match.group(0))
+                return cls.json_loads(match.group(0))
             except Exception as e:
                 jm_log('parse_json_object.error', e)
 
@@ -589,6 +677,50 @@ class CommentParser(HTMLParser):
 
 class PatternTool:
 
+    @classmethod
+    def literal_anchor(cls, pattern: Pattern) -> Optional[Tuple[str, int]]:
+        """
+        分析 pattern 的每个匹配都必须包含的开头部分：返回 (literal, offset)，表示匹配以 offset 个定宽字符 + literal 开头。
+        找不到这样的字面量时返回 None。
+        """
+        if not isinstance(pattern.pattern, str) or pattern.flags & re.IGNORECASE:
+            return None
+
+        try:
+            try:
+                from re import _parser as sre_parse
+            except ImportError:
+                import sre_parse
+
+            parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+            item_list = list(parsed)
+            k = next((i for i, (op, _) in enumerate(item_list) if op is sre_parse.LITERAL), None)
+            if k is None:
+                return None
+
+            lo, hi = sre_parse.SubPattern(parsed.state, item_list[:k]).getwidth()
+            if lo != hi:
+                return None
+
+            literal = []
+            for op, av in item_list[k:]:
+                if op is not sre_parse.LITERAL:
+                    break
+                literal.append(chr(av))
+        except Exception:
+            # 依赖 re 的内部实现，分析失败时不使用锚点
+            return None
+
+        return ''.join(literal), lo
+
+    @classmethod
+    def anchored(cls, pattern: Pattern):
+        """能分析出字面量锚点时返回 AnchoredPattern，否则返回 pattern 本身"""
+        anchor = cls.literal_anchor(pattern)
+        if anchor is None:
+            return pattern
+        return AnchoredPattern(pattern, *anchor)
+
     @classmethod
     def match_or_default(cls, html: str, pattern: Pattern, default):
         match = pattern.search(html)
@@ -619,6 +751,48 @@ class PatternTool:
         )
 
 
+class AnchoredPattern:
+    """
+    带字面量锚点的正则，提供和 re.Pattern 相同的 search / findall。
+
+    pattern 的每个匹配都以 offset 个定宽字符 + literal 开头时，先用 str.find 找 literal（比正则在大文本上逐字符扫描快得多），
+    再从 literal 前 offset 个字符处尝试 match，得到的结果和 pattern.search / pattern.findall 相同。
+    由 PatternTool.anchored 创建。
+    """
+
+    __slots__ = ('pattern', 'literal', 'offset')
+
+    def __init__(self, pattern: Pattern, literal: str, offset: int):
+        self.pattern = pattern
+        self.literal = literal
+        self.offset = offset
+
+    def search(self, text: str, pos: int = 0) -> Optional[Match]:
+        literal, offset, match = self.literal, self.offset, self.pattern.match
+        i = text.find(literal, pos + offset)
+        while i != -1:
+            m = match(text, i - offset)
+            if m is not None:
+                return m
+            i = text.find(literal, i + 1)
+        return None
+
+    def findall(self, text: str) -> list:
+        result = []
+        pos = 0
+        while True:
+            m = self.search(text, pos)
+            if m is None:
+                return result
+            groups = m.groups('')
+            result.append(m[0] if len(groups) == 0 else groups[0] if len(groups) == 1 else groups)
+            # literal 非空，匹配不会是空串
+            pos = m.end()
+
+    def __repr__(self):
+        return repr(self.pattern)
+
+
 class JmPageTool:
     # 用来缩减html的长度
     pattern_html_search_shorten_for = compile(r'<div class="well well-sm">([\s\S]*)<div class="row">')
@@ -1045,12 +1219,47 @@ class JmImageTool:
         :param image: PIL.Image对象
         :param filepath: 保存文件路径
         """
-        image.save(filepath)
+        # 写临时文件时PIL无法再从文件名推断格式，按目标后缀指定
+        image_format = Image.registered_extensions().get(of_file_suffix(filepath).lower())
+        with cls.open_atomic(filepath) as f:
+            image.save(f, format=image_format)
 
     @classmethod
     def save_directly(cls, resp, filepath):
-        from common import save_resp_content
-        save_resp_content(resp, filepath)
+        cls.save_bytes(resp.content, filepath)
+
+    @classmethod
+    def save_bytes(cls, data: bytes, filepath):
+        of_dir_path(filepath, mkdir=True)
+        with cls.open_atomic(filepath) as f:
+            f.write(data)
+
+    @classmethod
+    @contextmanager
+    def open_atomic(cls, filepath: str):
+        """
+        原子写文件：先写到同目录下的临时文件，with 块正常结束后 os.replace 到目标路径。
+        with 块内抛异常时删除临时文件，目标路径不会出现写了一半的文件。
+
+        :param filepath: 目标文件路径
+        :return: 以 'wb' 模式打开的临时文件对象
+        """
+        import uuid
+        dirpath, filename = os.path.split(filepath)
+        tmp_path = os.path.join(dirpath, f'.{filename}.{uuid.uuid4().hex[:8]}.part')
+        # 不用 tempfile.mkstemp：它创建的文件权限为 0600，os.replace 后会保留下来，
+        # 这里按 0666 创建，由 umask 决定最终权限，和直接 open 写文件一致
+        fd = os.open(tmp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0), 0o666)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield f
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
 
     @classmethod
     def decode_and_save(cls,
@@ -1070,6 +1279,92 @@ class JmImageTool:
             cls.save_image(img_src, decoded_save_path)
             return
 
+        # 解密到当前线程复用的画布，然后保存到新的解密文件
+        canvas = cls.reuse_canvas(img_src.size)
+        cls.save_image(cls.decode_image(num, img_src, canvas), decoded_save_path)
+
+    @classmethod
+    def decode_image(cls,
+                     num: int,
+                     img_src: Image,
+                     canvas: Optional[Image.Image] = None,
+                     ) -> Image:
+        """
+        解密图片，返回解密后的 RGB 图片。
+
+        禁漫的切割方式是把图片按水平条带倒序排列，解密只需要按偏移表把条带搬回原位。
+        偏移表按 (h, num) 缓存，见 cls.get_strip_table。
+
+        :param num: 分割数，0 表示无需解密
+        :param img_src: 原始图片
+        :param canvas: 解密画布，尺寸需与原始图片一致，为 None 时新建。
+                       传入可复用的画布可以省去每页分配画布的开销，见 cls.reuse_canvas
+        """
+        if num == 0:
+            return img_src
+
+        w, h = img_src.size
+        if canvas is None:
+            canvas = Image.new("RGB", (w, h))
+
+        for y_src, y_dst, rows in cls.get_strip_table(h, num):
+            canvas.paste(img_src.crop((0, y_src, w, y_src + rows)), (0, y_dst))
+
+        return canvas
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def get_strip_table(h: int, num: int) -> Tuple[Tuple[int, int, int], ...]:
+        """
+        计算条带偏移表，按 (h, num) 缓存。
+
+        :return: ((y_src, y_dst, rows), ...)，第0条带包含 h % num 的余数行
+        """
+        move = h // num
+        over = h % num
+        table = []
+        for i in range(num):
+            y_src = h - (move * (i + 1)) - over
+            y_dst = move * i
+            rows = move
+
+            if i == 0:
+                rows += over
+            else:
+                y_dst += over
+
+            table.append((y_src, y_dst, rows))
+
+        return tuple(table)
+
+    # 线程内复用的解密画布
+    _canvas_local = threading.local()
+
+    @classmethod
+    def reuse_canvas(cls, size) -> Image.Image:
+        """
+        获取当前线程可复用的解密画布。
+        解密线程一般连续处理尺寸相同的图片，同尺寸时直接复用上一次的画布（解密会覆盖画布的每一行），
+        尺寸不同时才重新分配。每个线程只保留一块画布。
+
+        注意：返回的画布会被同线程的下一次解密覆盖，用完（保存）之前不要交给其他线程。
+        """
+        local = cls._canvas_local
+        canvas = getattr(local, 'canvas', None)
+        if canvas is None or canvas.size != size:
+            canvas = Image.new("RGB", size)
+            local.canvas = canvas
+        return canvas
+
+    @classmethod
+    def decode_image_by_paste(cls, num: int, img_src: Image) -> Image:
+        """
+        旧版解密实现：每页新建画布，逐条计算偏移后 crop + paste。
+        保留作为 decode_image 的参照实现，供测试和 benchmark 对比。
+        """
+        if num == 0:
+            return img_src
+
         import math
         w, h = img_src.size
 
@@ -1097,14 +1392,41 @@ class JmImageTool:
                 )
             )
 
-            # save every step result
-            # cls.save_image(img_decode, change_file_name(
-            #     decoded_save_path,
-            #     f'{of_file_name(decoded_save_path, trim_suffix=True)}_{i}{of_file_suffix(decoded_save_path)}'
-            # ))
+        return img_decode
 
-        # 保存到新的解密文件
-        cls.save_image(img_decode, decoded_save_path)
+    @classmethod
+    def is_image_complete(cls, filepath: str) -> bool:
+        """
+        快速判断图片文件是否完整：文件非空，且对常见格式校验文件头和文件尾。
+        只读取头尾少量字节，不解析图片，用于断点续传时识别写了一半的文件。
+        无法识别的格式只要求文件非空。
+        """
+        try:
+            size = os.path.getsize(filepath)
+            if size == 0:
+                return False
+
+            with open(filepath, 'rb') as f:
+                head = f.read(16)
+                f.seek(max(0, size - 64))
+                tail = f.read()
+        except OSError:
+            return False
+
+        if head.startswith(b'\xff\xd8'):
+            # jpg: EOI 标记，允许其后有少量填充
+            return b'\xff\xd9' in tail
+        if head.startswith(b'\x89PNG\r\n\x1a\n'):
+            # png: IEND 块
+            return tail.endswith(b'IEND\xaeB`\x82')
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            # gif: trailer
+            return tail.endswith(b'\x3b')
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            # webp: RIFF 头记录的长度
+            return int.from_bytes(head[4:8], 'little') + 8 <= size
+
+        return True
 
     @classmethod
     def open_image(cls, fp: Union[str, bytes]):
@@ -1154,6 +1476,17 @@ class JmImageTool:
         """
         return cls.get_num(detail.scramble_id, detail.aid, detail.img_file_name)
 
+    @classmethod
+    def is_passthrough(cls, detail: JmImageDetail, save_path: str, decode_image: bool) -> bool:
+        """
+        判断图片能否原样写盘：不需要解密（不解密，或分割数为0），且保存后缀与原图一致。
+        只依赖 JmImageDetail，可以在请求图片之前决定。
+        """
+        if suffix_not_equal(detail.img_url, save_path):
+            return False
+
+        return decode_image is False or cls.get_num_by_detail(detail) == 0
+
 
 class JmCryptoTool:
     """
@@ -1211,9 +1544,7 @@ class JmCryptoTool:
         data_b64 = base64.b64decode(data)
 
         # 2. AES-ECB解密
-        key = cls.md5hex(f'{ts}{secret}').encode('utf-8')
-        from Crypto.Cipher import AES
-        data_aes = AES.new(key, AES.MODE_ECB).decrypt(data_b64)
+        data_aes = cls.resp_data_cipher(str(ts), secret).decrypt(data_b64)
 
         # 3. 移除末尾的padding
         data = data_aes[:-data_aes[-1]]
@@ -1223,6 +1554,17 @@ class JmCryptoTool:
 
         return res
 
+    @staticmethod
+    @lru_cache(maxsize=128)
+    def resp_data_cipher(ts: str, secret: str):
+        """
+        按 (ts, secret) 缓存解密接口返回值的 AES 解密器。
+        使用固定时间戳（FLAG_USE_FIX_TIMESTAMP）时 ts 不变，密钥只需计算一次。ECB 模式没有状态，解密器可以在线程间共用。
+        """
+        key = JmCryptoTool.md5hex(f'{ts}{secret}').encode('utf-8')
+        from Crypto.Cipher import AES
+        return AES.new(key, AES.MODE_ECB)
+
     @classmethod
     def md5hex(cls, key: str):
         ExceptionTool.require_true(isinstance(key, str), 'key参数需为字符串')
@@ -0,0 +1,110 @@
+import asyncio
+import base64
+import json
+import threading
+from unittest.mock import patch
+
+from Crypto.Cipher import AES
+
+from test_jmcomic import *
+from jmcomic.jm_async_client import AsyncJmApiClient
+
+TS = '1700000000'
+
+
+class FakeResp:
+
+    def __init__(self, text):
+        self.status_code = 200
+        self.text = text
+        self.content = text.encode('utf-8')
+        self.headers = {}
+        self.url = ''
+
+
+def encode_resp(data, ts=TS) -> FakeResp:
+    plain = json.dumps(data).encode('utf-8')
+    pad = 16 - len(plain) % 16
+    key = JmCryptoTool.md5hex(f'{ts}{JmMagicConstants.APP_DATA_SECRET}').encode('utf-8')
+    encoded = base64.b64encode(AES.new(key, AES.MODE_ECB).encrypt(plain + bytes([pad]) * pad)).decode()
+    return FakeResp(json.dumps({'code': 200, 'errorMsg': '', 'data': encoded}))
+
+
+class Test_Api_Decode(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(JmcomicText.configure_json, 'auto')
+
+    def test_decode_caches_cipher_and_result(self):
+        JmCryptoTool.resp_data_cipher.cache_clear()
+        data = {'name': 'album', 'list': [{'id': 1}, {'id': 2}]}
+        for _ in range(3):
+            resp = JmApiResp(encode_resp(data), TS)
+            self.assertEqual(data, resp.res_data)
+
+        # 同一个 ts 只计算一次密钥
+        self.assertEqual((2, 1), (JmCryptoTool.resp_data_cipher.cache_info().hits,
+                                  JmCryptoTool.resp_data_cipher.cache_info().misses))
+        self.assertIs(resp.res_data, resp.res_data)
+        self.assertIs(resp.model_data, resp.model_data)
+        self.assertEqual(2, resp.model_data.list[1].id)
+
+    def test_json_backend(self):
+        JmcomicText.configure_json('json')
+        self.assertIsNone(JmcomicText._json_loads)
+        self.assertEqual({'a': 1}, JmcomicText.json_loads('{"a": 1}'))
+
+        with self.assertRaises(Exception):
+            JmcomicText.configure_json('simplejson')
+
+        try:
+            import orjson
+        except ImportError:
+            with self.assertRaises(Exception):
+                JmcomicText.configure_json('orjson')
+            return
+
+        JmcomicText.configure_json('auto')
+        self.assertIs(orjson.loads, JmcomicText._json_loads)
+        # orjson 不接受的内容交给标准库
+        self.assertEqual(2 ** 70, JmcomicText.json_loads(f'{{"a": {2 ** 70}}}')['a'])
+
+    def test_preload_swallows_error(self):
+        resp = JmApiResp(FakeResp(json.dumps({'code': 401, 'errorMsg': 'login', 'data': ''})), TS)
+        resp.preload()
+        with self.assertRaises(JmcomicException):
+            _ = resp.res_data
+
+    def test_async_client_decodes_large_resp_off_loop(self):
+        decode_thread_list = []
+        decode_resp_data = JmCryptoTool.decode_resp_data
+
+        def record_thread(*args, **kwargs):
+            decode_thread_list.append(threading.current_thread())
+            return decode_resp_data(*args, **kwargs)
+
+        async def run_test(offload_bytes, data):
+            option = JmOption.default()
+            option.client.decode = {'json': 'auto', 'offload_bytes': offload_bytes}
+            client = AsyncJmApiClient(option, domain_list=['api.example'])
+
+            async def noop():
+                pass
+
+            async def request(*_args, **_kwargs):
+                return encode_resp(data)
+
+            client.setup = noop
+            client._build_api_headers = lambda _url: ({}, TS)
+            client._request_with_retry = request
+            resp = await client.req_api('/search')
+            return resp.res_data
+
+        with patch.object(JmCryptoTool, 'decode_resp_data', side_effect=record_thread):
+            small, large = {'name': 'small'}, {'name': 'x' * 2048}
+            self.assertEqual(small, asyncio.run(run_test(1024, small)))
+            self.assertEqual(large, asyncio.run(run_test(1024, large)))
+            self.assertEqual(large, asyncio.run(run_test(None, large)))
+
+        main_thread = threading.current_thread()
+        self.assertEqual([True, False, True], [t is main_thread for t in decode_thread_list])
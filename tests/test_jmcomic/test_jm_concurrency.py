@@ -0,0 +1,587 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from test_jmcomic import *
+from jmcomic.jm_async_client import AsyncJmApiClient
+from jmcomic.jm_downloader import AdaptiveConcurrencyLimiter
+
+
+class Test_Adaptive_Limiter(unittest.TestCase):
+
+    def test_success_increases_up_to_ceiling(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=2, floor=1, ceiling=4)
+        for _ in range(100):
+            limiter.on_success(0.01)
+
+        self.assertEqual(4, limiter.limit)
+        self.assertEqual([2, 3, 4], [limit for _, limit, _ in limiter.history])
+        self.assertEqual(['init', 'increase', 'increase'], [reason for _, _, reason in limiter.history])
+
+    def test_failure_decreases_multiplicatively_to_floor(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=16, floor=3, ceiling=32)
+        limiter.on_failure(time.perf_counter(), 'Timeout')
+        self.assertEqual(8, limiter.limit)
+        limiter.on_failure(time.perf_counter(), 'Timeout')
+        limiter.on_failure(time.perf_counter(), 'Timeout')
+        self.assertEqual(3, limiter.limit)
+        self.assertEqual((3, 'Timeout'), limiter.history[-1][1:])
+
+    def test_failures_of_same_window_decrease_once(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=16, floor=1, ceiling=32)
+        started_at = time.perf_counter()
+        for _ in range(5):
+            limiter.on_failure(started_at, 'ResponseUnexpectedException')
+
+        self.assertEqual(8, limiter.limit)
+
+    def test_slow_response_does_not_increase(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=2, floor=1, ceiling=8)
+        limiter.on_success(0.01)
+        before = limiter._limit
+        limiter.on_success(1.0)
+        self.assertEqual(before, limiter._limit)
+
+    def test_invalid_bounds(self):
+        with self.assertRaises(ValueError):
+            AdaptiveConcurrencyLimiter(initial=4, floor=8, ceiling=4)
+
+    def test_sync_slot_bounds_in_flight(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=2, floor=1, ceiling=2)
+        lock = threading.Lock()
+        running, max_running = [0], [0]
+
+        def work():
+            with limiter.slot():
+                with lock:
+                    running[0] += 1
+                    max_running[0] = max(max_running[0], running[0])
+                time.sleep(0.01)
+                with lock:
+                    running[0] -= 1
+
+        thread_list = [threading.Thread(target=work) for _ in range(8)]
+        for t in thread_list:
+            t.start()
+        for t in thread_list:
+            t.join()
+
+        self.assertEqual(2, max_running[0])
+        self.assertEqual(0, limiter.in_flight)
+
+    def test_sync_slot_records_failure(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=8, floor=1, ceiling=8)
+        with self.assertRaises(ValueError):
+            with limiter.slot():
+                raise ValueError('empty body')
+
+        self.assertEqual(4, limiter.limit)
+        self.assertEqual('ValueError', limiter.history[-1][2])
+        self.assertEqual(0, limiter.in_flight)
+
+    def test_async_slot_bounds_in_flight_and_adapts(self):
+        async def run_test():
+            limiter = AdaptiveConcurrencyLimiter(initial=4, floor=2, ceiling=4)
+            running, max_running = [0], [0]
+
+            async def work(fail):
+                async with limiter.async_slot():
+                    running[0] += 1
+                    max_running[0] = max(max_running[0], running[0])
+                    await asyncio.sleep(0.01)
+                    running[0] -= 1
+                    if fail:
+                        raise ValueError('5xx')
+
+            await asyncio.gather(*(work(i == 0) for i in range(12)), return_exceptions=True)
+            return limiter, max_running[0]
+
+        limiter, max_running = asyncio.run(run_test())
+        self.assertEqual(4, max_running)
+        self.assertEqual(0, limiter.in_flight)
+        self.assertIn('ValueError', [reason for _, _, reason in limiter.history])
+
+    def test_downloader_creates_limiter_from_threading_config(self):
+        threading_config = SimpleNamespace(image=10, photo=1)
+        option = SimpleNamespace(download=SimpleNamespace(threading=threading_config))
+        self.assertIsNone(BaseDownloader(option).create_image_limiter(10))
+
+        threading_config.adaptive = True
+        threading_config.image_floor = 2
+        threading_config.image_ceiling = 40
+        limiter = BaseDownloader(option).create_image_limiter(10)
+        self.assertEqual((10, 2, 40), (limiter.limit, limiter.floor, limiter.ceiling))
+
+
+class Test_Async_Single_Flight(unittest.TestCase):
+
+    def new_client(self, req_api):
+        client = AsyncJmApiClient(JmOption.default(), domain_list=['api.example'])
+        client.req_api = req_api
+        return client
+
+    class FakeDetail(DetailEntity):
+
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+    @classmethod
+    def parse_entity(cls, res_data, _clazz):
+        return cls.FakeDetail(**res_data)
+
+    def test_concurrent_detail_requests_are_coalesced(self):
+        request_list = []
+
+        async def req_api(url, params=None, **_kwargs):
+            request_list.append((url, params['id']))
+            await asyncio.sleep(0.01)
+            return SimpleNamespace(encoded_data='x', res_data={'name': 'album', 'album_id': params['id']})
+
+        async def run_test():
+            client = self.new_client(req_api)
+            result_list = await asyncio.gather(*(client.get_album_detail('123') for _ in range(5)))
+            # 完成后不再合并，之后的请求重新发起（缓存关闭时）
+            await client.get_album_detail('123')
+            return client, result_list
+
+        with patch.object(JmApiAdaptTool, 'parse_entity', self.parse_entity):
+            client, result_list = asyncio.run(run_test())
+
+        self.assertEqual(2, len(request_list))
+        self.assertEqual({'123'}, {album.album_id for album in result_list})
+        # 共享的结果每个调用方各拿一份副本
+        self.assertEqual(5, len({id(album) for album in result_list}))
+        self.assertEqual({}, client._flight_dict)
+
+    def test_photos_of_same_album_share_album_and_scramble_request(self):
+        request_list = []
+        scramble_list = []
+
+        async def req_api(url, params=None, **_kwargs):
+            request_list.append(url)
+            await asyncio.sleep(0.01)
+            return SimpleNamespace(encoded_data='x',
+                                   res_data={'name': 'photo', 'photo_id': params['id'], 'album_id': '900001'})
+
+        async def fetch_scramble_id(photo_id):
+            scramble_list.append(photo_id)
+            await asyncio.sleep(0.01)
+            return '220980'
+
+        async def run_test():
+            client = self.new_client(req_api)
+            client.fetch_scramble_id = fetch_scramble_id
+            return await asyncio.gather(*(client.get_photo_detail(f'90000{i}') for i in range(2, 6)))
+
+        self.addCleanup(lambda: [JmModuleConfig.SCRAMBLE_CACHE.pop(f'90000{i}', None) for i in range(1, 6)])
+        with patch.object(JmApiAdaptTool, 'parse_entity', self.parse_entity):
+            photo_list = asyncio.run(run_test())
+
+        self.assertEqual(4, request_list.count(AsyncJmApiClient.API_CHAPTER))
+        self.assertEqual(1, request_list.count(AsyncJmApiClient.API_ALBUM))
+        self.assertEqual(1, len(scramble_list))
+        self.assertEqual({'220980'}, {photo.scramble_id for photo in photo_list})
+        self.assertEqual(4, len({id(photo.from_album) for photo in photo_list}))
+
+    def test_error_is_shared_and_not_kept(self):
+        call_count = [0]
+
+        async def req_api(_url, **_kwargs):
+            call_count[0] += 1
+            await asyncio.sleep(0.01)
+            raise ConnectionError('reset')
+
+        async def run_test():
+            client = self.new_client(req_api)
+            result_list = await asyncio.gather(*(client.get_album_detail('123') for _ in range(3)),
+                                               return_exceptions=True)
+            return client, result_list
+
+        client, result_list = asyncio.run(run_test())
+        self.assertEqual(1, call_count[0])
+        self.assertTrue(all(isinstance(e, ConnectionError) for e in result_list))
+        self.assertEqual({}, client._flight_dict)
+
+    def test_cancelled_caller_does_not_cancel_others(self):
+        async def req_api(_url, params=None, **_kwargs):
+            await asyncio.sleep(0.05)
+            return SimpleNamespace(encoded_data='x', res_data={'name': 'album', 'album_id': params['id']})
+
+        async def run_test():
+            client = self.new_client(req_api)
+            first = asyncio.ensure_future(client.get_album_detail('123'))
+            second = asyncio.ensure_future(client.get_album_detail('123'))
+            await asyncio.sleep(0.01)
+            first.cancel()
+            return await second
+
+        with patch.object(JmApiAdaptTool, 'parse_entity', self.parse_entity):
+            album = asyncio.run(run_test())
+        self.assertEqual('123', album.album_id)
+
+
+class Test_Photo_Prefetch(unittest.TestCase):
+
+    def test_resolve_prefetches_next_photos_once(self):
+        photo_list = [f'photo{i}' for i in range(5)]
+        event_list = []
+        lock = threading.Lock()
+
+        def check_photo(photo):
+            with lock:
+                event_list.append(('check', photo))
+            time.sleep(0.01)
+
+        with ThreadPoolExecutor(2) as executor:
+            prefetcher = PhotoPrefetcher(photo_list, 2, check_photo, executor)
+            for photo in photo_list:
+                prefetcher.resolve(photo)
+                with lock:
+                    event_list.append(('resolved', photo))
+            prefetcher.close()
+
+        check_list = [photo for event, photo in event_list if event == 'check']
+        self.assertEqual(sorted(photo_list), sorted(check_list))
+        # 第一个章节补全完成时，之后两个章节已经开始预取
+        self.assertLess(event_list.index(('check', 'photo2')), event_list.index(('resolved', 'photo0')))
+
+    def test_prefetch_error_raised_by_its_photo(self):
+        def check_photo(photo):
+            if photo == 'photo1':
+                raise ConnectionError('reset')
+
+        with ThreadPoolExecutor(1) as executor:
+            prefetcher = PhotoPrefetcher(['photo0', 'photo1', 'photo2'], 1, check_photo, executor)
+            prefetcher.resolve('photo0')
+            with self.assertRaises(ConnectionError):
+                prefetcher.resolve('photo1')
+            prefetcher.resolve('photo2')
+
+    def test_sync_downloader_prefetches_while_photo_downloads(self):
+        album = JmAlbumDetail(album_id='123', scramble_id='220980', name='album',
+                              episode_list=[(str(400 + i), str(i + 1), f'photo{i}') for i in range(4)],
+                              page_count=0, pub_date='', update_date='', likes='0', views='0',
+                              comment_count=0, works=[], actors=[], authors=['author'], tags=['tag'])
+        event_list = []
+        lock = threading.Lock()
+
+        class Client:
+
+            @staticmethod
+            def check_photo(photo):
+                with lock:
+                    event_list.append(('check', photo.photo_id))
+                time.sleep(0.01)
+
+        class PrefetchDownloader(JmDownloader):
+
+            def create_client(self):
+                return Client()
+
+            def download_by_photo_detail(self, photo):
+                self.check_photo(photo)
+                time.sleep(0.05)
+                with lock:
+                    event_list.append(('done', photo.photo_id))
+
+        option = JmOption.default()
+        option.download.threading.photo = 1
+        with PrefetchDownloader(option) as dler:
+            dler.download_by_album_detail(album)
+            self.assertEqual({}, dler._prefetcher_dict)
+
+        self.assertEqual(4, len([e for e in event_list if e[0] == 'check']))
+        # photo 线程池只有一个线程，第一个章节完成前，后两个章节的元数据已经获取
+        self.assertLess(event_list.index(('check', '402')), event_list.index(('done', '400')))
+
+    def test_downloader_without_with_releases_threads(self):
+        album = JmAlbumDetail(album_id='123', scramble_id='220980', name='album',
+                              episode_list=[(str(400 + i), str(i + 1), f'photo{i}') for i in range(4)],
+                              page_count=0, pub_date='', update_date='', likes='0', views='0',
+                              comment_count=0, works=[], actors=[], authors=['author'], tags=['tag'])
+
+        class Client:
+
+            @staticmethod
+            def check_photo(photo):
+                time.sleep(0.01)
+
+        class PoolDownloader(JmDownloader):
+
+            def create_client(self):
+                return Client()
+
+            def download_by_photo_detail(self, photo):
+                self.check_photo(photo)
+                time.sleep(0.01)
+
+        option = JmOption.default()
+        option.download.threading.photo = 2
+        baseline = set(threading.enumerate())
+        dler = PoolDownloader(option)
+
+        for _ in range(2):
+            # 不使用 with，每次下载结束后线程池都会关闭，再次下载时重新创建
+            dler.download_by_album_detail(album)
+            self.assertEqual({}, dler._executor_dict)
+
+            for t in set(threading.enumerate()) - baseline:
+                t.join(5)
+            self.assertEqual(set(), {t for t in threading.enumerate() if t.is_alive()} - baseline)
+
+    def test_prefetch_disabled(self):
+        option = JmOption.default()
+        option.download.threading.prefetch = 0
+        dler = BaseDownloader(option)
+        self.assertIsNone(dler.begin_prefetch(['photo0', 'photo1']))
+
+    def test_async_resolve_runs_prefetch_in_parallel(self):
+        from jmcomic.jm_async_downloader import AsyncPhotoPrefetcher
+        running, max_running = [0], [0]
+        check_list = []
+
+        async def check_photo(photo):
+            check_list.append(photo)
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+            await asyncio.sleep(0.01)
+            running[0] -= 1
+
+        async def run_test():
+            prefetcher = AsyncPhotoPrefetcher([f'photo{i}' for i in range(4)], 2, check_photo)
+            for i in range(4):
+                await prefetcher.resolve(f'photo{i}')
+            prefetcher.close()
+
+        asyncio.run(run_test())
+        self.assertEqual([f'photo{i}' for i in range(4)], check_list)
+        self.assertEqual(3, max_running[0])
+
+
+class Test_Async_Batch_Engine(unittest.TestCase):
+
+    class FakeClient:
+
+        def __init__(self, fail_setup=False):
+            self.fail_setup = fail_setup
+            self.setup_count = 0
+            self.close_count = 0
+
+        async def setup(self):
+            self.setup_count += 1
+            if self.fail_setup:
+                raise ConnectionError('handshake')
+
+        async def close(self):
+            self.close_count += 1
+
+    def new_option(self, client_list, fail_setup=False):
+        option = JmOption.default()
+
+        def new_jm_async_client(**_kwargs):
+            client = self.FakeClient(fail_setup)
+            client_list.append(client)
+            return client
+
+        option.new_jm_async_client = new_jm_async_client
+        return option
+
+    @staticmethod
+    def new_downloader_class(running, max_running):
+        class BatchDownloader(JmAsyncDownloader):
+
+            async def download_album(self, album_id):
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+                await asyncio.sleep(0.01)
+                running[0] -= 1
+
+                album = JmAlbumDetail(album_id=album_id, scramble_id='220980', name=album_id,
+                                      episode_list=[], page_count=0, pub_date='', update_date='', likes='0',
+                                      views='0', comment_count=0, works=[], actors=[], authors=[], tags=[])
+                self.begin_manifest(album).image_filepath_list.append(f'{album_id}.jpg')
+                self.finish_manifest = lambda _album: None
+                return album
+
+        return BatchDownloader
+
+    def test_batch_shares_one_engine(self):
+        client_list = []
+        running, max_running = [0], [0]
+        option = self.new_option(client_list)
+        option.download.threading.album = 2
+
+        result = asyncio.run(download_batch_async(
+            download_album_async, ['1', '2', '3', '4'], option,
+            self.new_downloader_class(running, max_running),
+        ))
+
+        self.assertTrue(result.all_succeeded)
+        self.assertEqual(1, len(client_list))
+        self.assertEqual((1, 1), (client_list[0].setup_count, client_list[0].close_count))
+        self.assertEqual(2, max_running[0])
+
+        dler_list = [r.downloader for r in result]
+        self.assertEqual(4, len({id(dler) for dler in dler_list}))
+        self.assertEqual(1, len({id(dler.engine) for dler in dler_list}))
+        self.assertTrue(dler_list[0].engine.decode_pool._shutdown)
+        self.assertEqual({f'{r.detail.album_id}.jpg' for r in result},
+                         {r.manifest.image_filepath_list[0] for r in result})
+
+    def test_engine_setup_failure_raises_without_reading_ids(self):
+        client_list = []
+        pulled = []
+
+        def id_gen():
+            # 无限长的 id 来源
+            while True:
+                pulled.append(len(pulled))
+                yield str(len(pulled))
+
+        async def run_test():
+            async for _item in download_batch_stream_async(
+                    download_album_async, id_gen(), self.new_option(client_list, fail_setup=True),
+                    self.new_downloader_class([0], [0]),
+            ):
+                pass
+
+        with self.assertRaises(ConnectionError):
+            asyncio.run(run_test())
+
+        self.assertEqual([], pulled)
+        self.assertEqual(1, client_list[0].close_count)
+
+    def test_batch_records_every_id_failed_on_engine_setup_failure(self):
+        client_list = []
+        running, max_running = [0], [0]
+
+        result = asyncio.run(download_batch_async(
+            download_album_async, ['1', '2', '2', '3'], self.new_option(client_list, fail_setup=True),
+            self.new_downloader_class(running, max_running),
+        ))
+
+        self.assertIsInstance(result, BatchResult)
+        self.assertEqual(0, len(result))
+        self.assertEqual({'1', '2', '3'}, set(result.failed))
+        self.assertTrue(all(isinstance(e, ConnectionError) for e in result.failed.values()))
+        self.assertEqual(0, max_running[0])
+        self.assertEqual(1, client_list[0].close_count)
+
+    def test_single_download_owns_engine(self):
+        client_list = []
+        result = asyncio.run(download_album_async('1', self.new_option(client_list),
+                                                  self.new_downloader_class([0], [0])))
+
+        self.assertEqual(1, len(client_list))
+        self.assertIsNone(result.downloader.client)
+        self.assertTrue(result.downloader._decode_pool._shutdown)
+
+
+class Test_Streaming_Batch(unittest.TestCase):
+
+    def test_in_flight_is_uncapped_by_default(self):
+        from jmcomic.api import _decide_max_in_flight
+
+        option = JmOption.default()
+        self.assertIsNone(_decide_max_in_flight(option, None))
+        self.assertEqual(3, _decide_max_in_flight(option, 3))
+
+        option.download.threading.album = 2
+        self.assertEqual(2, _decide_max_in_flight(option, None))
+
+    def test_sync_stream_bounds_in_flight_and_pulls_lazily(self):
+        pulled = []
+        lock = threading.Lock()
+        running, max_running = [0], [0]
+
+        def id_gen():
+            for i in [1, 2, 2, 3, 4, 5, 6]:
+                pulled.append(i)
+                yield i
+
+        def fake_download(jmid, _option, _downloader, **_kwargs):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+            if jmid == '4':
+                raise ValueError('404')
+            return jmid
+
+        stream = download_batch_iter(fake_download, id_gen(), option=object(), max_in_flight=2)
+        first = next(stream)
+        # 第一个结果产出时，最多只读取了在途上限附近的 id
+        self.assertLessEqual(len(pulled), 4)
+        item_list = [first] + list(stream)
+
+        self.assertEqual(2, max_running[0])
+        self.assertEqual({'1', '2', '3', '5', '6'}, {item.result for item in item_list if item.succeeded})
+        self.assertEqual(['4'], [item.jm_id for item in item_list if not item.succeeded])
+        self.assertIsInstance(item_list[[item.jm_id for item in item_list].index('4')].error, ValueError)
+
+    def test_sync_stream_yields_base_exception_instead_of_hanging(self):
+        def fake_download(jmid, _option, _downloader, **_kwargs):
+            if jmid == '2':
+                raise SystemExit(1)
+            return jmid
+
+        # 异常仍会在线程中抛出，这里不打印
+        with patch.object(threading, 'excepthook', lambda _args: None):
+            item_list = list(download_batch_iter(fake_download, ['1', '2'], option=object(), max_in_flight=1))
+
+        self.assertEqual(['1', '2'], [item.jm_id for item in item_list])
+        self.assertIsInstance(item_list[1].error, SystemExit)
+
+    def test_async_stream_yields_in_completion_order(self):
+        async def id_gen():
+            for jmid in ['1', '2', '3']:
+                yield jmid
+
+        async def fake_download(jmid, _option, _downloader, **_kwargs):
+            await asyncio.sleep({'1': 0.05, '2': 0.01, '3': 0.02}[jmid])
+            return jmid
+
+        async def run_test():
+            return [item.jm_id async for item in download_batch_stream_async(fake_download, id_gen(), object())]
+
+        self.assertEqual(['2', '3', '1'], asyncio.run(run_test()))
+
+    def test_async_stream_bounds_in_flight_and_cancels_on_close(self):
+        running, max_running = [0], [0]
+        cancelled = []
+
+        async def fake_download(jmid, _option, _downloader, **_kwargs):
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+            try:
+                await asyncio.sleep(0.01 if jmid == '1' else 1)
+            except asyncio.CancelledError:
+                cancelled.append(jmid)
+                raise
+            finally:
+                running[0] -= 1
+            return jmid
+
+        async def run_test():
+            stream = download_batch_stream_async(fake_download, (str(i) for i in range(1, 100)), object(),
+                                                 max_in_flight=3)
+            item = await stream.__anext__()
+            await stream.aclose()
+            return item
+
+        item = asyncio.run(run_test())
+        self.assertEqual('1', item.jm_id)
+        self.assertEqual(3, max_running[0])
+        # 产出第一个结果时还没有开始第4个下载，关闭时取消剩下的2个
+        self.assertEqual(['2', '3'], sorted(cancelled))
+        self.assertEqual(0, running[0])
+
+    def test_batch_result_collects_items(self):
+        result = download_batch(lambda jmid, *_args, **_kwargs: int(jmid) // (int(jmid) - 1), ['1', '2'],
+                                option=object())
+        self.assertEqual({2}, set(result))
+        self.assertIsInstance(result.failed['1'], ZeroDivisionError)
@@ -0,0 +1,348 @@
+import asyncio
+import json
+import multiprocessing
+import tempfile
+from types import SimpleNamespace
+
+from test_jmcomic import *
+from jmcomic.jm_async_client import AsyncJmApiClient
+
+ALBUM_RES_DATA = {
+    'id': '123',
+    'name': 'album',
+    'author': ['author'],
+    'images': [],
+    'description': '',
+    'total_views': '0',
+    'likes': '0',
+    'series': [],
+    'comment_total': '0',
+    'tags': ['tag'],
+    'works': [],
+    'actors': [],
+    'related_list': [],
+}
+
+
+UNPICKLED = []
+
+
+class Payload:
+
+    def __reduce__(self):
+        return UNPICKLED.append, ('executed',)
+
+
+def write_keys(path, prefix):
+    cache = DiskCache(path)
+    for i in range(20):
+        cache[('search', prefix, i)] = i
+
+
+class DiskCacheTestClient(JmApiClient):
+    client_key = 'disk_cache_test'
+
+    def __init__(self, *args, **kwargs):
+        self.request_count = 0
+        super().__init__(*args, **kwargs)
+
+    def after_init(self):
+        pass
+
+    def fetch_detail_entity(self, jmid, clazz):
+        self.request_count += 1
+        return JmApiAdaptTool.parse_entity(dict(ALBUM_RES_DATA, id=jmid), clazz)
+
+    def fetch_scramble_id(self, photo_id):
+        self.request_count += 1
+        return '220980'
+
+
+class Test_Disk_Cache(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.path = os.path.join(self.tmp_dir, 'cache.sqlite3')
+
+    def new_option(self):
+        option = JmOption.default()
+        option.dir_rule.base_dir = self.tmp_dir
+        return option
+
+    def test_entity_round_trip_and_persistence(self):
+        album = JmApiAdaptTool.parse_entity(ALBUM_RES_DATA, JmModuleConfig.album_class())
+        key = ('detail', '123', JmModuleConfig.album_class())
+        DiskCache(self.path)[key] = album
+
+        # 新的实例（模拟进程重启）读到同一份数据
+        cache = DiskCache(self.path)
+        cached = cache[key]
+        self.assertIsInstance(cached, JmAlbumDetail)
+        self.assertEqual((album.id, album.name, album.tags), (cached.id, cached.name, cached.tags))
+        self.assertIn(key, cache)
+        self.assertEqual(1, len(cache))
+        self.assertEqual('album', DiskCache.kind_of(key))
+
+    def test_values_stored_as_json(self):
+        album = new_album()
+        page = JmSearchPage.wrap_single_album(album, 1)
+        value = {'page': page, 'raw': b'\x00\xff', 'ids': {('a', 1), ('b', 2)}, 1: [None, 1.5, True]}
+        cache = DiskCache(self.path)
+        cache[('search', 'query', 1)] = value
+
+        text = cache._conn().execute('SELECT value FROM cache').fetchone()[0]
+        self.assertIsInstance(json.loads(text), dict)
+
+        cached = DiskCache(self.path)[('search', 'query', 1)]
+        self.assertIsInstance(cached['page'], JmSearchPage)
+        self.assertEqual((page.content, page.total, page.page_number),
+                         (cached['page'].content, cached['page'].total, cached['page'].page_number))
+        self.assertEqual(album.__dict__, cached['page'].single_album.__dict__)
+        self.assertEqual((b'\x00\xff', {('a', 1), ('b', 2)}, [None, 1.5, True]),
+                         (cached['raw'], cached['ids'], cached[1]))
+
+        # 不能转为 JSON 的值不写入
+        cache[('search', 'query', 2)] = object()
+        self.assertNotIn(('search', 'query', 2), cache)
+
+    def test_untrusted_row_is_not_executed(self):
+        import pickle
+        cache = DiskCache(self.path)
+        cache[('scramble', '1')] = '220980'
+        cache[('scramble', '2')] = '220980'
+
+        # 能写缓存文件的人写入 pickle 数据，或者伪造一个非实体的类名
+        with cache._conn() as conn:
+            conn.execute('UPDATE cache SET value = ? WHERE key = ?',
+                         (pickle.dumps(Payload()), DiskCache.key_to_str(('scramble', '1'))))
+            conn.execute('UPDATE cache SET value = ? WHERE key = ?',
+                         ('{"@":"entity","cls":"os._wrap_close","state":{"@":"dict","v":[]}}',
+                          DiskCache.key_to_str(('scramble', '2'))))
+
+        self.assertIsNone(cache.get(('scramble', '1')))
+        self.assertIsNone(cache.get(('scramble', '2')))
+        self.assertEqual([], UNPICKLED)
+
+    def test_ttl_by_kind(self):
+        cache = DiskCache(self.path, ttl={'search': -1})
+        cache[('search', 'query', 1)] = 'page'
+        cache[('scramble', '123')] = '220980'
+
+        self.assertIsNone(cache.get(('search', 'query', 1)))
+        self.assertNotIn(('search', 'query', 1), cache)
+        self.assertEqual('220980', cache[('scramble', '123')])
+        with self.assertRaises(KeyError):
+            _ = cache[('search', 'query', 1)]
+
+    def test_pop_and_purge(self):
+        cache = DiskCache(self.path, ttl={'search': -1})
+        cache[('scramble', '1')] = '1'
+        self.assertEqual('1', cache.pop(('scramble', '1')))
+        self.assertIsNone(cache.pop(('scramble', '1'), None))
+
+        cache[('search', 'a')] = 'a'
+        cache[('search', 'b')] = 'b'
+        self.assertEqual(2, cache.purge_expired())
+
+    def test_concurrent_processes(self):
+        ctx = multiprocessing.get_context('spawn')
+        process_list = [ctx.Process(target=write_keys, args=(self.path, f'p{i}')) for i in range(3)]
+        DiskCache(self.path)
+        for p in process_list:
+            p.start()
+        for p in process_list:
+            p.join(60)
+
+        self.assertEqual([0, 0, 0], [p.exitcode for p in process_list])
+        self.assertEqual(60, len(DiskCache(self.path)))
+
+    def test_sync_client_level_disk(self):
+        option = self.new_option()
+        option.client.src_dict['disk_cache']['ttl'] = {'album': 60}
+
+        def new_client():
+            client = DiskCacheTestClient(postman=None, domain_list=['a.example'])
+            CacheRegistry.enable_client_cache_on_condition(option, client, 'level_disk')
+            return client
+
+        client = new_client()
+        self.assertIsInstance(client.get_cache_dict(), DiskCache)
+        self.assertEqual(60, client.get_cache_dict().ttl['album'])
+        self.assertTrue(file_exists(os.path.join(self.tmp_dir, '.jmcomic_cache.sqlite3')))
+        client.fetch_detail_entity('123', JmModuleConfig.album_class())
+
+        # 模拟进程重启：新的 DiskCache 对象，新的客户端
+        CacheRegistry.DISK_REGISTRY.pop(os.path.abspath(os.path.join(self.tmp_dir, '.jmcomic_cache.sqlite3')))
+        client = new_client()
+        album = client.fetch_detail_entity('123', JmModuleConfig.album_class())
+        self.assertEqual(0, client.request_count)
+        self.assertEqual('123', album.id)
+
+        JmModuleConfig.SCRAMBLE_CACHE.pop('900001', None)
+        self.assertEqual('220980', client.get_scramble_id('900001'))
+        JmModuleConfig.SCRAMBLE_CACHE.pop('900001', None)
+        self.assertEqual('220980', client.get_scramble_id('900001'))
+        self.assertEqual(1, client.request_count)
+        JmModuleConfig.SCRAMBLE_CACHE.pop('900001', None)
+
+    def test_async_client_uses_disk_cache(self):
+        request_list = []
+
+        async def req_api(url, params=None, **_kwargs):
+            request_list.append((url, params['id']))
+            return SimpleNamespace(encoded_data='x', res_data=ALBUM_RES_DATA)
+
+        async def get_album():
+            client = AsyncJmApiClient(JmOption.default(), domain_list=['api.example'])
+            client.set_cache_dict(DiskCache(self.path))
+            client.req_api = req_api
+            return await client.get_album_detail('123')
+
+        first = asyncio.run(get_album())
+        second = asyncio.run(get_album())
+        self.assertEqual(1, len(request_list))
+        self.assertEqual(first.tags, second.tags)
+
+
+class Test_Bounded_Cache(unittest.TestCase):
+
+    def test_lru_evicts_least_recently_used(self):
+        cache = LruCache(max_entries=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(1, cache['a'])
+        cache['c'] = 3
+
+        self.assertNotIn('b', cache)
+        self.assertEqual((1, 3), (cache['a'], cache['c']))
+        self.assertEqual((2, 1), (len(cache), cache.evict_count))
+
+    def test_max_bytes(self):
+        cache = LruCache(max_bytes=LruCache.size_of(b'x' * 100) * 2)
+        for key in 'abc':
+            cache[key] = b'x' * 100
+
+        self.assertEqual(['b', 'c'], [k for k in 'abc' if k in cache])
+        self.assertLessEqual(cache.size, cache.max_bytes)
+        cache.pop('b')
+        cache.clear()
+        self.assertEqual((0, 0), (len(cache), cache.size))
+
+    def test_ttl(self):
+        cache = LruCache(ttl=-1)
+        cache['a'] = 1
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(0, len(cache))
+
+    def test_scramble_cache_is_bounded(self):
+        self.assertIsInstance(JmModuleConfig.SCRAMBLE_CACHE, LruCache)
+        self.assertIsNotNone(JmModuleConfig.SCRAMBLE_CACHE.max_entries)
+
+    def test_registry_creates_bounded_cache_from_config(self):
+        option = JmOption.construct({'client': {'cache': {'level': 'level_client', 'max_entries': 2, 'ttl': None}}})
+        client = DiskCacheTestClient(postman=None, domain_list=['a.example'])
+        CacheRegistry.enable_client_cache_on_condition(option, client, option.client.cache)
+
+        cache = client.get_cache_dict()
+        self.assertIsInstance(cache, LruCache)
+        self.assertEqual((2, None), (cache.max_entries, cache.ttl))
+        for jmid in ['1', '2', '3']:
+            client.fetch_detail_entity(jmid, JmModuleConfig.album_class())
+        self.assertEqual(2, len(cache))
+
+        # 不配置上限时依然是 dict
+        option_client = DiskCacheTestClient(postman=None, domain_list=['a.example'])
+        CacheRegistry.enable_client_cache_on_condition(option, option_client, 'level_option')
+        self.assertIs(dict, type(option_client.get_cache_dict()))
+
+    def test_registry_releases_dropped_owner(self):
+        import gc
+        import weakref
+        option = JmOption.default()
+        client = DiskCacheTestClient(None, [])
+        CacheRegistry.enable_client_cache_on_condition(option, client, {'max_entries': 10})
+        self.assertIn(option, CacheRegistry.REGISTRY)
+        option_ref, cache_ref = weakref.ref(option), weakref.ref(client.get_cache_dict())
+
+        del option, client
+        gc.collect()
+        self.assertIsNone(option_ref())
+        self.assertIsNone(cache_ref())
+
+
+def new_album(episode_count=3):
+    return JmAlbumDetail(
+        album_id='123',
+        scramble_id='220980',
+        name='album',
+        episode_list=[(str(1000 + i), str(i + 1), f'photo-{i}') for i in range(episode_count)],
+        page_count=10,
+        pub_date='',
+        update_date='',
+        likes='0',
+        views='0',
+        comment_count=0,
+        works=[],
+        actors=[],
+        authors=['author'],
+        tags=['tag'],
+        related_list=[{'id': '1', 'name': 'related'}],
+    )
+
+
+class Test_Entity_Snapshot(unittest.TestCase):
+
+    def test_materialize_returns_independent_entity(self):
+        album = new_album()
+        snapshot = album.snapshot()
+        first, second = snapshot.materialize(), snapshot.materialize()
+
+        self.assertIsInstance(first, JmAlbumDetail)
+        self.assertEqual(album.__dict__, first.__dict__)
+        first.tags.append('mutated')
+        first.related_list[0]['name'] = 'mutated'
+        first.episode_list.pop()
+        first.save_path = '/download/123'
+
+        self.assertEqual(['tag'], second.tags)
+        self.assertEqual('related', second.related_list[0]['name'])
+        self.assertEqual(3, len(second))
+        self.assertEqual('', second.save_path)
+        self.assertEqual(['tag'], snapshot.materialize().tags)
+        # 不可变字段直接共享
+        self.assertIs(first.name, second.name)
+        self.assertIs(first.episode_list[0], second.episode_list[0])
+
+    def test_photo_with_album(self):
+        album = new_album()
+        photo = JmPhotoDetail(photo_id='1000', name='photo', series_id='123', sort=1, scramble_id='220980',
+                              page_arr=['00001.webp'], data_original_domain='cdn.example', from_album=album)
+        snapshot = photo.snapshot()
+        first, second = snapshot.materialize(), snapshot.materialize()
+
+        self.assertIsNot(first.from_album, second.from_album)
+        self.assertEqual('123', first.from_album.album_id)
+        first.page_arr.append('00002.webp')
+        self.assertEqual(1, len(second))
+        self.assertEqual('https://cdn.example/media/photos/1000/00001.webp', second[0].img_url.split('?')[0])
+
+    def test_snapshot_survives_disk_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = DiskCache(os.path.join(tmp_dir, 'cache.sqlite3'))
+            cache[('detail', '123', JmAlbumDetail)] = new_album().snapshot()
+            album = cache[('detail', '123', JmAlbumDetail)].materialize()
+        self.assertEqual(new_album().__dict__, album.__dict__)
+
+    def test_sync_cache_stores_snapshot(self):
+        client = DiskCacheTestClient(postman=None, domain_list=['a.example'])
+        client.set_cache_dict({})
+        first = client.fetch_detail_entity('123', JmModuleConfig.album_class())
+        first.tags.append('mutated')
+        second = client.fetch_detail_entity('123', JmModuleConfig.album_class())
+
+        self.assertEqual(1, client.request_count)
+        self.assertIsInstance(next(iter(client.get_cache_dict().values())), EntitySnapshot)
+        self.assertIsNot(first, second)
+        self.assertEqual(['tag'], second.tags)
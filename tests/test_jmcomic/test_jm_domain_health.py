@@ -0,0 +1,539 @@
+import asyncio
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from test_jmcomic import *
+from jmcomic.jm_async_client import AsyncJmApiClient
+
+
+class HealthTestClient(AbstractJmClient):
+    client_key = 'domain_health_test'
+    retry_policy = RetryPolicy(backoff_base=0)
+
+
+class FakeResp:
+
+    def __init__(self, status_code=200, text='{}', content=b'image', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.content = content
+        self.headers = headers or {}
+        self.url = ''
+
+
+def resp_error(status_code, headers=None):
+    try:
+        ExceptionTool.raises_resp(f'HTTP状态码: {status_code}', FakeResp(status_code, headers=headers))
+    except Exception as e:
+        return e
+
+
+class FakeStreamResp:
+    """流式响应，chunk 为异常时读到这里抛出（模拟读响应体时连接中断）"""
+
+    def __init__(self, url, chunk_list):
+        self.status_code = 200
+        self.url = url
+        self.chunk_list = chunk_list
+        self.stream_task = self.astream_task = object()
+        self.closed = False
+
+    def iter_content(self, _chunk_size=None):
+        for chunk in self.chunk_list:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    async def aiter_content(self, _chunk_size=None):
+        for chunk in self.iter_content():
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+    async def aclose(self):
+        self.closed = True
+
+
+IMAGE_HOST_LIST = ['img-a.example', 'img-b.example', 'img-c.example']
+IMAGE_URL = 'https://img-a.example/media/photos/123/00001.webp?v=1'
+
+
+class Test_Domain_Health(unittest.TestCase):
+
+    def setUp(self):
+        DomainHealthRegistry.reset()
+        # 测试中不启动后台探测线程
+        patcher = patch.object(DomainHealthRegistry, '_start_probe_thread')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(DomainHealthRegistry.reset)
+
+    def test_rank_by_latency_and_demote_failed_domain(self):
+        domain_list = ['a.example', 'b.example', 'c.example']
+        self.assertEqual(domain_list, DomainHealthRegistry.rank(domain_list))
+
+        DomainHealthRegistry.record_success('a.example', 2.0)
+        DomainHealthRegistry.record_success('b.example', 0.2)
+        DomainHealthRegistry.record_success('c.example', 0.1)
+        self.assertEqual(['c.example', 'b.example', 'a.example'], DomainHealthRegistry.rank(domain_list))
+
+        DomainHealthRegistry.record_failure('c.example')
+        DomainHealthRegistry.record_failure('c.example')
+        self.assertTrue(DomainHealthRegistry.is_demoted('c.example'))
+        self.assertEqual(['b.example', 'a.example', 'c.example'], DomainHealthRegistry.rank(domain_list))
+        # 不修改传入的列表
+        self.assertEqual(['a.example', 'b.example', 'c.example'], domain_list)
+
+    def test_unknown_domain_is_tried_before_slow_domain(self):
+        DomainHealthRegistry.record_success('a.example', 1.0)
+        self.assertEqual(['b.example', 'a.example'], DomainHealthRegistry.rank(['a.example', 'b.example']))
+
+    def test_probe_restores_demoted_domain(self):
+        for _ in range(3):
+            DomainHealthRegistry.record_failure('a.example')
+
+        probe_url_list = []
+
+        def get(url, **_kwargs):
+            probe_url_list.append(url)
+            return FakeResp(404)
+
+        with patch.object(DomainHealthRegistry, 'probe_postman', SimpleNamespace(get=get)):
+            for _ in range(3):
+                DomainHealthRegistry.probe_demoted()
+
+        # 探测成功后恢复，之后不再探测
+        self.assertEqual([f'{JmModuleConfig.PROT}a.example'], probe_url_list)
+        self.assertFalse(DomainHealthRegistry.is_demoted('a.example'))
+
+    def test_sync_client_uses_ranked_domain_and_records_result(self):
+        DomainHealthRegistry.record_failure('a.example')
+        DomainHealthRegistry.record_failure('a.example')
+        client = HealthTestClient(postman=None, domain_list=['a.example', 'b.example'], retry_times=1)
+
+        url_list = []
+
+        def request(url, **_kwargs):
+            url_list.append(url)
+            if 'a.example' in url:
+                raise ValueError('dead domain')
+            return FakeResp()
+
+        client.request_with_retry(request, '/album')
+        self.assertEqual(['b.example'], [JmcomicText.parse_to_jm_domain(url) for url in url_list])
+        self.assertEqual(1, DomainHealthRegistry.snapshot()['b.example']['success'])
+
+    def test_sync_client_retry_keeps_order_of_first_rank(self):
+        client = HealthTestClient(postman=None, domain_list=['a.example', 'b.example'], retry_times=1)
+        url_list = []
+
+        def request(url, **_kwargs):
+            url_list.append(url)
+            if 'a.example' in url:
+                raise ValueError('dead domain')
+            return FakeResp()
+
+        client.request_with_retry(request, '/album')
+        self.assertEqual(['a.example', 'a.example', 'b.example'],
+                         [JmcomicText.parse_to_jm_domain(url) for url in url_list])
+        self.assertTrue(DomainHealthRegistry.is_demoted('a.example'))
+
+    def test_async_client_shares_registry(self):
+        DomainHealthRegistry.record_failure('a.example')
+        DomainHealthRegistry.record_failure('a.example')
+
+        async def run_test():
+            option = JmOption.default()
+            option.client.src_dict['retry_times'] = 0
+            client = AsyncJmApiClient(option, domain_list=['a.example', 'b.example'])
+            url_list = []
+
+            async def get(url, **_kwargs):
+                url_list.append(url)
+                return FakeResp()
+
+            client._session = SimpleNamespace(get=get)
+            await client._request_with_retry('/album', headers={})
+            return url_list
+
+        url_list = asyncio.run(run_test())
+        self.assertEqual(['b.example'], [JmcomicText.parse_to_jm_domain(url) for url in url_list])
+        self.assertEqual(1, DomainHealthRegistry.snapshot()['b.example']['success'])
+
+
+class Test_Image_Host_Circuit_Breaker(unittest.TestCase):
+
+    def setUp(self):
+        ImageHostCircuitBreaker.reset()
+        self.addCleanup(ImageHostCircuitBreaker.reset)
+        patcher = patch.object(JmModuleConfig, 'DOMAIN_IMAGE_LIST', IMAGE_HOST_LIST)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def open_host(self, host):
+        for _ in range(ImageHostCircuitBreaker.FAILURE_THRESHOLD):
+            ImageHostCircuitBreaker.record_failure(host)
+
+    def test_candidate_url_list_rewrites_host(self):
+        self.assertEqual(
+            [
+                IMAGE_URL,
+                'https://img-b.example/media/photos/123/00001.webp?v=1',
+                'https://img-c.example/media/photos/123/00001.webp?v=1',
+            ],
+            ImageHostCircuitBreaker.candidate_url_list(IMAGE_URL),
+        )
+        cover_url = 'https://other.example/templates/cover.jpg'
+        self.assertEqual([cover_url], ImageHostCircuitBreaker.candidate_url_list(cover_url))
+
+    def test_open_host_is_skipped_then_half_open(self):
+        self.open_host('img-a.example')
+        self.assertTrue(ImageHostCircuitBreaker.is_open('img-a.example'))
+        self.assertEqual(['img-b.example', 'img-c.example'],
+                         [ImageHostCircuitBreaker.host_of(url)
+                          for url in ImageHostCircuitBreaker.candidate_url_list(IMAGE_URL)])
+
+        # 熔断时间过后放行一个试探请求
+        ImageHostCircuitBreaker.REGISTRY['img-a.example']['opened_at'] -= ImageHostCircuitBreaker.OPEN_DURATION
+        self.assertTrue(ImageHostCircuitBreaker.allow('img-a.example'))
+        self.assertFalse(ImageHostCircuitBreaker.allow('img-a.example'))
+
+        # 试探失败重新熔断
+        ImageHostCircuitBreaker.record_failure('img-a.example')
+        self.assertEqual('open', ImageHostCircuitBreaker.REGISTRY['img-a.example']['state'])
+
+        ImageHostCircuitBreaker.REGISTRY['img-a.example']['opened_at'] -= ImageHostCircuitBreaker.OPEN_DURATION
+        self.assertTrue(ImageHostCircuitBreaker.allow('img-a.example'))
+        ImageHostCircuitBreaker.record_success('img-a.example')
+        self.assertFalse(ImageHostCircuitBreaker.is_open('img-a.example'))
+
+    def test_all_hosts_open_still_requests_original_url(self):
+        for host in IMAGE_HOST_LIST:
+            self.open_host(host)
+        self.assertEqual([IMAGE_URL], ImageHostCircuitBreaker.candidate_url_list(IMAGE_URL))
+
+    def test_sync_image_request_fails_over_to_next_host(self):
+        client = HealthTestClient(postman=None, domain_list=['api.example'], retry_times=2)
+        url_list = []
+
+        def request(url, **_kwargs):
+            url_list.append(url)
+            if 'img-a.example' in url:
+                return FakeResp(status_code=502, content=b'')
+            return FakeResp()
+
+        resp = client.request_with_retry(request, IMAGE_URL, is_image=True)
+        self.assertIsInstance(resp, JmImageResp)
+        self.assertEqual(['img-a.example', 'img-b.example'],
+                         [ImageHostCircuitBreaker.host_of(url) for url in url_list])
+        self.assertEqual(1, ImageHostCircuitBreaker.REGISTRY['img-a.example']['failure'])
+
+    def test_sync_stream_body_failure_fails_over_to_next_host(self):
+        client = HealthTestClient(postman=None, domain_list=['api.example'], retry_times=2)
+        resp_list = []
+
+        def request(url, **kwargs):
+            self.assertTrue(kwargs['stream'])
+            self.assertNotIn('stream_to', kwargs)
+            chunk_list = {
+                'img-a.example': [b'half', ConnectionError('reset')],
+                'img-b.example': [],
+            }.get(ImageHostCircuitBreaker.host_of(url), [b'ima', b'ge'])
+            resp_list.append(FakeStreamResp(url, chunk_list))
+            return resp_list[-1]
+
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, '00001.webp')
+            resp = client.request_with_retry(request, IMAGE_URL, is_image=True, stream=True, stream_to=path)
+            with open(path, 'rb') as f:
+                self.assertEqual(b'image', f.read())
+            self.assertEqual(['00001.webp'], os.listdir(tmp))
+
+        self.assertEqual(5, resp.stream_size)
+        self.assertTrue(all(r.closed for r in resp_list))
+        self.assertEqual([1, 1], [ImageHostCircuitBreaker.REGISTRY[host]['failure'] for host in IMAGE_HOST_LIST[:2]])
+
+    def test_async_stream_body_failure_fails_over_to_next_host(self):
+        async def run_test(path):
+            option = JmOption.default()
+            option.client.src_dict['retry_times'] = 2
+            client = AsyncJmApiClient(option, domain_list=['api.example'])
+            client._has_setup = True
+
+            async def get(url, **_kwargs):
+                if 'img-a.example' in url:
+                    return FakeStreamResp(url, [b'half', ConnectionError('reset')])
+                return FakeStreamResp(url, [b'ima', b'ge'])
+
+            client._session = SimpleNamespace(get=get)
+            with patch('asyncio.sleep'):
+                return await client.get_jm_image(IMAGE_URL, stream=True, stream_to=path)
+
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, '00001.webp')
+            resp = asyncio.run(run_test(path))
+            with open(path, 'rb') as f:
+                self.assertEqual(b'image', f.read())
+            self.assertEqual(['00001.webp'], os.listdir(tmp))
+
+        self.assertEqual(5, resp.stream_size)
+        self.assertEqual(1, ImageHostCircuitBreaker.REGISTRY['img-a.example']['failure'])
+
+    def test_async_image_request_fails_over_to_next_host(self):
+        self.open_host('img-b.example')
+
+        async def run_test():
+            option = JmOption.default()
+            option.client.src_dict['retry_times'] = 2
+            client = AsyncJmApiClient(option, domain_list=['api.example'])
+            client._has_setup = True
+            url_list = []
+
+            async def get(url, **_kwargs):
+                url_list.append(url)
+                if 'img-a.example' in url:
+                    raise ConnectionError('reset')
+                return FakeResp()
+
+            client._session = SimpleNamespace(get=get)
+            with patch('asyncio.sleep') as sleep:
+                resp = await client.get_jm_image(IMAGE_URL)
+                self.assertEqual(1, sleep.call_count)
+            return resp, url_list
+
+        resp, url_list = asyncio.run(run_test())
+        self.assertEqual(b'image', resp.content)
+        self.assertEqual(['img-a.example', 'img-c.example'],
+                         [ImageHostCircuitBreaker.host_of(url) for url in url_list])
+
+
+class Test_Image_Hedge(unittest.TestCase):
+
+    def setUp(self):
+        ImageHostCircuitBreaker.reset()
+        self.addCleanup(ImageHostCircuitBreaker.reset)
+        patcher = patch.object(JmModuleConfig, 'DOMAIN_IMAGE_LIST', IMAGE_HOST_LIST)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_slow_primary(self, hedge):
+        async def run_test():
+            option = JmOption.default()
+            option.client.src_dict['hedge'] = hedge
+            client = AsyncJmApiClient(option, domain_list=['api.example'])
+            client._has_setup = True
+            client._image_latency_list.extend([0.01] * 5)
+            url_list, cancelled_list = [], []
+
+            async def get(url, **_kwargs):
+                url_list.append(url)
+                if 'img-a.example' in url:
+                    try:
+                        await asyncio.sleep(0.5)
+                    except asyncio.CancelledError:
+                        cancelled_list.append(url)
+                        raise
+                    return FakeResp(content=b'slow')
+                return FakeResp(content=b'fast')
+
+            client._session = SimpleNamespace(get=get)
+            resp = await client.get_jm_image(IMAGE_URL)
+            return client, resp, url_list, cancelled_list
+
+        return asyncio.run(run_test())
+
+    def test_slow_request_is_hedged_to_next_host(self):
+        client, resp, url_list, cancelled_list = self.run_slow_primary(
+            {'percentile': 0.9, 'budget': 1.0, 'min_sample': 5})
+
+        self.assertEqual(b'fast', resp.content)
+        self.assertEqual(['img-a.example', 'img-b.example'],
+                         [ImageHostCircuitBreaker.host_of(url) for url in url_list])
+        self.assertEqual([IMAGE_URL], cancelled_list)
+        self.assertEqual((1, 1), (client.image_request_count, client.image_hedge_count))
+
+    def test_hedge_respects_budget(self):
+        client, resp, url_list, cancelled_list = self.run_slow_primary(
+            {'percentile': 0.9, 'budget': 0.5, 'min_sample': 5})
+
+        self.assertEqual(b'slow', resp.content)
+        self.assertEqual([IMAGE_URL], url_list)
+        self.assertEqual(0, client.image_hedge_count)
+
+    def test_hedge_disabled_by_default(self):
+        client, resp, url_list, _ = self.run_slow_primary(JmModuleConfig.DEFAULT_OPTION_DICT['client']['hedge'])
+
+        self.assertEqual(b'slow', resp.content)
+        self.assertEqual([IMAGE_URL], url_list)
+
+
+class Test_Retry_Policy(unittest.TestCase):
+
+    def setUp(self):
+        DomainHealthRegistry.reset()
+        patcher = patch.object(DomainHealthRegistry, '_start_probe_thread')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(DomainHealthRegistry.reset)
+
+    def test_classify_by_status(self):
+        policy = RetryPolicy(status_action={500: 'abort'})
+        self.assertEqual('retry', policy.classify(ValueError('timeout')))
+        self.assertEqual('retry', policy.classify(resp_error(429)))
+        self.assertEqual('switch', policy.classify(resp_error(403)))
+        self.assertEqual('abort', policy.classify(resp_error(500)))
+        self.assertEqual('retry', policy.classify(resp_error(502)))
+
+    def test_delay_backoff_jitter_and_retry_after(self):
+        policy = RetryPolicy(backoff_base=1, backoff_max=5, jitter=False, retry_after_max=30)
+        self.assertEqual([1, 2, 4, 5], [policy.delay(i, ValueError()) for i in range(4)])
+        self.assertEqual(7, policy.delay(0, resp_error(429, {'Retry-After': '7'})))
+        self.assertEqual(30, policy.delay(0, resp_error(429, {'Retry-After': '120'})))
+
+        jitter_policy = RetryPolicy(backoff_base=1, backoff_max=5)
+        for _ in range(20):
+            self.assertTrue(0 <= jitter_policy.delay(2, ValueError()) <= 4)
+
+    def test_context_retry_switch_and_exhaust(self):
+        ctx = RetryPolicy(backoff_base=1, jitter=False).new_context(['a', 'b'], retry_times=1)
+        self.assertEqual(1, ctx.on_failure(ValueError()))
+        self.assertEqual(('a', 1), (ctx.target, ctx.retry_count))
+        self.assertEqual(0, ctx.on_failure(ValueError()))
+        self.assertEqual(('b', 0), (ctx.target, ctx.retry_count))
+        self.assertIsNone(ctx.on_failure(resp_error(403)))
+        self.assertFalse(ctx.aborted)
+
+    def test_context_abort_and_deadline(self):
+        ctx = RetryPolicy(status_action={404: 'abort'}).new_context(['a'], retry_times=3)
+        self.assertIsNone(ctx.on_failure(resp_error(404)))
+        self.assertTrue(ctx.aborted)
+
+        ctx = RetryPolicy(backoff_base=10, jitter=False, deadline=5).new_context(['a'], retry_times=3)
+        self.assertIsNone(ctx.on_failure(ValueError()))
+        self.assertFalse(ctx.aborted)
+
+    def test_sync_client_honors_retry_after_and_switches_on_403(self):
+        client = HealthTestClient(postman=None, domain_list=['a.example', 'b.example'], retry_times=2)
+        client.retry_policy = RetryPolicy(backoff_base=1, jitter=False)
+        error_list = [resp_error(429, {'Retry-After': '3'}), resp_error(403)]
+        url_list = []
+
+        def request(url, **_kwargs):
+            url_list.append(url)
+            if error_list:
+                raise error_list.pop(0)
+            return FakeResp()
+
+        with patch('time.sleep') as sleep:
+            client.request_with_retry(request, '/album')
+
+        self.assertEqual([3], [call.args[0] for call in sleep.call_args_list])
+        self.assertEqual(['a.example', 'a.example', 'b.example'],
+                         [JmcomicText.parse_to_jm_domain(url) for url in url_list])
+
+    def test_sync_client_abort_raises_original_error(self):
+        client = HealthTestClient(postman=None, domain_list=['a.example', 'b.example'], retry_times=2)
+        client.retry_policy = RetryPolicy(status_action={404: 'abort'})
+        error = resp_error(404)
+
+        def request(_url, **_kwargs):
+            raise error
+
+        with self.assertRaises(ResponseUnexpectedException) as cm:
+            client.request_with_retry(request, '/album')
+        self.assertIs(error, cm.exception)
+
+    def test_option_builds_retry_policy(self):
+        option = JmOption.default()
+        option.client.src_dict['retry']['deadline'] = 12
+        option.client.src_dict['retry']['status_action'] = {404: 'abort'}
+        with patch.dict(JmModuleConfig.REGISTRY_CLIENT, {HealthTestClient.client_key: HealthTestClient}):
+            client = option.new_jm_client(impl=HealthTestClient, domain_list=['a.example'])
+        self.assertEqual(12, client.retry_policy.deadline)
+        self.assertEqual('abort', client.retry_policy.status_action[404])
+        self.assertEqual('switch', client.retry_policy.status_action[403])
+
+        async_client = AsyncJmApiClient(option, domain_list=['a.example'])
+        self.assertEqual(12, async_client.retry_policy.deadline)
+
+
+class Test_Rate_Limiter(unittest.TestCase):
+
+    def setUp(self):
+        RateLimiter.reset()
+        self.addCleanup(RateLimiter.configure, None)
+        self.addCleanup(RateLimiter.reset)
+
+    def test_token_bucket_allows_burst_then_waits(self):
+        bucket = TokenBucket(rate=2, capacity=2)
+        self.assertEqual(0, bucket.reserve())
+        self.assertEqual(0, bucket.reserve())
+        self.assertAlmostEqual(0.5, bucket.reserve(), places=2)
+        # 一次扣除超过容量的令牌，欠账按速率换算为等待时间
+        self.assertAlmostEqual(3.0, bucket.reserve(5), places=2)
+
+    def test_disabled_by_default(self):
+        RateLimiter.configure(JmOption.default().client.get('rate_limit'))
+        for _ in range(100):
+            self.assertEqual(0, RateLimiter.reserve_request('https://a.example/album'))
+        self.assertEqual(100, RateLimiter.snapshot()['a.example']['request'])
+
+    def test_rps_per_host_and_host_override(self):
+        RateLimiter.configure({'api': {'rps': 1}, 'host': {'b.example': {'rps': 3}}})
+        self.assertEqual(0, RateLimiter.reserve_request('https://a.example/album'))
+        self.assertGreater(RateLimiter.reserve_request('https://a.example/album'), 0.9)
+        for _ in range(3):
+            self.assertEqual(0, RateLimiter.reserve_request('https://b.example/album'))
+        # 图片域名不受 api 配置限制
+        self.assertEqual(0, RateLimiter.reserve_request(IMAGE_URL, True))
+        self.assertEqual(0, RateLimiter.reserve_request(IMAGE_URL, True))
+
+        metric = RateLimiter.snapshot()['a.example']
+        self.assertEqual((2, 1), (metric['request'], metric['throttled']))
+
+    def test_global_rps_is_shared_by_all_hosts(self):
+        RateLimiter.configure({'global': {'rps': 2}})
+        self.assertEqual(0, RateLimiter.reserve_request('https://a.example/album'))
+        self.assertEqual(0, RateLimiter.reserve_request(IMAGE_URL, True))
+        self.assertGreater(RateLimiter.reserve_request('https://b.example/album'), 0.4)
+
+    def test_bandwidth_debt_delays_next_request(self):
+        RateLimiter.configure({'image': {'bps': 1000}})
+        self.assertEqual(0, RateLimiter.reserve_request(IMAGE_URL, True))
+        self.assertAlmostEqual(1.0, RateLimiter.reserve_bytes(IMAGE_URL, True, 2000), places=2)
+        self.assertGreater(RateLimiter.reserve_request(IMAGE_URL, True), 0.9)
+        self.assertEqual(2000, RateLimiter.snapshot()['img-a.example']['bytes'])
+
+    def test_sync_client_request_is_shaped(self):
+        RateLimiter.configure({'api': {'rps': 1}})
+        client = HealthTestClient(postman=SimpleNamespace(get=lambda url, **_kwargs: FakeResp(content=b'12345')),
+                                  domain_list=['a.example'],
+                                  retry_times=0)
+        with patch('time.sleep') as sleep:
+            client.get('/album')
+            client.get('/album')
+
+        self.assertEqual(1, sleep.call_count)
+        self.assertEqual((2, 10), (RateLimiter.snapshot()['a.example']['request'],
+                                   RateLimiter.snapshot()['a.example']['bytes']))
+
+    def test_async_image_request_is_shaped(self):
+        async def run_test():
+            option = JmOption.default()
+            option.client.src_dict['rate_limit']['image']['rps'] = 1
+            client = AsyncJmApiClient(option, domain_list=['api.example'])
+            client._has_setup = True
+
+            async def get(_url, **_kwargs):
+                return FakeResp()
+
+            client._session = SimpleNamespace(get=get)
+            with patch('asyncio.sleep') as sleep:
+                await client.get_jm_image(IMAGE_URL)
+                await client.get_jm_image(IMAGE_URL)
+                return sleep.call_count
+
+        self.assertEqual(1, asyncio.run(run_test()))
+        self.assertEqual(2, RateLimiter.snapshot()['img-a.example']['request'])
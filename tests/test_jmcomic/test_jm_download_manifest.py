@@ -1,6 +1,8 @@
 import asyncio
 import os
 import sys
+import threading
+import time
 from tempfile import TemporaryDirectory
 from types import SimpleNamespace
 from unittest.mock import patch
@@ -127,6 +129,24 @@ class ContractSyncDownloader(JmDownloader):
             apply(detail)
 
 
+class IndexedSyncDownloader(ContractSyncDownloader):
+
+    def do_filter(self, detail):
+        # 章节仍走 BaseDownloader.do_filter，以便批量加载已完成的图片
+        if detail is self._contract_photo:
+            JmDownloader.do_filter(self, detail)
+        return super().do_filter(detail)
+
+
+class PooledSyncDownloader(ContractSyncDownloader):
+    """走 JmDownloader 真实的调度逻辑（共享线程池）"""
+
+    execute_on_condition = JmDownloader.execute_on_condition
+
+    def do_filter(self, detail):
+        return detail
+
+
 class ContractAsyncClient:
 
     def __init__(self, album, photo):
@@ -144,6 +164,24 @@ class ContractAsyncClient:
         return None
 
 
+class AsyncStreamResp:
+    """模拟 AsyncSession 的流式响应"""
+
+    def __init__(self, chunk_list, status_code=200):
+        self.chunk_list = chunk_list
+        self.status_code = status_code
+        self.url = 'https://cdn.example/media/photos/456/00001.jpg'
+        self.astream_task = object()
+        self.closed = False
+
+    async def aiter_content(self, _chunk_size=None):
+        for chunk in self.chunk_list:
+            yield chunk
+
+    async def aclose(self):
+        self.closed = True
+
+
 class ContractAsyncDownloader(JmAsyncDownloader):
 
     def __init__(self, option, album, photo, image_list):
@@ -1021,6 +1059,196 @@ class Test_Download_Manifest(unittest.TestCase):
             self.assertEqual(downloader.manifest_dict[album].image_filepath_list, [final_path])
 
 
+    def test_unscrambled_image_passthrough_is_counted(self):
+        with TemporaryDirectory() as temp_dir:
+            album, _, image_list, option, downloader = self.new_downloader(temp_dir, image_count=2)
+            option.decide_download_image_decode = lambda _image: True
+            decode_args = []
+            client = downloader._contract_client
+            download = client.download_by_image_detail
+            client.download_by_image_detail = lambda image, save_path, decode_image: (
+                decode_args.append(decode_image), download(image, save_path, decode_image)
+            )
+
+            downloader.download_album(album.id)
+
+            # aid < scramble_id，分割数为0，配置了解密也按原图保存
+            self.assertEqual([False, False], decode_args)
+            self.assertTrue(all(image.passthrough for image in image_list))
+            self.assertEqual(2, downloader.manifest_dict[album].passthrough_image_count)
+
+    def test_cache_verify_redownloads_truncated_image(self):
+        with TemporaryDirectory() as temp_dir:
+            album, _, image_list, option, downloader = self.new_downloader(temp_dir, image_count=2)
+            self.create_cached_images(option, image_list)
+            # 第一张是完整的 gif，第二张是写了一半的 jpg
+            with open(option.decide_image_filepath(image_list[0]), 'wb') as f:
+                f.write(b'GIF89a' + b'0' * 10 + b'\x3b')
+            with open(option.decide_image_filepath(image_list[1]), 'wb') as f:
+                f.write(b'\xff\xd8\xff\xe0' + b'0' * 10)
+            option.download.cache_verify = True
+
+            downloader.download_album(album.id)
+
+            self.assertEqual([True, False], [image.exists for image in image_list])
+            self.assertEqual(1, downloader._contract_client.image_download_count)
+
+    def test_cache_without_verify_trusts_existing_file(self):
+        with TemporaryDirectory() as temp_dir:
+            album, _, image_list, option, downloader = self.new_downloader(temp_dir)
+            self.create_cached_images(option, image_list)
+
+            downloader.download_album(album.id)
+
+            self.assertTrue(image_list[0].exists)
+            self.assertEqual(0, downloader._contract_client.image_download_count)
+
+    def test_cached_image_is_not_counted_as_passthrough(self):
+        with TemporaryDirectory() as temp_dir:
+            album, _, image_list, option, downloader = self.new_downloader(temp_dir)
+            self.create_cached_images(option, image_list)
+
+            downloader.download_album(album.id)
+
+            self.assertFalse(image_list[0].passthrough)
+            self.assertEqual(0, downloader.manifest_dict[album].passthrough_image_count)
+
+    @staticmethod
+    def new_indexed_downloader(base_dir, image_count=2):
+        album, photo, image_list = new_album_photo_images(image_count)
+        option = ContractOption(base_dir)
+        downloader = IndexedSyncDownloader(option, album, photo, image_list)
+        return album, photo, image_list, option, downloader
+
+    def test_photo_completion_index_written_after_photo(self):
+        with TemporaryDirectory() as temp_dir:
+            album, photo, image_list, option, downloader = self.new_indexed_downloader(temp_dir)
+
+            downloader.download_album(album.id)
+
+            index = PhotoCompletionIndex(temp_dir)
+            self.assertTrue(os.path.isfile(index.index_filepath(photo)))
+            self.assertEqual({image.filename for image in image_list}, index.load(photo, photo.save_path))
+            # 索引不写在章节目录中，避免被插件当作图片
+            self.assertEqual(sorted(image.filename for image in image_list), sorted(os.listdir(photo.save_path)))
+
+    def test_photo_completion_index_not_written_without_cache(self):
+        with TemporaryDirectory() as temp_dir:
+            album, photo, image_list, option, downloader = self.new_indexed_downloader(temp_dir)
+            option.download.cache = False
+
+            downloader.download_album(album.id)
+
+            self.assertFalse(os.path.exists(PhotoCompletionIndex(temp_dir).index_filepath(photo)))
+            self.assertEqual(['album'], os.listdir(temp_dir))
+
+    def test_resume_uses_photo_completion_index_instead_of_stat(self):
+        with TemporaryDirectory() as temp_dir:
+            album, photo, image_list, option, downloader = self.new_indexed_downloader(temp_dir)
+            downloader.download_album(album.id)
+
+            album, photo, image_list, option, downloader = self.new_indexed_downloader(temp_dir)
+            with patch('jmcomic.jm_downloader.file_exists', side_effect=AssertionError), \
+                    patch.object(PhotoCompletionIndex, 'scan', side_effect=AssertionError):
+                downloader.download_album(album.id)
+
+            self.assertEqual([True, True], [image.exists for image in image_list])
+            self.assertEqual(0, downloader._contract_client.image_download_count)
+
+    def test_stale_photo_completion_index_falls_back_to_scandir(self):
+        with TemporaryDirectory() as temp_dir:
+            album, photo, image_list, option, downloader = self.new_indexed_downloader(temp_dir)
+            downloader.download_album(album.id)
+            os.remove(option.decide_image_filepath(image_list[1]))
+            # 删除文件会改变目录 mtime，这里显式设置，避免文件系统时间精度的影响
+            stat = os.stat(photo.save_path)
+            os.utime(photo.save_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+            album, photo, image_list, option, downloader = self.new_indexed_downloader(temp_dir)
+            with patch('jmcomic.jm_downloader.file_exists', side_effect=AssertionError):
+                downloader.download_album(album.id)
+
+            self.assertEqual([True, False], [image.exists for image in image_list])
+            self.assertEqual(1, downloader._contract_client.image_download_count)
+
+    def test_image_tasks_share_one_bounded_executor(self):
+        with TemporaryDirectory() as temp_dir:
+            album, photo, image_list = new_album_photo_images(image_count=12)
+            option = ContractOption(temp_dir)
+            option.download.threading = SimpleNamespace(image=3, photo=2, scope='downloader')
+            option.decide_image_batch_count = lambda _photo: 12
+            downloader = PooledSyncDownloader(option, album, photo, image_list)
+
+            lock = threading.Lock()
+            running, max_running, thread_name_set = [0], [0], set()
+
+            def download_by_image_detail(_image, save_path, decode_image):
+                with lock:
+                    running[0] += 1
+                    max_running[0] = max(max_running[0], running[0])
+                    thread_name_set.add(threading.current_thread().name)
+                time.sleep(0.01)
+                with lock:
+                    running[0] -= 1
+
+            downloader._contract_client.download_by_image_detail = download_by_image_detail
+            with downloader:
+                downloader.download_photo(photo.id)
+                executor = downloader.get_executor('image')
+                downloader.download_photo(photo.id)
+                self.assertIs(executor, downloader.get_executor('image'))
+
+            self.assertEqual(3, max_running[0])
+            self.assertEqual(3, len(thread_name_set))
+            self.assertTrue(all(name.startswith('jm_image') for name in thread_name_set))
+            self.assertEqual(24, len(downloader.download_success_dict[album][photo]))
+
+    def test_process_scope_executor_is_shared_between_downloaders(self):
+        with TemporaryDirectory() as temp_dir:
+            executor_list = []
+            for _ in range(2):
+                album, photo, image_list = new_album_photo_images()
+                option = ContractOption(temp_dir)
+                option.download.threading = SimpleNamespace(image=2, photo=1, scope='process')
+                with PooledSyncDownloader(option, album, photo, image_list) as downloader:
+                    downloader.download_photo(photo.id)
+                    executor_list.append(downloader.get_executor('image'))
+
+            self.assertIs(executor_list[0], executor_list[1])
+            self.assertFalse(executor_list[0]._shutdown)
+
+    def test_async_unscrambled_image_passthrough_is_counted(self):
+        async def run_test(temp_dir):
+            album, photo, image_list = new_album_photo_images()
+            option = ContractOption(temp_dir)
+            option.decide_download_image_decode = lambda _image: True
+            os.makedirs(option.decide_image_save_dir(photo), exist_ok=True)
+
+            downloader = ContractAsyncDownloader(option, album, photo, image_list)
+            stream_resp = AsyncStreamResp([b'raw-', b'image'])
+
+            async def get_jm_image(_url, stream=False, stream_to=None):
+                self.assertTrue(stream)
+                img_resp = JmImageResp(stream_resp)
+                await img_resp.astream_to(stream_to)
+                return img_resp
+
+            downloader.client.get_jm_image = get_jm_image
+            try:
+                with patch.object(JmImageTool, 'decode_and_save') as decode_and_save:
+                    await downloader.download_album(album.id)
+
+                decode_and_save.assert_not_called()
+                with open(image_list[0].save_path, 'rb') as f:
+                    self.assertEqual(b'raw-image', f.read())
+                self.assertTrue(stream_resp.closed)
+                self.assertEqual(1, downloader.manifest_dict[album].passthrough_image_count)
+            finally:
+                downloader.shutdown()
+
+        with TemporaryDirectory() as temp_dir:
+            asyncio.run(run_test(temp_dir))
+
     def test_cache_hit_paths_durations_after_image_and_manifest(self):
         async def run_test(temp_dir):
             album, photo, image_list = new_album_photo_images()
@@ -0,0 +1,98 @@
+import re
+from unittest.mock import patch
+
+from test_jmcomic import *
+
+ALBUM_HTML = '''<html><head><title>本子|禁漫天堂</title></head><body>
+<h1 id="book-name" class="book-name">本子名称</h1>
+<span class="number">禁漫車：JM123456</span>
+<span class="pagecount">頁數:40</span>
+<span itemprop="datePublished">上架日期 : 2024-01-01</span>
+<span itemprop="dateModified">更新日期 : 2024-02-01</span>
+<span itemprop="author" data-type="works"><a href="#">作品</a></span>
+<span itemprop="author" data-type="actor"></span>
+<span itemprop="genre" data-type="tags"><a href="#">tag1</a><a href="#"> tag2 </a></span>
+<span itemprop="author" data-type="author"><a href="#">作者</a></span>
+<span id="albim_likes_123456">1.2K</span>
+<span>40K</span>
+    <span>次觀看</span>
+<h2 class="p-t-5 p-b-5">敘述：简介</h2>
+<a href="/photo/123456" data-album="123456"><li>第1話 开始<span>2024-01-01</span></li></a>
+<a href="/photo/123457" data-album="123457"><li>第2話 结束<span>2024-02-01</span></li></a>
+<script>var scramble_id = 220980;</script></body></html>'''
+
+
+class Test_Html_Field_Plan(unittest.TestCase):
+
+    def test_anchored_pattern_same_as_re(self):
+        text = 'xx ab1 cab22 ab ab333 叙述：a</h2> 敘述：b</h2>'
+        for pattern in [r'ab(\d+)', r'(a)(b)(\d*)', r'ab\d', r'c?ab(\d+)', r'.ab(\d+)', r'[叙|敘]述：([\s\S]*?)</h2>']:
+            pattern = re.compile(pattern)
+            anchored = PatternTool.anchored(pattern)
+            self.assertEqual(pattern.findall(text), anchored.findall(text), pattern)
+            self.assertEqual(pattern.search(text)[0], anchored.search(text)[0], pattern)
+            self.assertIsNone(anchored.search('no match'))
+
+        # 没有定宽的开头时不使用锚点
+        self.assertEqual((None, None), (PatternTool.literal_anchor(re.compile(r'a*b')),
+                                        PatternTool.literal_anchor(re.compile(r'ab', re.I))))
+        self.assertEqual(('述：', 1), PatternTool.literal_anchor(re.compile(r'[叙|敘]述：(.*)')))
+
+    def test_parse_album_html(self):
+        album = JmcomicText.analyse_jm_album_html(ALBUM_HTML)
+        self.assertEqual(('123456', '220980', '本子名称', '简介', 40), (album.album_id, album.scramble_id, album.name,
+                                                                  album.description, album.page_count))
+        self.assertEqual((['作品'], [], ['tag1', 'tag2'], ['作者']), (album.works, album.actors, album.tags, album.authors))
+        self.assertEqual(['123456', '123457'], [photo_id for photo_id, _, _ in album.episode_list])
+        self.assertEqual(0, album.comment_count)
+
+        with self.assertRaises(RegularNotMatchException):
+            JmcomicText.analyse_jm_album_html(ALBUM_HTML.replace('book-name', 'book'))
+
+    def test_plan_compiled_once_and_regions_shared(self):
+        search_count = [0]
+        narrow = re.compile(r'<ul>[\s\S]*?</ul>')
+
+        class CountingPattern:
+            pattern = None
+
+            def search(self, text):
+                search_count[0] += 1
+                return narrow.search(text)
+
+        counting = CountingPattern()
+
+        class Text(JmcomicText):
+            pattern_html_test_a = [counting, re.compile(r'<li>a(\d)</li>')]
+            pattern_html_test_b = [counting, re.compile(r'<li>b(\d)</li>')]
+            pattern_html_test_name = re.compile(r'<h1>(.*?)</h1>')
+
+        html = '<h1>x</h1><ul><li>a1</li><li>b2</li><li>a3</li></ul>'
+        result = Text.reflect_new_instance(html, 'pattern_html_test_', dict)
+        self.assertEqual({'a': ['1', '3'], 'b': ['2'], 'name': 'x'}, result)
+        self.assertEqual(1, search_count[0])
+        self.assertIs(Text.compile_field_plan('pattern_html_test_'), Text.compile_field_plan('pattern_html_test_'))
+
+        Text.pattern_html_test_name = re.compile(r'<li>(a\d)</li>')
+        Text.clear_field_plan()
+        self.assertEqual('a1', Text.reflect_new_instance(html, 'pattern_html_test_', dict)['name'])
+
+    def test_pattern_patched_after_parse_takes_effect(self):
+        self.assertEqual('本子名称', JmcomicText.analyse_jm_album_html(ALBUM_HTML).name)
+
+        # 网页改版时按文档直接替换 pattern 类属性，不需要调用 clear_field_plan
+        html = ALBUM_HTML.replace('book-name', 'album-title')
+        with patch.object(JmcomicText, 'pattern_html_album_name', re.compile(r'id="album-title"[^>]*>([\s\S]*?)</h1>')):
+            self.assertEqual('本子名称', JmcomicText.analyse_jm_album_html(html).name)
+
+        with self.assertRaises(RegularNotMatchException):
+            JmcomicText.analyse_jm_album_html(html)
+
+        # 新增的 pattern 也会被编译进字段计划
+        class Text(JmcomicText):
+            pattern_html_test_name = re.compile(r'<h1>(.*?)</h1>')
+
+        self.assertEqual({'name': 'x'}, Text.reflect_new_instance('<h1>x</h1><b>y</b>', 'pattern_html_test_', dict))
+        Text.pattern_html_test_bold = re.compile(r'<b>(.*?)</b>')
+        self.assertEqual({'name': 'x', 'bold': 'y'},
+                         Text.reflect_new_instance('<h1>x</h1><b>y</b>', 'pattern_html_test_', dict))
@@ -0,0 +1,360 @@
+import asyncio
+import os
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from PIL import Image
+
+from test_jmcomic import *
+from jmcomic.jm_async_downloader import JmProcessDecodePool, _decode_and_save_image
+
+
+def record_task_context(image_bytes, tag):
+    if tag == 'fail':
+        raise ValueError(tag)
+    return len(image_bytes), tag, get_jm_task_context()
+
+
+def record_buffer(image_bytes):
+    return type(image_bytes).__name__, bytes(image_bytes)
+
+
+def new_gradient_image(w, h, mode='RGB'):
+    img = Image.new('RGB', (w, h))
+    img.putdata([((x * 7) % 256, (y * 3) % 256, (x + y) % 256) for y in range(h) for x in range(w)])
+    return img if mode == 'RGB' else img.convert(mode)
+
+
+class Test_Jm_Image_Decode(unittest.TestCase):
+
+    def assert_decode_equal(self, num, img):
+        expected = JmImageTool.decode_image_by_paste(num, img)
+        actual = JmImageTool.decode_image(num, img)
+        self.assertEqual(expected.size, actual.size)
+        self.assertEqual(expected.tobytes(), actual.tobytes())
+
+    def test_decode_matches_paste_implementation(self):
+        # 覆盖整除 / 有余数 / 高度小于分割数的情况
+        for w, h in [(13, 100), (7, 97), (5, 3)]:
+            img = new_gradient_image(w, h)
+            for num in range(2, 22, 2):
+                self.assert_decode_equal(num, img)
+
+    def test_decode_converts_non_rgb_source(self):
+        for mode in ('RGBA', 'L', 'P'):
+            self.assert_decode_equal(10, new_gradient_image(9, 41, mode))
+
+    def test_decode_into_reused_canvas(self):
+        canvas = JmImageTool.reuse_canvas((8, 40))
+        self.assertIs(canvas, JmImageTool.reuse_canvas((8, 40)))
+        self.assertIsNot(canvas, JmImageTool.reuse_canvas((8, 41)))
+
+        canvas = JmImageTool.reuse_canvas((8, 40))
+        for img in (new_gradient_image(8, 40), Image.new('RGB', (8, 40), (255, 0, 0))):
+            decoded = JmImageTool.decode_image(10, img, canvas)
+            self.assertIs(canvas, decoded)
+            self.assertEqual(JmImageTool.decode_image_by_paste(10, img).tobytes(), decoded.tobytes())
+
+    def test_strip_table_covers_all_rows(self):
+        for h, num in [(100, 6), (97, 10), (3, 8)]:
+            table = JmImageTool.get_strip_table(h, num)
+            self.assertEqual(num, len(table))
+            self.assertEqual(h, sum(rows for _, _, rows in table))
+            self.assertEqual(0, table[0][1])
+            self.assertIs(table, JmImageTool.get_strip_table(h, num))
+
+    def test_decode_and_save(self):
+        with TemporaryDirectory() as tmp:
+            # 同一线程连续保存同尺寸图片，复用画布不能串页
+            for index, color in enumerate([None, (0, 255, 0)]):
+                img = new_gradient_image(10, 60) if color is None else Image.new('RGB', (10, 60), color)
+                buf = BytesIO()
+                img.save(buf, 'png')
+
+                path = os.path.join(tmp, f'{index:05}.png')
+                JmImageTool.decode_and_save(8, JmImageTool.open_image(buf.getvalue()), path)
+                with Image.open(path) as saved:
+                    self.assertEqual(JmImageTool.decode_image_by_paste(8, img).tobytes(), saved.tobytes())
+
+    def test_transfer_to_writes_raw_bytes_when_not_scrambled(self):
+        img = new_gradient_image(10, 60)
+        buf = BytesIO()
+        img.save(buf, 'png')
+        content = buf.getvalue()
+        url = 'https://cdn.example/media/photos/456/00001.png'
+        resp = JmImageResp(SimpleNamespace(content=content, status_code=200, url=url))
+
+        with TemporaryDirectory() as tmp:
+            # aid(456) < scramble_id，分割数为0，即使要求解密也原样写盘
+            path = os.path.join(tmp, '00001.png')
+            with patch.object(JmImageTool, 'decode_and_save') as decode_and_save:
+                resp.transfer_to(path, 220980, decode_image=True)
+            decode_and_save.assert_not_called()
+            with open(path, 'rb') as f:
+                self.assertEqual(content, f.read())
+
+            # 后缀不一致时仍需格式转换
+            path = os.path.join(tmp, '00001.jpg')
+            resp.transfer_to(path, 220980, decode_image=True)
+            with Image.open(path) as saved:
+                self.assertEqual('JPEG', saved.format)
+
+    def test_is_passthrough(self):
+        image = JmImageDetail('456', '220980', 'https://cdn.example/media/photos/456/00001.webp', '00001', '.webp')
+        scrambled = JmImageDetail('500000', '220980', 'https://cdn.example/media/photos/500000/00001.webp', '00001', '.webp')
+
+        self.assertTrue(JmImageTool.is_passthrough(image, '/tmp/00001.webp', True))
+        self.assertFalse(JmImageTool.is_passthrough(image, '/tmp/00001.png', True))
+        self.assertFalse(JmImageTool.is_passthrough(scrambled, '/tmp/00001.webp', True))
+        self.assertTrue(JmImageTool.is_passthrough(scrambled, '/tmp/00001.webp', False))
+
+
+class Test_Jm_Process_Decode_Pool(unittest.TestCase):
+
+    def test_decode_in_process_pool(self):
+        img = new_gradient_image(10, 60)
+        buf = BytesIO()
+        img.save(buf, 'png')
+        image_bytes = buf.getvalue()
+        aid, scramble_id = 500000, 220980
+
+        async def run_test(tmp):
+            pool = JmProcessDecodePool(max_workers=1, batch=2)
+            try:
+                path_list = [os.path.join(tmp, f'{i:05}.png') for i in range(1, 4)]
+                await asyncio.gather(*[
+                    pool.submit(_decode_and_save_image, image_bytes, scramble_id, aid, of_file_name(path, True), path)
+                    for path in path_list
+                ])
+                return path_list
+            finally:
+                pool.shutdown()
+
+        with TemporaryDirectory() as tmp:
+            for path in asyncio.run(run_test(tmp)):
+                num = JmImageTool.get_num(scramble_id, aid, of_file_name(path, True))
+                with Image.open(path) as saved:
+                    self.assertEqual(JmImageTool.decode_image_by_paste(num, img).tobytes(), saved.tobytes())
+
+    def test_task_context_and_exception_cross_process(self):
+        async def run_test():
+            pool = JmProcessDecodePool(max_workers=1, batch=8)
+            try:
+                with jm_task_context(session_id='process', jm_id='1'):
+                    ok = pool.submit(record_task_context, b'12345', 'ok')
+                with jm_task_context(session_id='process', jm_id='2'):
+                    fail = pool.submit(record_task_context, b'', 'fail')
+                return await asyncio.gather(ok, fail, return_exceptions=True)
+            finally:
+                pool.shutdown()
+
+        ok, fail = asyncio.run(run_test())
+        self.assertEqual((5, 'ok', {'session_id': 'process', 'jm_id': '1'}), ok)
+        self.assertIsInstance(fail, ValueError)
+
+    def test_child_reads_shared_memory_without_copy(self):
+        async def run_test():
+            pool = JmProcessDecodePool(max_workers=1, batch=2)
+            try:
+                ret = await asyncio.gather(pool.submit(record_buffer, b'abc'), pool.submit(record_buffer, b'de'))
+                return ret, pool._executor._mp_context.get_start_method()
+            finally:
+                pool.shutdown()
+
+        ret, start_method = asyncio.run(run_test())
+        self.assertEqual([('memoryview', b'abc'), ('memoryview', b'de')], ret)
+        self.assertEqual('spawn', start_method)
+
+    def test_downloader_decode_backend_option(self):
+        option = JmOption.default()
+        downloader = JmAsyncDownloader(option)
+        self.assertIsNone(downloader._process_decode_pool)
+        downloader.shutdown()
+
+        option.download.decode_backend = 'process'
+        option.download.decode_batch = 3
+        option.download.decode_worker = 2
+        downloader = JmAsyncDownloader(option)
+        self.assertEqual(3, downloader._process_decode_pool.batch)
+        # decode_worker 同时决定线程池和进程池的大小
+        self.assertEqual((2, 2), (downloader._process_decode_pool.max_workers, downloader._decode_pool._max_workers))
+        downloader.shutdown()
+
+        downloader = JmAsyncDownloader(option, decode_worker=3, decode_backend='thread')
+        self.assertEqual(3, downloader._decode_pool._max_workers)
+        downloader.shutdown()
+
+        self.assertRaises(ValueError, JmAsyncDownloader, option, decode_backend='fork')
+
+
+class StreamResp:
+    """模拟 curl_cffi 的同步流式响应"""
+
+    def __init__(self, chunk_list, status_code=200):
+        self.chunk_list = chunk_list
+        self.status_code = status_code
+        self.url = 'https://cdn.example/media/photos/456/00001.gif'
+        self.content = b''
+        self.stream_task = object()
+        self.closed = False
+
+    def iter_content(self, _chunk_size=None):
+        yield from self.chunk_list
+
+    def close(self):
+        self.closed = True
+
+
+class Test_Jm_Stream_Image_Resp(unittest.TestCase):
+
+    def test_stream_to_writes_chunks_atomically(self):
+        resp = StreamResp([b'GIF8', b'9a', b'body'])
+        img_resp = JmImageResp(resp)
+        self.assertTrue(img_resp.is_stream)
+        img_resp.require_success()
+
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, '00001.gif')
+            img_resp.transfer_to(path, None, decode_image=False)
+
+            with open(path, 'rb') as f:
+                self.assertEqual(b'GIF89abody', f.read())
+            self.assertEqual(['00001.gif'], os.listdir(tmp))
+        self.assertEqual(10, img_resp.stream_size)
+        self.assertTrue(resp.closed)
+
+    def test_stream_bytes_are_charged_in_batches(self):
+        img_resp = JmImageResp(StreamResp([b'12345'] * 5))
+        with TemporaryDirectory() as tmp, \
+                patch.object(RateLimiter, 'STREAM_CHARGE_BYTES', 10), \
+                patch.object(RateLimiter, 'consume') as consume:
+            img_resp.stream_to(os.path.join(tmp, '00001.gif'))
+
+        self.assertEqual([10, 10, 5], [call.args[2] for call in consume.call_args_list])
+
+    def test_empty_stream_body_fails_without_leaving_file(self):
+        resp = StreamResp([])
+        img_resp = JmImageResp(resp)
+
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, '00001.gif')
+            with self.assertRaisesRegex(ResponseUnexpectedException, '响应数据为空'):
+                img_resp.stream_to(path)
+            self.assertEqual([], os.listdir(tmp))
+        self.assertTrue(resp.closed)
+
+    def test_failed_status_closes_stream(self):
+        resp = StreamResp([b'not found'], status_code=404)
+        with self.assertRaisesRegex(ResponseUnexpectedException, '404'):
+            JmImageResp(resp).require_success()
+        self.assertTrue(resp.closed)
+
+    def test_stream_content_is_buffered_when_decode_is_needed(self):
+        img_resp = JmImageResp(StreamResp([b'12', b'34']))
+        self.assertEqual(b'1234', img_resp.content)
+        self.assertEqual(b'1234', img_resp.content)
+
+    def test_download_image_selects_stream_mode(self):
+        stream_list = []
+
+        class Client(JmImageClient):
+
+            def get_jm_image(self, img_url, stream=False, stream_to=None):
+                stream_list.append(stream)
+                return JmImageResp(StreamResp([b'image']) if stream else SimpleNamespace(
+                    content=b'image', status_code=200, url=img_url))
+
+            def save_image_resp(self, *_args):
+                pass
+
+        client = Client()
+        url = 'https://cdn.example/media/photos/500000/00001.webp'
+        client.download_image(url, '/tmp/00001.webp', 220980, decode_image=False)
+        client.download_image(url, '/tmp/00001.png', 220980, decode_image=False)
+        client.download_image(url, '/tmp/00001.webp', 220980, decode_image=True)
+        client.download_image(url.replace('500000', '456'), '/tmp/00001.webp', 220980, decode_image=True)
+        client.download_album_cover('123', '/tmp/123.jpg')
+        self.assertEqual([True, False, False, True, True], stream_list)
+
+    def test_download_image_with_old_get_jm_image_signature(self):
+        url_list = []
+
+        class OldClient(JmImageClient):
+
+            def get_jm_image(self, img_url):
+                url_list.append(img_url)
+                return JmImageResp(SimpleNamespace(content=b'image', status_code=200, url=img_url))
+
+        url = 'https://cdn.example/media/photos/456/00001.webp'
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, '00001.webp')
+            OldClient().download_image(url, path, 220980, decode_image=False)
+            with open(path, 'rb') as f:
+                self.assertEqual(b'image', f.read())
+
+        self.assertEqual([url], url_list)
+        self.assertFalse(JmImageClient.support_stream_to(OldClient().get_jm_image))
+        self.assertTrue(JmImageClient.support_stream_to(lambda img_url, **kwargs: None))
+
+
+class Test_Jm_Image_Atomic_Write(unittest.TestCase):
+
+    def test_save_image_is_atomic_and_keeps_format(self):
+        img = new_gradient_image(10, 20)
+        with TemporaryDirectory() as tmp:
+            for suffix, image_format in [('.jpg', 'JPEG'), ('.png', 'PNG'), ('.webp', 'WEBP'), ('.gif', 'GIF')]:
+                path = os.path.join(tmp, f'00001{suffix}')
+                JmImageTool.save_image(img, path)
+                with Image.open(path) as saved:
+                    self.assertEqual(image_format, saved.format)
+
+            self.assertEqual(4, len(os.listdir(tmp)))
+
+    def test_failed_write_keeps_old_file_and_removes_temp(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, '00001.jpg')
+            JmImageTool.save_bytes(b'old', path)
+
+            with self.assertRaises(RuntimeError):
+                with JmImageTool.open_atomic(path) as f:
+                    f.write(b'half')
+                    raise RuntimeError('killed')
+
+            self.assertEqual(['00001.jpg'], os.listdir(tmp))
+            with open(path, 'rb') as f:
+                self.assertEqual(b'old', f.read())
+
+    @unittest.skipIf(os.name == 'nt', '文件权限只在 posix 上检查')
+    def test_written_file_mode_follows_umask(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, '00001.jpg')
+            umask = os.umask(0o022)
+            try:
+                JmImageTool.save_bytes(b'data', path)
+            finally:
+                os.umask(umask)
+            self.assertEqual(0o644, os.stat(path).st_mode & 0o777)
+
+    def test_is_image_complete(self):
+        img = new_gradient_image(30, 30)
+        with TemporaryDirectory() as tmp:
+            for suffix in ('.jpg', '.png', '.webp', '.gif'):
+                path = os.path.join(tmp, f'00001{suffix}')
+                JmImageTool.save_image(img, path)
+                self.assertTrue(JmImageTool.is_image_complete(path), suffix)
+
+                with open(path, 'rb') as f:
+                    data = f.read()
+                JmImageTool.save_bytes(data[:len(data) // 2], path)
+                self.assertFalse(JmImageTool.is_image_complete(path), suffix)
+
+            empty = os.path.join(tmp, 'empty.jpg')
+            JmImageTool.save_bytes(b'', empty)
+            self.assertFalse(JmImageTool.is_image_complete(empty))
+            self.assertFalse(JmImageTool.is_image_complete(os.path.join(tmp, 'missing.jpg')))
+
+            unknown = os.path.join(tmp, '00001.bin')
+            JmImageTool.save_bytes(b'data', unknown)
+            self.assertTrue(JmImageTool.is_image_complete(unknown))
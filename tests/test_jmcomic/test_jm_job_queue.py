@@ -0,0 +1,228 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+
+from test_jmcomic import *
+from jmcomic.cli import JmWorkerUI
+
+
+class Test_Job_Queue(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.path = os.path.join(self.temp_dir.name, 'queue', 'jobs.db')
+
+    def new_queue(self, **kwargs):
+        return JmJobQueue(self.path, **kwargs)
+
+    def test_put_is_idempotent(self):
+        queue = self.new_queue()
+        self.assertTrue(queue.put('JM123'))
+        self.assertFalse(queue.put(123, priority=5, page_count=20))
+        self.assertTrue(queue.put(123, kind='photo'))
+
+        job = queue.get(123)
+        self.assertEqual(('123', 5, 20), (job.jm_id, job.priority, job.page_count))
+        self.assertEqual(2, queue.depth())
+
+        with self.assertRaises(Exception):
+            queue.put(1, kind='user')
+
+    def test_claim_orders_by_priority_then_shortest_job(self):
+        queue = self.new_queue()
+        queue.put(1, page_count=300)
+        queue.put(2)
+        queue.put(3, page_count=10)
+        queue.put(4, page_count=50, priority=1)
+
+        claimed = [job.jm_id for job in queue.claim('w', 10)]
+        self.assertEqual(['4', '3', '1', '2'], claimed)
+        self.assertEqual([], queue.claim('w', 10))
+
+    def test_expired_lease_is_reclaimed(self):
+        queue = self.new_queue(lease_seconds=0.05)
+        queue.put(1)
+        first = queue.claim('w1')[0]
+        self.assertEqual([], queue.claim('w2'))
+
+        time.sleep(0.1)
+        second = queue.claim('w2')[0]
+        self.assertEqual((first.job_id, 2), (second.job_id, second.attempts))
+        # 租约已被接手，原 worker 不能再修改任务
+        self.assertFalse(queue.complete(first, 'w1'))
+        self.assertTrue(queue.complete(second, 'w2'))
+
+    def test_expired_lease_gives_up_after_max_attempts(self):
+        queue = self.new_queue(lease_seconds=0.01, max_attempts=2)
+        queue.put(1)
+        queue.claim('w1')
+        time.sleep(0.02)
+        self.assertEqual(2, queue.claim('w2')[0].attempts)
+
+        # 两次都没有完成就丢了租约，不再领取
+        time.sleep(0.02)
+        self.assertEqual([], queue.claim('w3'))
+        job = queue.get(1)
+        self.assertEqual((JmJobQueue.STATUS_FAILED, 2), (job.status, job.attempts))
+        self.assertIn('租约过期', job.last_error)
+
+    def test_fail_backs_off_then_gives_up(self):
+        queue = self.new_queue(max_attempts=2, backoff_base=60)
+        queue.put(1)
+        job = queue.claim('w')[0]
+        queue.fail(job, 'w', ValueError('timeout'))
+
+        # 还在退避时间内，不能领取
+        self.assertEqual([], queue.claim('w'))
+        self.assertEqual(0, queue.stats()['ready'])
+        with queue._conn() as conn:
+            conn.execute('UPDATE job SET available_at = 0')
+
+        job = queue.claim('w')[0]
+        queue.fail(job, 'w', ValueError('timeout'))
+        job = queue.get(1)
+        self.assertEqual((JmJobQueue.STATUS_FAILED, 'ValueError: timeout'), (job.status, job.last_error))
+
+        # 重新添加 failed 的任务会放回队列
+        queue.put(1)
+        self.assertEqual((JmJobQueue.STATUS_PENDING, 0), (queue.get(1).status, queue.get(1).attempts))
+
+    def test_release_and_stats(self):
+        queue = self.new_queue()
+        queue.put_many([1, 2, 3])
+        job_list = queue.claim('w', 2)
+        queue.complete(job_list[0], 'w')
+        self.assertEqual(1, queue.release('w'))
+
+        stats = queue.stats()
+        self.assertEqual((2, 0, 1, 0, 2), tuple(stats[k] for k in ('pending', 'running', 'done', 'failed', 'ready')))
+        self.assertEqual(1, stats['done_in_window'])
+        self.assertEqual(0, queue.get(job_list[1].jm_id).attempts)
+
+        # 已完成的任务不会重新添加
+        self.assertFalse(queue.put(job_list[0].jm_id))
+        self.assertEqual(JmJobQueue.STATUS_DONE, queue.get(job_list[0].jm_id).status)
+
+
+class Test_Queue_Worker(unittest.TestCase):
+
+    class FakeWorker(JmQueueWorker):
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.download_list = []
+
+        async def download_job(self, job):
+            self.download_list.append(job.jm_id)
+            await asyncio.sleep(0.01)
+            if job.jm_id == '404':
+                raise ValueError('not found')
+            return SimpleNamespace(detail=SimpleNamespace(page_count=int(job.jm_id)))
+
+    class NoEngineDownloader:
+        pass
+
+    def test_worker_drains_queue_and_resumes(self):
+        with TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'jobs.db')
+            queue = JmJobQueue(path, max_attempts=2, backoff_base=0)
+            queue.put_many(['1', '2', '404'])
+            queue.put('3', kind='photo')
+
+            worker = self.FakeWorker(queue, JmOption.default(), self.NoEngineDownloader,
+                                     concurrency=2, poll_interval=0.01, exit_when_empty=True)
+            worker.run_forever()
+
+            self.assertEqual(['404', '404'], [i for i in worker.download_list if i == '404'])
+            self.assertEqual((3, 2), (worker.done_count, worker.failed_count))
+            self.assertEqual(2, queue.get('2').page_count)
+            self.assertEqual(JmJobQueue.STATUS_FAILED, queue.get('404').status)
+
+            # 重启后不会重新下载已完成的任务
+            queue = JmJobQueue(path)
+            queue.put_many(['1', '2', '5'])
+            worker = self.FakeWorker(queue, JmOption.default(), self.NoEngineDownloader,
+                                     poll_interval=0.01, exit_when_empty=True)
+            worker.run_forever()
+            self.assertEqual(['5'], worker.download_list)
+
+    def test_estimate_once_and_unknown_sorts_last(self):
+        with TemporaryDirectory() as temp_dir:
+            queue = JmJobQueue(os.path.join(temp_dir, 'jobs.db'))
+            queue.put_many(['1', '2', '3'])
+            fetched = []
+
+            async def get_album_detail(jm_id):
+                fetched.append(jm_id)
+                if jm_id == '1':
+                    raise ConnectionError('timeout')
+                return SimpleNamespace(page_count={'2': 0, '3': 30}[jm_id])
+
+            worker = JmQueueWorker(queue, JmOption.default(), self.NoEngineDownloader)
+            worker.engine = SimpleNamespace(client=SimpleNamespace(get_album_detail=get_album_detail))
+            for _ in range(2):
+                asyncio.run(worker.estimate(10))
+
+            # 获取失败、页数未知的只估计一次，页数仍为 NULL
+            self.assertEqual(['1', '2', '3'], fetched)
+            self.assertEqual([None, None, 30], [queue.get(jm_id).page_count for jm_id in ['1', '2', '3']])
+            self.assertEqual(['3', '1', '2'], [job.jm_id for job in queue.claim('w', 10)])
+
+    def test_queue_operations_run_off_event_loop(self):
+        with TemporaryDirectory() as temp_dir:
+            queue = JmJobQueue(os.path.join(temp_dir, 'jobs.db'))
+            queue.put('1')
+            thread_list = []
+            claim = queue.claim
+
+            def record_claim(*args):
+                thread_list.append(threading.current_thread())
+                return claim(*args)
+
+            queue.claim = record_claim
+            worker = self.FakeWorker(queue, JmOption.default(), self.NoEngineDownloader,
+                                     poll_interval=0.01, exit_when_empty=True)
+            worker.run_forever()
+
+            self.assertEqual(['1'], worker.download_list)
+            self.assertNotIn(threading.main_thread(), thread_list)
+
+    def test_renew_failure_stops_worker(self):
+        with TemporaryDirectory() as temp_dir:
+            queue = JmJobQueue(os.path.join(temp_dir, 'jobs.db'), lease_seconds=0.06)
+            queue.put_many(['1', '2'])
+
+            def broken_renew(worker_id):
+                raise sqlite3.OperationalError('disk I/O error')
+
+            class SlowWorker(self.FakeWorker):
+                async def download_job(self, job):
+                    self.download_list.append(job.jm_id)
+                    await asyncio.sleep(10)
+
+            queue.renew = broken_renew
+            worker = SlowWorker(queue, JmOption.default(), self.NoEngineDownloader,
+                                concurrency=1, poll_interval=0.01, exit_when_empty=True)
+            begin = time.time()
+            with self.assertRaises(sqlite3.OperationalError):
+                worker.run_forever()
+
+            # 不再领取新任务，正在下载的任务被取消并放回队列
+            self.assertLess(time.time() - begin, 5)
+            self.assertEqual(['1'], worker.download_list)
+            self.assertEqual(0, worker.done_count)
+            self.assertEqual([JmJobQueue.STATUS_PENDING] * 2, [queue.get(jm_id).status for jm_id in ['1', '2']])
+
+    def test_cli_add_jobs(self):
+        with TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'jobs.db')
+            JmWorkerUI().main(['--queue', path, '--add', '123', 'p456', '--priority', '3'])
+
+            queue = JmJobQueue(path)
+            self.assertEqual(3, queue.get('123').priority)
+            self.assertEqual('photo', queue.get('456', kind='photo').kind)
@@ -0,0 +1,173 @@
+import asyncio
+import multiprocessing
+import threading
+import time
+from tempfile import TemporaryDirectory
+
+from test_jmcomic import *
+
+
+# 子进程使用 spawn 启动，下面的类和函数需要在模块级定义，子进程才能 import
+
+class FakeEngine(JmAsyncDownloadEngine):
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+
+class FakeDownloader(JmAsyncDownloader):
+
+    @classmethod
+    def create_engine(cls, option, **kwargs):
+        return FakeEngine(option, **kwargs)
+
+    async def download_album(self, album_id):
+        await asyncio.sleep(0.05)
+        with open(os.path.join(self.option.dir_rule.base_dir, 'download.log'), 'a', encoding='utf-8') as f:
+            f.write(f'{os.getpid()} {album_id}\n')
+
+        album = JmAlbumDetail(album_id=album_id, scramble_id='220980', name=album_id,
+                              episode_list=[], page_count=0, pub_date='', update_date='', likes='0',
+                              views='0', comment_count=0, works=[], actors=[], authors=[], tags=[])
+        self.begin_manifest(album)
+        self.finish_manifest = lambda _album: None
+        return album
+
+
+def run_node(base_dir, jm_id_list):
+    option = JmOption.default()
+    option.dir_rule.base_dir = base_dir
+    download_batch_leased(download_album, jm_id_list, option, FakeDownloader, poll_interval=0.05, concurrency=2)
+
+
+class Test_Lease_Dir(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def new_lease(self, owner, **kwargs):
+        return JmLeaseDir(self.temp_dir.name, owner=owner, **kwargs)
+
+    def test_lease_is_exclusive_until_released(self):
+        a, b = self.new_lease('a'), self.new_lease('b')
+        self.assertTrue(a.try_acquire('album_1'))
+        self.assertFalse(b.try_acquire('album_1'))
+        self.assertEqual('a', b.holder('album_1')['owner'])
+
+        a.release('album_1')
+        self.assertTrue(b.try_acquire('album_1'))
+        b.release('album_1', done=True)
+
+        # 完成后不能再领取
+        self.assertFalse(a.try_acquire('album_1'))
+        self.assertTrue(a.is_done('album_1'))
+
+    def test_done_marker_ttl_and_clear(self):
+        lease = self.new_lease('a', done_ttl=60)
+        lease.release('album_1', done=True)
+        self.assertTrue(lease.is_done('album_1'))
+
+        # 超过有效期的完成标记视为没有完成，可以重新领取
+        past = time.time() - 61
+        os.utime(lease.done_path('album_1'), (past, past))
+        self.assertFalse(lease.is_done('album_1'))
+        self.assertTrue(self.new_lease('b').is_done('album_1'))
+        self.assertTrue(lease.try_acquire('album_1'))
+        lease.release('album_1', done=True)
+        self.assertTrue(lease.is_done('album_1'))
+
+        self.assertTrue(lease.clear_done('album_1'))
+        self.assertFalse(lease.clear_done('album_1'))
+        self.assertTrue(lease.try_acquire('album_1'))
+
+    def test_album_done_right_after_check_is_not_acquired(self):
+        lease = self.new_lease('a')
+        # 第一次检查时还没完成，创建租约后再检查时其他节点已经完成
+        done_list = [False, True]
+        lease.is_done = lambda _key: done_list.pop(0)
+
+        self.assertFalse(lease.try_acquire('album_1'))
+        self.assertEqual([], lease.holding())
+        self.assertIsNone(lease.holder('album_1'))
+
+    def test_expired_lease_is_taken_over_and_lost(self):
+        a, b = self.new_lease('a', lease_seconds=0.05), self.new_lease('b', lease_seconds=0.05)
+        self.assertTrue(a.try_acquire('album_1'))
+        self.assertEqual([], a.renew())
+        self.assertFalse(b.try_acquire('album_1'))
+
+        time.sleep(0.1)
+        self.assertTrue(b.try_acquire('album_1'))
+        self.assertEqual(['album_1'], a.renew())
+        self.assertEqual([], a.holding())
+
+        # 丢失的租约释放时不会删除新持有者的租约
+        a.release('album_1')
+        self.assertEqual('b', a.holder('album_1')['owner'])
+
+    def test_stale_guard_is_removed(self):
+        lease = self.new_lease('a', lease_seconds=0.05)
+        guard = os.path.join(self.temp_dir.name, 'album_1.guard')
+        open(guard, 'w').close()
+
+        with lease._guard('album_1') as ok:
+            self.assertFalse(ok)
+        time.sleep(0.1)
+        with lease._guard('album_1', retry=1) as ok:
+            self.assertTrue(ok)
+        self.assertFalse(os.path.exists(guard))
+
+
+class Test_Lease_Worker(unittest.TestCase):
+
+    def test_nodes_never_download_same_album(self):
+        jm_id_list = [str(i) for i in range(1, 13)]
+        with TemporaryDirectory() as base_dir:
+            context = multiprocessing.get_context('spawn')
+            process_list = [context.Process(target=run_node, args=(base_dir, jm_id_list)) for _ in range(3)]
+            for p in process_list:
+                p.start()
+            for p in process_list:
+                p.join(60)
+                self.assertEqual(0, p.exitcode)
+
+            with open(os.path.join(base_dir, 'download.log'), 'r', encoding='utf-8') as f:
+                line_list = [line.split() for line in f.read().splitlines()]
+
+            self.assertEqual(sorted(jm_id_list), sorted(jm_id for _, jm_id in line_list))
+            lease = JmLeaseDir(os.path.join(base_dir, JmLeaseDir.lease_dirname))
+            self.assertTrue(all(lease.is_done(lease.key('album', jm_id)) for jm_id in jm_id_list))
+            self.assertFalse([name for name in os.listdir(lease.lease_dir) if not name.endswith('.done')])
+
+    def test_skips_albums_done_by_other_node(self):
+        with TemporaryDirectory() as base_dir:
+            option = JmOption.default()
+            option.dir_rule.base_dir = base_dir
+            JmLeaseDir.of_option(option).release('album_2', done=True)
+
+            lease = JmLeaseDir.of_option(option)
+            thread_list = []
+            for name in ('try_acquire', 'release'):
+                def record_thread(*args, _func=getattr(lease, name)):
+                    thread_list.append(threading.current_thread())
+                    return _func(*args)
+
+                setattr(lease, name, record_thread)
+
+            worker = JmLeaseWorker(lease, option, FakeDownloader, poll_interval=0.01)
+            result = worker.run_forever(['1', '2', '3'])
+
+            self.assertEqual({'1', '3'}, {album.album_id for album, _ in result})
+            self.assertEqual(['2'], worker.skipped_list)
+            # 租约文件的读写不在事件循环所在的线程中执行
+            self.assertEqual(4, len(thread_list))
+            self.assertNotIn(threading.main_thread(), thread_list)
+
+            # redo 会删除完成标记，重新下载
+            result = download_batch_leased(download_album, ['1', '2'], option, FakeDownloader,
+                                           poll_interval=0.01, redo=True)
+            self.assertEqual({'1', '2'}, {album.album_id for album, _ in result})
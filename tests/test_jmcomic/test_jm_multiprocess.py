@@ -0,0 +1,178 @@
+import asyncio
+import pickle
+import threading
+import time
+from unittest.mock import patch
+
+from test_jmcomic import *
+
+
+# 子进程使用 spawn 启动，下面的类需要在模块级定义，子进程才能 import
+
+class FakeEngine(JmAsyncDownloadEngine):
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+
+class FakeDownloader(JmAsyncDownloader):
+
+    @classmethod
+    def create_engine(cls, option, **kwargs):
+        return FakeEngine(option, **kwargs)
+
+    async def download_album(self, album_id):
+        RateLimiter.reserve_request('https://img.example/x.jpg', True)
+        DomainHealthRegistry.record_success('api.example', 0.1)
+        if album_id == '404':
+            # context 中的值不能 pickle，传回父进程时会被丢弃
+            raise JmcomicException('本子不存在', {'resp': lambda: None})
+
+        album = JmAlbumDetail(album_id=album_id, scramble_id='220980', name=album_id,
+                              episode_list=[], page_count=0, pub_date='', update_date='', likes='0',
+                              views='0', comment_count=0, works=[], actors=[], authors=[], tags=[])
+        self.begin_manifest(album).image_filepath_list.append(f'{os.getpid()}/{album_id}.jpg')
+        self.finish_manifest = lambda _album: None
+        if album_id == '500':
+            # 部分图片下载失败，download_album_async 会抛出带 downloader 的 PartialDownloadFailedException
+            self.download_failed_image.append(('00001.jpg', JmcomicException('图片下载超时', {})))
+        return album
+
+
+class Test_Shared_State(unittest.TestCase):
+
+    def setUp(self):
+        RateLimiter.reset()
+        DomainHealthRegistry.reset()
+        self.addCleanup(RateLimiter.reset)
+        self.addCleanup(DomainHealthRegistry.reset)
+        self.addCleanup(setattr, RateLimiter, 'shared_state', None)
+        self.addCleanup(setattr, DomainHealthRegistry, 'shared_state', None)
+        self.addCleanup(RateLimiter.configure, None)
+
+    def test_limiter_and_registry_delegate_to_shared_state(self):
+        RateLimiter.configure({'image': {'rps': 10}})
+        calls = []
+
+        class State(JmSharedState):
+            def reserve_request(self, url, is_image):
+                calls.append(url)
+                return 0.5
+
+            def record_domain_events(self, event_list):
+                calls.append(event_list)
+                return {'api.example': {'latency': 0.2, 'error_rate': 0.1, 'success': 7, 'failure': 3}}
+
+        RateLimiter.shared_state = DomainHealthRegistry.shared_state = State()
+        self.assertEqual(0.5, RateLimiter.reserve_request('https://img.example/1.jpg', True))
+        DomainHealthRegistry.record_failure('api.example')
+
+        self.assertEqual(['https://img.example/1.jpg', [('api.example', None)]], calls)
+        self.assertEqual(1, RateLimiter.snapshot()['img.example']['throttled'])
+        # 本进程的统计同步为共享状态汇总后的统计
+        self.assertEqual((7, 3), tuple(DomainHealthRegistry.REGISTRY['api.example'][k] for k in ('success', 'failure')))
+
+    def test_limiter_skips_ipc_without_limit_and_offloads_async_calls(self):
+        thread_list = []
+
+        class State(JmSharedState):
+            def reserve_request(self, url, is_image):
+                thread_list.append(threading.current_thread())
+                return 0.0
+
+            def reserve_bytes(self, url, is_image, size):
+                raise AssertionError('没有配置 bps 时不经过共享状态')
+
+            def record_domain_events(self, event_list):
+                thread_list.append(threading.current_thread())
+                return {}
+
+        RateLimiter.shared_state = DomainHealthRegistry.shared_state = State()
+        RateLimiter.acquire('https://img.example/1.jpg', True)
+        self.assertEqual([], thread_list)
+
+        RateLimiter.configure({'image': {'rps': 1000}})
+
+        async def run_test():
+            await RateLimiter.async_acquire('https://img.example/1.jpg', True)
+            await RateLimiter.async_consume('https://img.example/1.jpg', True, 100)
+            await DomainHealthRegistry.async_record_success('api.example', 0.1)
+
+        asyncio.run(run_test())
+        self.assertEqual(2, len(thread_list))
+        self.assertNotIn(threading.main_thread(), thread_list)
+        self.assertEqual((2, 100), tuple(RateLimiter.snapshot()['img.example'][k] for k in ('request', 'bytes')))
+
+    def test_registry_records_locally_and_flushes_in_batches(self):
+        batch_list = []
+
+        class State(JmSharedState):
+            def record_domain_events(self, event_list):
+                batch_list.append(list(event_list))
+                return super().record_domain_events(event_list)
+
+        DomainHealthRegistry.shared_state = State()
+
+        with patch.object(DomainHealthRegistry, 'FLUSH_BATCH', 3), patch.object(time, 'monotonic', return_value=100.0):
+            # 第一条立即同步，之后攒够 FLUSH_BATCH 条再同步
+            for _ in range(4):
+                DomainHealthRegistry.record_success('api.example', 0.1)
+            self.assertEqual([1, 3], [len(batch) for batch in batch_list])
+
+            DomainHealthRegistry.record_failure('api.example')
+            # 没有同步前，本进程的统计已经更新
+            self.assertEqual(1, DomainHealthRegistry.REGISTRY['api.example']['failure'])
+            self.assertEqual(2, len(batch_list))
+
+        DomainHealthRegistry.flush()
+        self.assertEqual([('api.example', None)], batch_list[-1])
+        DomainHealthRegistry.flush()
+        self.assertEqual(3, len(batch_list))
+
+    def test_exception_pickle_drops_unpicklable_context(self):
+        e = pickle.loads(pickle.dumps(PartialDownloadFailedException('部分失败', {'downloader': lambda: None, 'n': 1})))
+        self.assertIsInstance(e, PartialDownloadFailedException)
+        self.assertEqual(('部分失败', {'n': 1}), (e.msg, e.context))
+
+
+class Test_Multiprocess_Batch(unittest.TestCase):
+
+    def setUp(self):
+        RateLimiter.reset()
+        DomainHealthRegistry.reset()
+        self.addCleanup(RateLimiter.reset)
+        self.addCleanup(DomainHealthRegistry.reset)
+
+    def test_shards_across_processes_and_merges_result(self):
+        option = JmOption.default()
+        option.client.rate_limit = {'image': {'rps': 1000}}
+
+        result = download_batch_multiprocess(download_album, ['1', '2', '2', '3', '404', '500'], option,
+                                             FakeDownloader, processes=2)
+
+        self.assertEqual({'1', '2', '3'}, {album.album_id for album, _ in result})
+        self.assertEqual({'404', '500'}, set(result.failed))
+        self.assertEqual('本子不存在', str(result.failed['404']))
+        self.assertEqual({}, result.failed['404'].context)
+
+        # 部分下载失败的异常在父进程中同样带有下载器，可以读取清单和失败记录
+        e = result.failed['500']
+        self.assertIsInstance(e, PartialDownloadFailedException)
+        self.assertEqual([('00001.jpg', '图片下载超时')], [(img, str(err)) for img, err in e.downloader.download_failed_image])
+        self.assertEqual(['500.jpg'], [m.image_filepath_list[0].split('/')[1] for m in e.downloader.manifest_dict.values()])
+
+        # 下载清单来自子进程
+        pid_set = {r.manifest.image_filepath_list[0].split('/')[0] for r in result}
+        self.assertNotIn(str(os.getpid()), pid_set)
+        self.assertEqual(2, len(pid_set))
+
+        # 限速和域名健康度在共享状态中汇总，下载结束后并回父进程
+        self.assertEqual(5, RateLimiter.snapshot()['img.example']['request'])
+        self.assertEqual(5, DomainHealthRegistry.REGISTRY['api.example']['success'])
+
+    def test_rejects_other_download_api(self):
+        with self.assertRaises(Exception):
+            download_batch_multiprocess(download_batch, ['1'])
@@ -0,0 +1,97 @@
+"""
+客户端缓存命中开销评测脚本
+
+对比缓存命中时得到一个独立实体的两种方式（只计算 CPU 部分，不含网络）：
+  1. deepcopy：旧实现，存、取各 deepcopy 一次
+  2. EntitySnapshot：缓存不可变快照，命中时 materialize
+
+用法：
+  python usage/benchmark_entity_cache.py
+环境变量：
+  BENCHMARK_EPISODES  本子的章节数，默认 500
+  BENCHMARK_PAGES     章节的图片数，默认 200
+  BENCHMARK_HITS      每轮命中次数，默认 1000
+  BENCHMARK_ROUNDS    轮数，默认 3
+"""
+from __future__ import annotations
+
+import os
+import sys
+import time
+from copy import deepcopy
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from jmcomic import JmAlbumDetail, JmPhotoDetail
+
+EPISODES = int(os.environ.get('BENCHMARK_EPISODES', '500'))
+PAGES = int(os.environ.get('BENCHMARK_PAGES', '200'))
+HITS = int(os.environ.get('BENCHMARK_HITS', '1000'))
+ROUNDS = int(os.environ.get('BENCHMARK_ROUNDS', '3'))
+
+
+def new_album() -> JmAlbumDetail:
+    return JmAlbumDetail(
+        album_id='123',
+        scramble_id='220980',
+        name='album',
+        episode_list=[(str(100000 + i), str(i + 1), f'第{i + 1}話') for i in range(EPISODES)],
+        page_count=EPISODES * PAGES,
+        pub_date='2026-01-01',
+        update_date='2026-01-01',
+        likes='1K',
+        views='40K',
+        comment_count=100,
+        works=['work'],
+        actors=['actor'],
+        authors=['author'],
+        tags=[f'tag{i}' for i in range(20)],
+        related_list=[{'id': str(i), 'name': f'related{i}', 'author': 'author'} for i in range(20)],
+    )
+
+
+def new_photo(album: JmAlbumDetail) -> JmPhotoDetail:
+    return JmPhotoDetail(
+        photo_id='100000',
+        name='第1話',
+        series_id='123',
+        sort=1,
+        scramble_id='220980',
+        page_arr=[f'{i:05}.webp' for i in range(1, PAGES + 1)],
+        data_original_domain='cdn.example',
+        from_album=album,
+    )
+
+
+def bench(hit_func) -> float:
+    """返回单次命中的微秒数，取多轮最好成绩"""
+    best = float('inf')
+    for _ in range(ROUNDS):
+        begin = time.perf_counter()
+        for _ in range(HITS):
+            hit_func()
+        best = min(best, (time.perf_counter() - begin) / HITS * 1e6)
+    return best
+
+
+def main():
+    album = new_album()
+    # 模拟 getindex 的 lru_cache 已经被填充
+    for photo in album:
+        _ = photo.name
+    photo = new_photo(album)
+
+    print(f'episodes: {EPISODES}, pages: {PAGES}, hits: {HITS}, rounds: {ROUNDS}')
+    print('| 实体 | deepcopy (us/hit) | snapshot (us/hit) | speedup |')
+    print('|---|---|---|---|')
+    for name, entity in (('album', album), ('photo', photo)):
+        cached, snapshot = deepcopy(entity), entity.snapshot()
+        assert snapshot.materialize().__dict__.keys() == entity.__dict__.keys()
+
+        old = bench(lambda: deepcopy(cached))
+        new = bench(snapshot.materialize)
+        print(f'| {name} | {old:.1f} | {new:.1f} | {old / new:.1f}x |')
+
+
+if __name__ == '__main__':
+    main()
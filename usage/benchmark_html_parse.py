@@ -0,0 +1,162 @@
+"""
+网页端详情页解析性能评测脚本
+
+对比 JmcomicText.reflect_new_instance 的两种实现（只计算 CPU 解析部分，不含网络）：
+  1. legacy：旧实现，每次解析遍历 cls.__dict__ 查找 pattern，每个字段各自缩小范围
+  2. field plan：每个前缀只编译一次字段计划，缩小范围的结果在字段间共享
+
+用法：
+  python usage/benchmark_html_parse.py
+环境变量：
+  BENCHMARK_HTML_DIR  保存下来的网页目录，album_*.html 为本子页，photo_*.html 为章节页。
+                      不指定时使用生成的页面
+  BENCHMARK_EPISODES  生成的本子页的章节数，默认 200
+  BENCHMARK_PADDING   生成的页面中无关内容的字节数，默认 200000（接近真实页面大小）
+  BENCHMARK_PARSES    每轮每个页面的解析次数，默认 50
+  BENCHMARK_ROUNDS    轮数，默认 3
+"""
+from __future__ import annotations
+
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from jmcomic import JmcomicText, JmModuleConfig
+
+HTML_DIR = os.environ.get('BENCHMARK_HTML_DIR', None)
+EPISODES = int(os.environ.get('BENCHMARK_EPISODES', '200'))
+PADDING = int(os.environ.get('BENCHMARK_PADDING', '200000'))
+PARSES = int(os.environ.get('BENCHMARK_PARSES', '50'))
+ROUNDS = int(os.environ.get('BENCHMARK_ROUNDS', '3'))
+
+
+def new_album_html() -> str:
+    padding = '<div class="p-t-5 p-b-5">related</div>\n' * (PADDING // 40)
+    episode = ''.join(
+        f'<a href="/photo/{100000 + i}" data-album="{100000 + i}"><li>第{i + 1}話 标题{i}<span>2024-01-01</span></li></a>\n'
+        for i in range(EPISODES)
+    )
+    tag_span = ''.join(
+        f'<span itemprop="{prop}" data-type="{kind}"><a href="/search?q={kind}">{kind}1</a><a href="#">{kind}2</a></span>\n'
+        for prop, kind in (('author', 'works'), ('author', 'actor'), ('genre', 'tags'), ('author', 'author'))
+    )
+    return (
+        f'<html><head><title>本子|禁漫天堂</title></head><body>{padding}'
+        f'<h1 id="book-name" class="book-name">本子名称</h1>\n'
+        f'<span class="number">禁漫車：JM123456</span>\n'
+        f'<span class="pagecount">頁數:{EPISODES * 20}</span>\n'
+        f'<span itemprop="datePublished">上架日期 : 2024-01-01</span>\n'
+        f'<span itemprop="dateModified">更新日期 : 2024-02-01</span>\n'
+        f'{tag_span}'
+        f'<span id="albim_likes_123456">1.2K</span>\n'
+        f'<span>40K</span>\n    <span>次觀看</span>\n'
+        f'<h2 class="p-t-5 p-b-5">叙述：简介</h2>\n'
+        f'<div class="episode">{episode}</div>\n'
+        f'<div class="badge" id="total_video_comments">100</div>\n'
+        f'{padding}<script>var scramble_id = 220980;</script></body></html>'
+    )
+
+
+def new_photo_html() -> str:
+    padding = '<div class="p-t-5 p-b-5">related</div>\n' * (PADDING // 40)
+    return (
+        f'<html><head><title>第1話|禁漫天堂</title>'
+        f'<meta name="keywords" content="tag1,tag2" />'
+        f'<meta property="og:url" content="https://18comic.vip/photo/100000/" /></head><body>{padding}'
+        f'<img src="https://cdn.example/media/albums/blank.jpg" />'
+        f'<img data-original="https://cdn.example/media/photos/100000/00001.webp" id="album_photo_00001.webp" data-page="0" />'
+        f'{padding}<script>var scramble_id = 220980;\nvar series_id = 123456;\nvar sort = 1;\n'
+        f'var page_arr = ["00001.webp","00002.webp"];</script></body></html>'
+    )
+
+
+def load_page_list() -> list:
+    if HTML_DIR is None:
+        return [('album', new_album_html()), ('photo', new_photo_html())]
+
+    page_list = []
+    for kind in ('album', 'photo'):
+        for path in sorted(glob.glob(os.path.join(HTML_DIR, f'{kind}_*.html'))):
+            with open(path, 'r', encoding='utf-8') as f:
+                page_list.append((kind, f.read()))
+    return page_list
+
+
+def legacy_reflect_new_instance(cls, html: str, cls_field_prefix: str, clazz: type):
+    """reflect_new_instance 的旧实现"""
+
+    def match_field(field_name, pattern, text):
+        if isinstance(pattern, list):
+            last_pattern = pattern[len(pattern) - 1]
+            for i in range(0, len(pattern) - 1):
+                match = pattern[i].search(text)
+                if match is None:
+                    return None
+                text = match[0]
+            return last_pattern.findall(text)
+
+        if field_name.endswith("_list"):
+            return pattern.findall(text)
+        else:
+            match = pattern.search(text)
+            if match is not None:
+                return match[1]
+            return None
+
+    field_dict = {}
+    for pattern_name, pattern in cls.__dict__.items():
+        if not pattern_name.startswith(cls_field_prefix):
+            continue
+        if isinstance(pattern, tuple):
+            pattern, default = pattern
+        else:
+            default = None
+        field_name = pattern_name[pattern_name.index(cls_field_prefix) + len(cls_field_prefix):]
+        field_value = match_field(field_name, pattern, html)
+        field_dict[field_name] = default if field_value is None else field_value
+    return clazz(**field_dict)
+
+
+def parse_args(kind: str):
+    if kind == 'album':
+        return 'pattern_html_album_', JmModuleConfig.album_class()
+    return 'pattern_html_photo_', JmModuleConfig.photo_class()
+
+
+def bench(parse_func, page_list) -> float:
+    """返回 pages/sec，取多轮最好成绩"""
+    best = 0.0
+    for _ in range(ROUNDS):
+        begin = time.perf_counter()
+        for kind, html in page_list:
+            prefix, clazz = parse_args(kind)
+            for _ in range(PARSES):
+                parse_func(html, prefix, clazz)
+        best = max(best, len(page_list) * PARSES / (time.perf_counter() - begin))
+    return best
+
+
+def main():
+    page_list = load_page_list()
+    assert page_list, f'{HTML_DIR} 中没有 album_*.html / photo_*.html'
+
+    for kind, html in page_list:
+        prefix, clazz = parse_args(kind)
+        old = legacy_reflect_new_instance(JmcomicText, html, prefix, clazz)
+        new = JmcomicText.reflect_new_instance(html, prefix, clazz)
+        assert old.__dict__ == new.__dict__, f'解析结果不一致: {kind}'
+
+    print(f'pages: {len(page_list)} ({"saved" if HTML_DIR else "generated"}), parses: {PARSES}, rounds: {ROUNDS}')
+    print('| 实现 | pages/sec |')
+    print('|---|---|')
+    old = bench(lambda *args: legacy_reflect_new_instance(JmcomicText, *args), page_list)
+    new = bench(JmcomicText.reflect_new_instance, page_list)
+    print(f'| legacy | {old:.0f} |')
+    print(f'| field plan | {new:.0f} ({new / old:.2f}x) |')
+
+
+if __name__ == '__main__':
+    main()
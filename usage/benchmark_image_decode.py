@@ -0,0 +1,70 @@
+"""
+图片解密性能评测脚本
+
+对比 JmImageTool 的两种解密实现（只计算 CPU 解密部分，不含网络和磁盘）：
+  1. decode_image_by_paste：旧实现，每页新建画布，逐条计算偏移后 crop + paste
+  2. decode_image + reuse_canvas：缓存的条带偏移表 + 线程内复用画布（decode_and_save 的实际路径）
+
+用法：
+  python usage/benchmark_image_decode.py
+环境变量：
+  BENCHMARK_IMAGE_SIZE  图片尺寸，默认 720x10000（接近长条漫画页）
+  BENCHMARK_PAGES       每轮解密页数，默认 50
+  BENCHMARK_ROUNDS      轮数，默认 3
+"""
+from __future__ import annotations
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from PIL import Image
+
+from jmcomic import JmImageTool
+
+W, H = map(int, os.environ.get('BENCHMARK_IMAGE_SIZE', '720x10000').split('x'))
+PAGES = int(os.environ.get('BENCHMARK_PAGES', '50'))
+ROUNDS = int(os.environ.get('BENCHMARK_ROUNDS', '3'))
+NUM_LIST = [2, 4, 6, 8, 10, 12, 14, 16, 18, 20]
+
+
+def new_source_image() -> Image.Image:
+    # 用随机字节构造，避免纯色图片让 PIL 走捷径
+    return Image.frombytes('RGB', (W, H), os.urandom(W * H * 3))
+
+
+def bench(decode_func, img) -> float:
+    """返回 pages/sec，取多轮最好成绩"""
+    best = 0.0
+    for _ in range(ROUNDS):
+        begin = time.perf_counter()
+        for i in range(PAGES):
+            decode_func(NUM_LIST[i % len(NUM_LIST)], img)
+        cost = time.perf_counter() - begin
+        best = max(best, PAGES / cost)
+    return best
+
+
+def main():
+    img = new_source_image()
+
+    # 正确性校验
+    for num in NUM_LIST:
+        assert JmImageTool.decode_image(num, img).tobytes() == \
+               JmImageTool.decode_image_by_paste(num, img).tobytes(), num
+
+    old = bench(JmImageTool.decode_image_by_paste, img)
+    new = bench(lambda num, src: JmImageTool.decode_image(num, src, JmImageTool.reuse_canvas(src.size)), img)
+
+    print(f'image: {W}x{H}, pages: {PAGES}, rounds: {ROUNDS}')
+    print('| 实现 | pages/sec |')
+    print('|---|---|')
+    print(f'| crop + paste | {old:.1f} |')
+    print(f'| strip table + reused canvas | {new:.1f} |')
+    print(f'speedup: {new / old:.2f}x')
+
+
+if __name__ == '__main__':
+    main()